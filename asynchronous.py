@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""
+Non-blocking counterparts of the users module functions.
+
+An AsyncConnection runs work on a fixed number of worker threads, each
+borrowing a connection from a db.ConnectionPool, so that any number of
+requests can be in flight without a thread for each of them. Every
+function here returns a Future at once, which is resolved when the work
+is done. Futures can be waited on, or given callbacks, which is how an
+event loop would integrate them.
+
+
+rbp@isnomore.net
+"""
+
+
+import sys
+import logging
+import threading
+from Queue import Queue
+
+from . import users
+from . db import queries
+from . config import options
+
+
+class Future(object):
+    """The eventual result of some work (or the exception it raised)."""
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def _resolve(self, result, exc_info):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        """Calls callback(self), logging (rather than raising) whatever it
+        raises, so that it can't kill the thread resolving the future.
+        """
+        try:
+            callback(self)
+        except Exception:
+            logging.getLogger(__name__).exception(
+                'Exception calling callback for %r', self)
+
+    def set_result(self, result):
+        self._resolve(result, None)
+
+    def set_exception(self, exc_info):
+        """Resolves the future with an exception, as given by
+        sys.exc_info(), so that result() raises it with its traceback.
+        """
+        self._resolve(None, exc_info)
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) once it's done (right away, if it is),
+        on the thread that resolves it. Exceptions raised by callbacks are
+        logged and ignored.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def _wait(self, timeout):
+        if timeout is None:
+            # Waiting with no timeout at all can't be interrupted
+            while not self._done.wait(1):
+                pass
+        elif not self._done.wait(timeout):
+            raise RuntimeError('Future not done after {0} seconds'.
+                               format(timeout))
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+    def result(self, timeout=None):
+        """Waits for the result (at most timeout seconds, if given), and
+        returns it, or raises the work's exception.
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class AsyncConnection(object):
+    """Runs work on 'workers' threads (defaulting to options.async_workers),
+    each borrowing a connection from pool (a db.ConnectionPool, which
+    should allow at least as many connections) for each piece of work.
+
+    Named queries can be called on it as on a db.Connection, returning
+    Futures.
+    """
+    def __init__(self, pool, workers=None):
+        if workers is None:
+            workers = options.async_workers
+        self._pool = pool
+        self._tasks = Queue()
+        self._threads = [threading.Thread(target=self._work)
+                         for i in xrange(workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def __getattr__(self, name):
+        if name in queries:
+            def call_query(*args):
+                return self.submit(_run_query, name, *args)
+            return call_query
+        else:
+            raise AttributeError("'{0}' object has no attribute '{1}'".
+                                 format(self.__class__, name))
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            future, func, args, kwargs = task
+            try:
+                with self._pool.connection() as conn:
+                    result = func(*args, conn=conn, **kwargs)
+            except Exception:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+    def submit(self, func, *args, **kwargs):
+        """Calls func(*args, conn=<a db.Connection>, **kwargs) on a worker
+        thread, returning a Future of its result.
+        """
+        future = Future()
+        self._tasks.put((future, func, args, kwargs))
+        return future
+
+    def close(self):
+        """Finishes the pending work, and stops the worker threads."""
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def _run_query(name, *args, **kwargs):
+    return kwargs['conn']._execute_query(name, *args)
+
+
+def register_user(email, password, aconn):
+    return aconn.submit(users.register_user, email, password)
+
+def activate(key, aconn):
+    return aconn.submit(users.activate, key)
+
+def authenticate(email, password, aconn, issue_token=False):
+    return aconn.submit(users.authenticate, email, password,
+                        issue_token=issue_token)
+
+
+def _offloaded(decorator):
+    """Turns a users module access control decorator into one for
+    functions called with an AsyncConnection, which return a Future of the
+    function's result (or of UnauthorizedAccessError).
+    """
+    def decorate(func):
+        checked = decorator(func)
+        def async_wrapper(email, aconn, *args, **kwargs):
+            def run(conn):
+                return checked(email, conn, *args, **kwargs)
+            return aconn.submit(run)
+        return async_wrapper
+    return decorate
+
+def access_control(role):
+    """Counterpart of users.access_control."""
+    return _offloaded(users.access_control(role))
+
+def access_control_by_roles(expression):
+    """Counterpart of users.access_control_by_roles."""
+    return _offloaded(users.access_control_by_roles(expression))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+Failed authentication attempt trackers.
+
+When options.attempt_tracker is set to one of these, users.authenticate
+counts failed attempts on it, instead of on the database, and only writes
+to the database to suspend a user. Counts are forgotten
+options.failed_attempts_ttl seconds after the last failed attempt.
+
+MemoryAttemptTracker keeps counts in the running process.
+FileAttemptTracker shares them between processes on the same host, and
+RedisAttemptTracker between hosts, through a Redis server.
+
+
+rbp@isnomore.net
+"""
+
+
+import abc
+import time
+import sqlite3
+import threading
+
+from . cache import TTLCache
+from . config import options
+
+
+class AttemptTracker(object):
+    """Interface of failed attempt trackers. 'now', when given, is the
+    current time, so that it doesn't have to be looked up again.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def get(self, email, now=None):
+        """Returns the number of recent failed attempts for email."""
+
+    @abc.abstractmethod
+    def increment(self, email, now=None):
+        """Records a failed attempt for email, returning the number of
+        recent failed attempts (this one included).
+        """
+
+    @abc.abstractmethod
+    def reset(self, email):
+        pass
+
+
+class MemoryAttemptTracker(AttemptTracker):
+    """Keeps failed attempt counts in memory, for at most max_size users
+    (the least recently seen ones being forgotten first).
+    """
+    def __init__(self, ttl=None, max_size=100000):
+        if ttl is None:
+            ttl = options.failed_attempts_ttl
+        self._counts = TTLCache(ttl, max_size)
+
+    def get(self, email, now=None):
+        return self._counts.get(email, 0, now)
+
+    def increment(self, email, now=None):
+        return self._counts.increment(email, now)
+
+    def reset(self, email):
+        self._counts.pop(email)
+
+
+class FileAttemptTracker(AttemptTracker):
+    """Keeps failed attempt counts on a sqlite database at path, in WAL
+    mode, so that they're shared by every process using the same path.
+    Each thread uses a connection of its own. Expired counts are purged
+    at most once every purge_interval seconds, as attempts are counted.
+    """
+    def __init__(self, path, ttl=None, purge_interval=60):
+        if ttl is None:
+            ttl = options.failed_attempts_ttl
+        self._path = path
+        self._ttl = ttl
+        self._purge_interval = purge_interval
+        self._next_purge = 0
+        self._local = threading.local()
+        self._conn().executescript("""
+            create table if not exists attempt_counts
+                (email text primary key, count integer not null,
+                 expires real not null);
+            create index if not exists attempt_counts_expires
+                on attempt_counts (expires);""")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit, so that increment can begin immediate transactions
+            conn = self._local.conn = sqlite3.connect(self._path,
+                                                      isolation_level=None)
+            conn.execute('pragma journal_mode = wal')
+            conn.execute('pragma synchronous = normal')
+        return conn
+
+    def get(self, email, now=None):
+        if now is None:
+            now = time.time()
+        row = self._conn().execute(
+            'select count from attempt_counts where email = ? and expires > ?',
+            (email, now)).fetchone()
+        return row[0] if row else 0
+
+    def increment(self, email, now=None):
+        if now is None:
+            now = time.time()
+        conn = self._conn()
+        conn.execute('begin immediate')
+        try:
+            if now >= self._next_purge:
+                conn.execute('delete from attempt_counts where expires <= ?',
+                             (now,))
+                self._next_purge = now + self._purge_interval
+            count = self.get(email, now) + 1
+            conn.execute('insert or replace into attempt_counts '
+                         '(email, count, expires) values (?, ?, ?)',
+                         (email, count, now + self._ttl))
+        except:
+            conn.execute('rollback')
+            raise
+        conn.execute('commit')
+        return count
+
+    def reset(self, email):
+        self._conn().execute('delete from attempt_counts where email = ?',
+                             (email,))
+
+
+class RedisAttemptTracker(AttemptTracker):
+    """Keeps failed attempt counts on a Redis server, through client (a
+    redis.StrictRedis, or anything with its incr, expire, get and delete
+    methods), as keys made of prefix and each email.
+    """
+    def __init__(self, client, ttl=None, prefix='auth:failed:'):
+        if ttl is None:
+            ttl = options.failed_attempts_ttl
+        self._client = client
+        self._ttl = int(ttl)
+        self._prefix = prefix
+
+    def get(self, email, now=None):
+        return int(self._client.get(self._prefix + email) or 0)
+
+    def increment(self, email, now=None):
+        key = self._prefix + email
+        count = self._client.incr(key)
+        self._client.expire(key, self._ttl)
+        return count
+
+    def reset(self, email):
+        self._client.delete(self._prefix + email)
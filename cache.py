@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+In-process caches for this package.
+
+Since time.time is sometimes replaced by tests, cache methods accept the
+current time as an optional parameter, so that callers which already know
+it don't have to look it up again.
+
+
+rbp@isnomore.net
+"""
+
+
+import time
+import itertools
+import threading
+
+
+class TTLCache(object):
+    """A thread-safe mapping whose entries expire 'ttl' seconds after they
+    are set (or at an explicit time), holding at most max_size entries, the
+    least recently used ones being evicted first. A ttl or max_size of None
+    means no limit.
+
+    Entries are kept in a plain dictionary (collections.OrderedDict is
+    several times slower), along with the tick of a clock at which they
+    were last used. When the cache grows past max_size, expired entries
+    and then the least recently used ones are evicted, a tenth of max_size
+    more than necessary, so that this happens only now and then.
+    """
+    def __init__(self, ttl=None, max_size=None):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._data = {}
+        self._clock = itertools.count()
+        self._lock = threading.Lock()
+        self._sweep_at = max_size if max_size is not None else 1024
+
+    def __len__(self):
+        return len(self._data)
+
+    def _expiry(self, now, expires):
+        if expires is not None or self._ttl is None:
+            return expires
+        return now + self._ttl
+
+    def _evict(self, now):
+        """Evicts expired entries and, if there are still too many, the
+        least recently used ones. Called with the lock held.
+        """
+        data = self._data
+        for key, entry in data.items():
+            if entry[0] is not None and entry[0] <= now:
+                del data[key]
+        if self._max_size is None:
+            self._sweep_at = max(1024, 2 * len(data))
+            return
+        excess = len(data) - self._max_size
+        if excess > 0:
+            excess += self._max_size // 10
+            by_use = sorted(data, key=lambda key: data[key][2])
+            for key in by_use[:excess]:
+                del data[key]
+
+    def _store(self, key, value, expires, now):
+        """Called with the lock held."""
+        self._data[key] = [expires, value, next(self._clock)]
+        if len(self._data) > self._sweep_at:
+            self._evict(now)
+
+    def get(self, key, default=None, now=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[0] is not None:
+            if now is None:
+                now = time.time()
+            if entry[0] <= now:
+                return default
+        entry[2] = next(self._clock)
+        return entry[1]
+
+    def set(self, key, value, expires=None, now=None):
+        """Sets key to value, expiring at 'expires' (if given) or after
+        this cache's ttl.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._store(key, value, self._expiry(now, expires), now)
+
+    def increment(self, key, now=None):
+        """Adds one to the value of key (starting at zero, if it isn't set
+        or has expired), renewing its expiry time. Returns the new value.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[0] is not None and entry[0] <= now):
+                value = 1
+            else:
+                value = entry[1] + 1
+            self._store(key, value, self._expiry(now, None), now)
+            return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -11,29 +11,73 @@ rbp@isnomore.net
 
 
 import time
-from . db import Connection
+from . db import Connection, borrow
 from . config import options
 
 
-def delete_expired_pending_users(conn=None):
+def delete_expired_pending_users(conn=None, chunk_size=None, pause=None):
+    """Deletes pending users registered more than
+    options.registration_expiration seconds ago, with a single statement.
+
+    If chunk_size is given (it defaults to
+    options.expired_users_chunk_size), they are deleted at most chunk_size
+    at a time, each chunk in its own transaction, with a pause of 'pause'
+    seconds (defaulting to options.expired_users_chunk_pause) between
+    chunks, so that the table isn't locked for long.
+
+    Returns a dictionary with the number of users 'deleted' (not counting
+    those deleted by drivers that don't report it), the time 'elapsed' (in
+    seconds), and the chunks that 'failed' to be deleted, as a list of
+    (chunk number, exception args) tuples.
+    """
     if conn is None:
         conn = Connection(options.db_params, driver=options.db_driver)
         conn.connect()
-    results = {'failed': []}
-    now = int(time.time())
-    expiration_time = now - options.registration_expiration
-    expired = conn.get_pending_users_registered_before(expiration_time)
-    for email in expired:
-        try:
-            conn.delete_pending_user(email)
-        except Exception, e:
-            results['failed'].append((email, e.args))
+    if chunk_size is None:
+        chunk_size = options.expired_users_chunk_size
+    if pause is None:
+        pause = options.expired_users_chunk_pause
+    results = {'failed': [], 'deleted': 0}
+    start = time.time()
+    expiration_time = int(start) - options.registration_expiration
+    with borrow(conn) as conn:
+        chunk = 0
+        while True:
+            try:
+                with conn.transaction():
+                    if chunk_size:
+                        deleted = \
+                            conn.delete_some_pending_users_registered_before(
+                                expiration_time, chunk_size)
+                    else:
+                        deleted = conn.delete_pending_users_registered_before(
+                            expiration_time)
+            except Exception, e:
+                results['failed'].append((chunk, e.args))
+                break
+            if deleted < 0:
+                # The driver doesn't know how many were deleted: carry on
+                # until there are none left
+                if (not chunk_size or
+                    conn.get_a_pending_user_registered_before(
+                        expiration_time) is None):
+                    break
+            else:
+                results['deleted'] += deleted
+                if not chunk_size or deleted < chunk_size:
+                    break
+            chunk += 1
+            if pause:
+                time.sleep(pause)
+    results['elapsed'] = time.time() - start
     return results
 
 
 if __name__ == '__main__':
     results = delete_expired_pending_users()
-    if results:
-        print "Deletion failed for:"
-        print "\n".join(i[0] for i in results["failed"])
+    print "Deleted {0} users in {1:.2f} seconds".format(results['deleted'],
+                                                       results['elapsed'])
+    if results['failed']:
+        print "Deletion failed for chunks:"
+        print "\n".join(str(i[0]) for i in results["failed"])
 
@@ -18,6 +18,11 @@ options = Options()
 # For how long new user registration is valid, in seconds
 options.registration_expiration = 60 * 60 * 24 * 7
 
+# Expired pending users are deleted this many at a time (None for all
+# at once), pausing for this many seconds between each chunk
+options.expired_users_chunk_size = None
+options.expired_users_chunk_pause = 0
+
 # "From" field of registration confirmation email
 options.reg_confirmation_from = 'The Website People'
 options.reg_confirmation_from_addr = 'webmaster@isnomore.net'
@@ -30,9 +35,74 @@ options.reg_confirmation_template = 'reg_confirmation.template'
 
 options.smtp_server = 'localhost'
 
+# Confirmation messages sent over each connection to the SMTP server,
+# before reconnecting (None for no limit)
+options.smtp_messages_per_session = 100
+
+# Mailed pending users are marked as such this many at a time. When
+# running in worker mode (mailer.py --worker), each mailer also claims
+# this many pending users at a time, mails them using this many threads,
+# and gives up on claims after this many seconds
+options.mailer_batch_size = 100
+options.mailer_threads = 4
+options.mailer_claim_timeout = 60 * 10
+
+# users.bulk_import_users reads, hashes and inserts users this many at a
+# time, hashing them on this many processes (None for one per CPU)
+options.import_chunk_size = 10000
+options.import_processes = None
+
+# Passwords are hashed by this hasher (from the hashers module), at a
+# cost (see "python -m auth.hashers" to calibrate it) of this many
+# iterations for pbkdf2_sha256, or of this "n" parameter for scrypt
+options.password_hasher = 'pbkdf2_sha256'
+options.pbkdf2_iterations = 100000
+options.scrypt_cost = 2 ** 14
+
+# When calibrating, hashers aim to take this many seconds per password
+options.password_hash_target = 0.1
+
+# When set to a hashers.HashingExecutor, passwords are hashed on its pool
+# of processes (this many, or one per CPU if None), instead of on the
+# calling thread. Hashing waits at most this many seconds (None to wait
+# forever) when the executor already has too many pending hashes
+options.hashing_executor = None
+options.hashing_processes = None
+options.hashing_queue_timeout = None
+
+# Whether users' passwords are hashed again when they authenticate, if
+# they were hashed by an older hasher, or at a lower cost
+options.rehash_passwords = True
+
+# Threads on which an asynchronous.AsyncConnection runs its work (its
+# connection pool should allow at least as many connections)
+options.async_workers = 8
+
 # After this many consecutive failed authentication attemps,
 # account is temporarily suspended
 options.failed_auth_limit = 3
 
 # For how long account is suspended, in seconds
 options.login_suspended_period = 60 * 5
+
+# Roles are remembered by each process, for up to this many users and for
+# at most this many seconds, before being queried again
+options.role_cache_size = 10000
+options.role_cache_ttl = 60
+
+# Session tokens (see the tokens module) are signed with the first of these
+# (key id, secret) pairs, and accepted if signed with any of them, for this
+# many seconds after being issued. Key ids can't contain dots
+options.token_keys = []
+options.token_ttl = 3600
+
+# Suspended accounts are remembered by each process, up to this many, and
+# rejected without querying the database until their suspension ends
+options.suspension_cache_size = 10000
+
+# Where failed authentication attempts are counted: None for the database,
+# or one of the trackers from the attempts module (for instance,
+# attempts.MemoryAttemptTracker()), in which case counts are forgotten
+# this many seconds after the last failed attempt
+options.attempt_tracker = None
+options.failed_attempts_ttl = 60 * 60
@@ -8,24 +8,66 @@ rbp@isnomore.net
 """
 
 
+import bisect
+import logging
 import string
-from . exceptions import (InternalError, InvalidDriverError,
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from . exceptions import (InternalError, InvalidDriverError, PoolTimeoutError,
                           UnsupportedParamStyle, UnsupportedQueryReturnType)
 
 
+def _no_results(cursor):
+    return None
+
+def _one_row(cursor):
+    rows = cursor.fetchall()
+    return rows[0] if rows else None
+
+def _unique(cursor):
+    rows = cursor.fetchall()
+    return rows[0][0] if rows and rows[0] else None
+
+# Functions turning the cursor on which a query was executed into its
+# results, by return type
+result_shapers = {None: _no_results,
+                  'rowcount': lambda cursor: cursor.rowcount,
+                  'rows': lambda cursor: cursor.fetchall(),
+                  'one row': _one_row,
+                  'one column': lambda cursor: [r[0] for r in
+                                                cursor.fetchall()],
+                  'unique': _unique}
+
+def _unsupported_return_type(return_type):
+    def shape(cursor):
+        raise UnsupportedQueryReturnType('Unsupported return type: {0}'.
+                                         format(return_type))
+    return shape
+
+
 class Query(object):
     """A query to the database.
     This takes care of properly formatting the query and parameters,
     according to the chosen Python DB API v2.0 parameter style
     (if supported).
+
+    The query string and parameter binding for each paramstyle are
+    compiled on first use and memoized, so that executing the same query
+    again does no string processing at all.
     """
-    supported_paramstyles = ['qmark', 'numeric', 'named']
+    supported_paramstyles = ['qmark', 'numeric', 'named',
+                             'format', 'pyformat']
 
     def __init__(self, name, return_type, query, param_order=None):
         self._name = name
         self._return_type = return_type
         self._query = query
         self._param_order = param_order
+        self._compiled = {}
+        self._shape = result_shapers.get(
+            return_type, _unsupported_return_type(return_type))
 
     def __eq__(self, other):
         return self._name == other
@@ -49,44 +91,234 @@ class Query(object):
             return params
         return seq(params[i] for i in self._param_order)
 
-    def query(self, *params, **kwargs):
-        """Returns properly formatted (query string, parameter tuple)
-        for this query, given parameters and optional paramstyle
-        (which defaults to qmark).
+    def compile(self, paramstyle='qmark'):
+        """Returns (query string, binder) for the given paramstyle,
+        where binder is a function converting the method's parameter
+        tuple into what the driver expects. The result is memoized.
         """
-        paramstyle = kwargs.get('paramstyle', 'qmark')
-        params = self.reorder_params(params)
+        try:
+            return self._compiled[paramstyle]
+        except KeyError:
+            pass
+        if paramstyle not in self.supported_paramstyles:
+            raise UnsupportedParamStyle(
+                'Unsupported paramstyle: {0}'.format(paramstyle))
+
         q_split = self._query.split('?')
+        if paramstyle in ('format', 'pyformat'):
+            q_split = [part.replace('%', '%%') for part in q_split]
         if paramstyle == 'qmark':
-            return self._query, params
+            query = self._query
         elif paramstyle == 'numeric':
-            converted = [(part + ':{0}'.format(i+1)) for i, part in
-                         enumerate(q_split[:-1])] + q_split[-1:]
-            return ''.join(converted), params
+            query = ''.join([(part + ':{0}'.format(i+1)) for i, part in
+                             enumerate(q_split[:-1])] + q_split[-1:])
         elif paramstyle == 'named':
-            converted = [part + ':{0}'.format(l) for l, part in
-                         zip(string.ascii_letters, q_split[:-1])] + q_split[-1:]
-            param_dict = dict(zip(string.ascii_letters, params))
-            return ''.join(converted), param_dict
+            query = ''.join([part + ':{0}'.format(l) for l, part in
+                             zip(string.ascii_letters, q_split[:-1])] +
+                            q_split[-1:])
+        elif paramstyle == 'format':
+            query = '%s'.join(q_split)
+        else:
+            query = ''.join([part + '%({0})s'.format(l) for l, part in
+                             zip(string.ascii_letters, q_split[:-1])] +
+                            q_split[-1:])
+
+        if paramstyle in ('named', 'pyformat'):
+            names = string.ascii_letters[:len(q_split) - 1]
+            order = self._param_order
+            if order is None:
+                binder = lambda params: dict(zip(names, params))
+            else:
+                binder = lambda params: dict(zip(names,
+                                                 [params[i] for i in order]))
+        elif self._param_order is None:
+            binder = lambda params: params
+        else:
+            binder = self.reorder_params
+
+        compiled = self._compiled[paramstyle] = query, binder
+        return compiled
+
+    def query(self, *params, **kwargs):
+        """Returns properly formatted (query string, parameter tuple)
+        for this query, given parameters and optional paramstyle
+        (which defaults to qmark).
+        """
+        query, binder = self.compile(kwargs.get('paramstyle', 'qmark'))
+        return query, binder(params)
+
+
+def redact(params):
+    """Returns the types of params, in their stead, for logging queries
+    without their (possibly sensitive) parameters.
+    """
+    return tuple('<{0}>'.format(type(param).__name__) for param in params)
+
+
+def _redact_batch(rows):
+    return ('<{0} rows>'.format(len(rows)),)
+
+
+def log_slow_query(name, elapsed, params):
+    """Default sink for slow queries, logging them as warnings."""
+    logging.getLogger(__name__).warning(
+        'Slow query %s (%.3f s), params %s', name, elapsed, params)
+
+
+def _row_count(return_type, result):
+    """The number of rows returned (or affected) by a query, given its
+    shaped result.
+    """
+    if return_type == 'rowcount':
+        return result
+    if return_type is None:
+        return 0
+    if return_type in ('rows', 'one column'):
+        return len(result)
+    return 0 if result is None else 1
+
+
+class QueryStats(object):
+    """Metrics of the named queries executed on db.Connection objects
+    created with it as their 'query_stats' argument: for each query, the
+    number of calls, errors and rows, its total and maximum time, and a
+    histogram of its latencies. It's thread-safe, so all the connections
+    of a pool can share one.
+    """
+    # Upper bounds of the histogram buckets, in seconds (100us to 6.5s)
+    latency_buckets = [0.0001 * 2 ** i for i in xrange(17)]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queries = {}
+
+    def record(self, name, elapsed, rows=0, error=False):
+        bucket = bisect.bisect_left(self.latency_buckets, elapsed)
+        with self._lock:
+            try:
+                stats = self._queries[name]
+            except KeyError:
+                # calls, errors, rows, total time, max time, histogram
+                stats = self._queries[name] = [
+                    0, 0, 0, 0.0, 0.0, [0] * (len(self.latency_buckets) + 1)]
+            stats[0] += 1
+            if error:
+                stats[1] += 1
+            if rows:
+                stats[2] += rows
+            stats[3] += elapsed
+            if elapsed > stats[4]:
+                stats[4] = elapsed
+            stats[5][bucket] += 1
+
+    def _percentile(self, latencies, calls, percent):
+        """Upper bound of the bucket holding the given percentile (None if
+        it's beyond the last one).
+        """
+        threshold = calls * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.latency_buckets, latencies):
+            seen += count
+            if seen >= threshold:
+                return bound
+        return None
+
+    def snapshot(self):
+        """Returns the metrics of each query, by name. Latency percentiles
+        (p50, p95 and p99) are the upper bounds of the buckets they fall
+        in, and 'latencies' maps each upper bound (None for unbounded) to
+        the number of calls that took that long.
+        """
+        with self._lock:
+            snapshot = {}
+            for name, stats in self._queries.iteritems():
+                calls, errors, rows, total_time, max_time, latencies = stats
+                snapshot[name] = {
+                    'calls': calls, 'errors': errors, 'rows': rows,
+                    'total_time': total_time, 'max_time': max_time,
+                    'latencies': dict(zip(self.latency_buckets + [None],
+                                          latencies))}
+                for percent in (50, 95, 99):
+                    snapshot[name]['p{0}'.format(percent)] = \
+                        self._percentile(latencies, calls, percent)
+            return snapshot
 
-        raise UnsupportedParamStyle(
-            'Unsupported paramstyle: {0}'.format(paramstyle))
+    def clear(self):
+        with self._lock:
+            self._queries.clear()
+
+
+# Connection parameters with which drivers can be asked to keep their own
+# cache of prepared statements, by driver module name.
+statement_cache_params = {'sqlite3': 'cached_statements',
+                          'pysqlite2.dbapi2': 'cached_statements'}
+
+# Drivers, by module name, whose connections begin transactions implicitly
+# and commit them before statements such as SAVEPOINT (or don't begin them
+# at all, in autocommit mode), so that Connection.transaction turns that off
+# while in a transaction, and begins it explicitly.
+explicit_begin_drivers = ('sqlite3', 'pysqlite2.dbapi2')
 
 
 class Connection(object):
     """Connection encapsulates a connection to the actual database.
     This takes care of connecting, requesting cursors and executing queries.
+
+    If a 'statement_cache_size' keyword argument is given, each named query
+    is executed on its own cursor, so that it is prepared only once per
+    connection (by the driver's own statement cache, where available) and
+    afterwards only receives new parameters. At most statement_cache_size
+    such cursors are kept, the least recently used ones being closed.
+
+    A 'stream_arraysize' keyword argument sets how many rows at a time are
+    fetched by streaming queries (see StreamingQueries); it defaults to
+    1000.
+
+    Named queries (run on their own or in batch form) are measured when
+    given a 'query_stats' keyword argument (True, or a QueryStats to
+    share), available from stats(), and when given a 'slow_query_time':
+    queries taking at least that many seconds are passed, as (name,
+    elapsed, redacted parameters), to 'slow_query_sink' (log_slow_query
+    by default). Otherwise, queries aren't timed at all.
     """
     def __init__(self, *args, **kwargs):
         self._driver = kwargs.pop('driver', None)
+        self._statement_cache_size = kwargs.pop('statement_cache_size', None)
+        self._stream_arraysize = kwargs.pop('stream_arraysize', 1000)
+        query_stats = kwargs.pop('query_stats', None)
+        if query_stats is True:
+            query_stats = QueryStats()
+        self._query_stats = query_stats or None
+        self._slow_query_time = kwargs.pop('slow_query_time', None)
+        self._slow_query_sink = kwargs.pop('slow_query_sink', log_slow_query)
         self._conn = None
         self._cursor = None
+        self._statements = {}
+        self._statement_use = {}
+        self._statement_clock = 0
+        self._transaction_depth = 0
+        self._pending_hooks = []
         self._conn_args = args
         self._conn_kwargs = kwargs
+        # Whether transactions are begun explicitly, known once the first
+        # one is (see explicit_begin_drivers)
+        self._explicit_begin = None
+        if self._statement_cache_size:
+            cache_param = statement_cache_params.get(
+                getattr(self._driver, '__name__', None))
+            if cache_param:
+                kwargs.setdefault(cache_param, self._statement_cache_size)
+        if self._query_stats is not None or self._slow_query_time is not None:
+            # Shadowing the methods, so that unmeasured connections don't
+            # pay for measuring at all
+            self._execute_query = self._measured_query
+            self._execute_query_many = self._measured_query_many
 
     def __getattr__(self, name):
         """Automatically execute a query called 'name',
         if the requested attribute is the name of a query stored in this module.
+        Queries defined along with this module are methods of this class
+        (see _query_method), so this only handles queries added later.
         """
         if name in queries:
             def call_query(*args):
@@ -96,6 +328,24 @@ class Connection(object):
             raise AttributeError("'{0}' object has no attribute '{1}'".
                                  format(self.__class__, name))
 
+    def stats(self):
+        """Returns a snapshot of the metrics of the named queries executed
+        (see QueryStats.snapshot), or an empty dict if they aren't kept.
+        """
+        if self._query_stats is None:
+            return {}
+        return self._query_stats.snapshot()
+
+    @property
+    def many(self):
+        """The named queries in batch form (see BatchQueries)."""
+        return BatchQueries(self)
+
+    @property
+    def stream(self):
+        """The named queries in streaming form (see StreamingQueries)."""
+        return StreamingQueries(self)
+
     def connect(self):
         try:
             self._conn = self._driver.connect(*self._conn_args,
@@ -105,22 +355,151 @@ class Connection(object):
         if self._conn:
             self._cursor = self._conn.cursor()
 
-    def execute(self, query, params=()):
+    def close(self):
+        if self._conn:
+            self._conn.close()
+        self._conn = None
+        self._cursor = None
+        self._statements.clear()
+        self._statement_use.clear()
+
+    def ping(self):
+        """Returns whether the database still answers on this connection."""
+        if not self._cursor:
+            return False
+        try:
+            self.execute('select 1')
+        except Exception:
+            return False
+        return True
+
+    def _statement_cursor(self, name):
+        """Returns the cursor dedicated to the named query, creating it
+        if needed and evicting the least recently used one if the
+        statement cache is full.
+        """
+        self._statement_clock += 1
+        self._statement_use[name] = self._statement_clock
+        try:
+            return self._statements[name]
+        except KeyError:
+            pass
+        if len(self._statements) >= self._statement_cache_size:
+            lru = min(self._statements, key=self._statement_use.get)
+            self._statements.pop(lru).close()
+            del self._statement_use[lru]
+        cursor = self._statements[name] = self._conn.cursor()
+        return cursor
+
+    def execute(self, query, params=(), statement=None):
+        """Executes query with params. If statement caching is enabled,
+        'statement' names the query, which is then run on its own cursor.
+        """
+        return self._execute('execute', query, params, statement)
+
+    def executemany(self, query, seq_of_params, statement=None):
+        """Executes query once for each params in seq_of_params (which
+        must be a sequence, not an iterator, as it might have to be run
+        twice), as execute does.
+        """
+        return self._execute('executemany', query, seq_of_params, statement)
+
+    def _execute(self, method, query, params, statement):
+        """Calls the cursor's 'method' (execute or executemany)."""
         if self._cursor:
             ret = None
+            cached = statement is not None and self._statement_cache_size
+            if cached:
+                cursor = self._statement_cursor(statement)
+            else:
+                cursor = self._cursor
             try:
                 try:
-                    ret = self._cursor.execute(query, params)
+                    ret = getattr(cursor, method)(query, params)
                 except InternalError:
-                    self._cursor = self._conn.cursor()
-                    ret = self._cursor.execute(query, params)
+                    cursor = self._conn.cursor()
+                    if cached:
+                        self._statements[statement] = cursor
+                    else:
+                        self._cursor = cursor
+                    ret = getattr(cursor, method)(query, params)
             except Exception, e:
-                self._conn.rollback()
+                if not self._transaction_depth:
+                    self._conn.rollback()
                 raise e
             else:
-                self._conn.commit()
+                if not self._transaction_depth:
+                    self._conn.commit()
             return ret
 
+    @contextmanager
+    def transaction(self):
+        """Context manager running all queries executed within it in a single
+        transaction, committed on exit, or rolled back if an exception is
+        raised. Transactions can be nested, using savepoints. Query hooks
+        for the queries run within it are called once the outermost
+        transaction commits, and not at all if theirs is rolled back.
+        """
+        if not self._cursor:
+            yield self
+            return
+        depth = self._transaction_depth
+        # sqlite3 begins transactions implicitly (unless in autocommit mode),
+        # and commits them before statements such as SAVEPOINT. While in a
+        # transaction, we turn that off (setting isolation_level to None)
+        # and begin it ourselves.
+        if depth == 0 and self._explicit_begin is None:
+            self._explicit_begin = (getattr(self._driver, '__name__', None)
+                                    in explicit_begin_drivers)
+        explicit_begin = depth == 0 and self._explicit_begin
+        if explicit_begin:
+            isolation_level = self._conn.isolation_level
+            self._conn.isolation_level = None
+            self._cursor.execute('begin')
+        elif depth > 0:
+            self._cursor.execute('savepoint tx{0}'.format(depth))
+        self._transaction_depth += 1
+        hooks_before = len(self._pending_hooks)
+        try:
+            try:
+                yield self
+            except:
+                del self._pending_hooks[hooks_before:]
+                if depth > 0:
+                    self._cursor.execute('rollback to savepoint tx{0}'.
+                                         format(depth))
+                    self._cursor.execute('release savepoint tx{0}'.
+                                         format(depth))
+                else:
+                    self._conn.rollback()
+                raise
+            if depth > 0:
+                self._cursor.execute('release savepoint tx{0}'.format(depth))
+            else:
+                self._conn.commit()
+        finally:
+            self._transaction_depth = depth
+            if depth == 0:
+                hooks, self._pending_hooks = self._pending_hooks, []
+                if explicit_begin:
+                    self._conn.isolation_level = isolation_level
+        if depth == 0:
+            for hook, params in hooks:
+                hook(*params)
+
+    def _run_hooks(self, name, rows):
+        """Calls the query hooks for the named query with each tuple of
+        parameters in rows, or, within a transaction, queues them to be
+        called when it commits.
+        """
+        calls = [(hook, params) for params in rows
+                 for hook in query_hooks[name]]
+        if self._transaction_depth:
+            self._pending_hooks.extend(calls)
+        else:
+            for hook, params in calls:
+                hook(*params)
+
     @property
     def paramstyle(self):
         return getattr(self._driver, 'paramstyle', 'qmark')
@@ -130,24 +509,320 @@ class Connection(object):
         Returns results as specified by the appropriate Query object.
         """
         query_obj = queries[name]
-        
-        q, p = query_obj.query(*params, paramstyle=self.paramstyle)
-        results = self.execute(q, p)
+        q, binder = query_obj.compile(self.paramstyle)
+        results = self.execute(q, binder(params), name)
+        if name in query_hooks:
+            self._run_hooks(name, [params])
+        if results is None:
+            return None
+        return query_obj._shape(results)
+
+    def _execute_query_many(self, name, rows):
+        """Executes the named query once for each tuple of parameters in
+        rows, with a single executemany. Returns the number of rows
+        affected, for 'rowcount' queries, and None otherwise.
+        """
+        query_obj = queries[name]
+        if query_obj._return_type not in (None, 'rowcount'):
+            raise UnsupportedQueryReturnType(
+                'Queries returning {0} cannot be run in batch'.
+                format(query_obj._return_type))
+
+        q, binder = query_obj.compile(self.paramstyle)
+        rows = [tuple(row) for row in rows]
+        if not rows:
+            return 0 if query_obj._return_type == 'rowcount' else None
+        results = self.executemany(q, [binder(row) for row in rows], name)
+        if name in query_hooks:
+            self._run_hooks(name, rows)
         if query_obj._return_type is None or results is None:
             return None
-        rows = results.fetchall()
+        return results.rowcount
 
-        if query_obj._return_type == 'rows':
-            return rows
-        if query_obj._return_type == 'one row':
-            return rows[0] if rows else None
-        if query_obj._return_type == 'one column':
-            return [r[0] for r in rows]
-        if query_obj._return_type == 'unique':
-            return rows[0][0] if rows and rows[0] else None
+    def _measured(self, name, start, rows, error, params, redactor):
+        elapsed = time.time() - start
+        if self._query_stats is not None:
+            self._query_stats.record(name, elapsed, rows, error)
+        if (self._slow_query_time is not None and
+            elapsed >= self._slow_query_time):
+            self._slow_query_sink(name, elapsed, redactor(params))
 
-        raise UnsupportedQueryReturnType('Unsupported return type: {0}'.
-                                         format(query_obj._return_type))
+    def _measured_query(self, name, *params):
+        """_execute_query, measured."""
+        start = time.time()
+        try:
+            result = Connection._execute_query(self, name, *params)
+        except Exception:
+            exc_info = sys.exc_info()
+            self._measured(name, start, 0, True, params, redact)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._measured(name, start,
+                       _row_count(queries[name]._return_type, result),
+                       False, params, redact)
+        return result
+
+    def _measured_query_many(self, name, rows):
+        """_execute_query_many, measured (rows affected being counted as
+        the query's rows, for 'rowcount' queries).
+        """
+        rows = list(rows)
+        start = time.time()
+        try:
+            result = Connection._execute_query_many(self, name, rows)
+        except Exception:
+            exc_info = sys.exc_info()
+            self._measured(name, start, 0, True, rows, _redact_batch)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._measured(name, start, result, False, rows, _redact_batch)
+        return result
+
+    def _execute_query_stream(self, name, *params):
+        """Generator executing the named query with the passed parameters
+        on a cursor of its own, and yielding its results (as rows, or as
+        values for 'one column' queries), fetched self._stream_arraysize at
+        a time.
+        """
+        query_obj = queries[name]
+        if query_obj._return_type not in ('rows', 'one column'):
+            raise UnsupportedQueryReturnType(
+                'Queries returning {0} cannot be streamed'.
+                format(query_obj._return_type))
+        one_column = query_obj._return_type == 'one column'
+
+        q, binder = query_obj.compile(self.paramstyle)
+        cursor = self._conn.cursor()
+        cursor.arraysize = self._stream_arraysize
+        try:
+            cursor.execute(q, binder(params))
+            if name in query_hooks:
+                self._run_hooks(name, [params])
+            while True:
+                rows = cursor.fetchmany()
+                if not rows:
+                    break
+                if one_column:
+                    for row in rows:
+                        yield row[0]
+                else:
+                    for row in rows:
+                        yield row
+        finally:
+            cursor.close()
+
+
+class BatchQueries(object):
+    """The named queries of a db.Connection, in batch form:
+    conn.many.<name>(rows) executes the query called name once for each
+    tuple of parameters in rows (each as they would be passed to
+    conn.<name>), with a single call to the cursor's executemany.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if name in queries:
+            def call_query(rows):
+                return self._conn._execute_query_many(name, rows)
+            return call_query
+        else:
+            raise AttributeError("'{0}' object has no attribute '{1}'".
+                                 format(self.__class__, name))
+
+
+class StreamingQueries(object):
+    """The named queries of a db.Connection returning rows (or a column),
+    in streaming form: conn.stream.<name>(*params) returns a generator of
+    the query's results, fetched a few at a time, instead of a list of all
+    of them, so that large results don't have to fit in memory.
+
+    The query runs on a cursor of its own, which is closed once the
+    results are exhausted (or the generator is closed). It isn't
+    committed, and some drivers (sqlite3 amongst them) abandon results
+    when the connection commits or rolls back, so other queries should
+    only be run while streaming within a transaction.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if name in queries:
+            def call_query(*args):
+                return self._conn._execute_query_stream(name, *args)
+            return call_query
+        else:
+            raise AttributeError("'{0}' object has no attribute '{1}'".
+                                 format(self.__class__, name))
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of connected db.Connection objects.
+    Positional and keyword arguments (including 'driver') are passed on
+    to each db.Connection. Pool behaviour is set by the keyword arguments:
+
+    min_size: connections kept open, even when idle
+    max_size: connections kept by the pool
+    max_overflow: extra connections opened when all others are in use,
+        closed as soon as they are checked in
+    idle_timeout: seconds after which idle connections above min_size
+        are closed (None for never)
+    wait_timeout: seconds to wait for a free connection before raising
+        PoolTimeoutError (None to wait forever)
+    pre_ping: whether to check that an idle connection is still alive
+        before handing it out, replacing it otherwise
+    """
+    wait_time_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+    def __init__(self, *args, **kwargs):
+        self._min_size = kwargs.pop('min_size', 1)
+        self._max_size = kwargs.pop('max_size', 5)
+        self._max_overflow = kwargs.pop('max_overflow', 0)
+        self._idle_timeout = kwargs.pop('idle_timeout', None)
+        self._wait_timeout = kwargs.pop('wait_timeout', None)
+        self._pre_ping = kwargs.pop('pre_ping', False)
+        self._conn_args = args
+        self._conn_kwargs = kwargs
+        self._lock = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_times = [0] * (len(self.wait_time_buckets) + 1)
+        for i in xrange(self._min_size):
+            self._idle.append((time.time(), self._new_connection()))
+            self._size += 1
+
+    def _new_connection(self):
+        conn = Connection(*self._conn_args, **self._conn_kwargs)
+        conn.connect()
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _expire_idle(self, now):
+        """Closes connections idle for longer than idle_timeout, oldest
+        first, while more than min_size are open. Called with the lock held.
+        """
+        while (self._idle_timeout is not None and self._idle and
+               self._size > self._min_size and
+               now - self._idle[0][0] > self._idle_timeout):
+            self._discard(self._idle.pop(0)[1])
+            self._size -= 1
+
+    def _record_wait(self, waited):
+        for i, limit in enumerate(self.wait_time_buckets):
+            if waited <= limit:
+                break
+        else:
+            i = len(self.wait_time_buckets)
+        self._wait_times[i] += 1
+
+    def checkout(self):
+        """Returns a connection from the pool, opening a new one if needed
+        and allowed. Every connection checked out must be checked back in.
+        """
+        start = time.time()
+        waited = False
+        conn = None
+        with self._lock:
+            while True:
+                self._expire_idle(time.time())
+                if self._idle:
+                    conn = self._idle.pop()[1]
+                    break
+                if self._size < self._max_size + self._max_overflow:
+                    self._size += 1
+                    break
+                if not waited:
+                    waited = True
+                    self._waits += 1
+                if self._wait_timeout is None:
+                    self._lock.wait()
+                    continue
+                remaining = start + self._wait_timeout - time.time()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError(
+                        'No connection available after {0} seconds'.format(
+                            self._wait_timeout))
+                self._lock.wait(remaining)
+            self._checkouts += 1
+            if waited:
+                self._record_wait(time.time() - start)
+
+        try:
+            if conn is not None and self._pre_ping and not conn.ping():
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._new_connection()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+        return conn
+
+    def checkin(self, conn):
+        """Returns a connection to the pool."""
+        with self._lock:
+            if self._size > self._max_size:
+                self._discard(conn)
+                self._size -= 1
+            else:
+                self._idle.append((time.time(), conn))
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager checking out a connection, and checking it back
+        in on exit.
+        """
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            for last_used, conn in self._idle:
+                self._discard(conn)
+            self._size -= len(self._idle)
+            self._idle = []
+
+    def stats(self):
+        """Returns a snapshot of this pool's metrics. 'wait_times' maps
+        the upper bound of each bucket (in seconds, None for unbounded)
+        to the number of checkouts that waited for that long.
+        """
+        with self._lock:
+            return {'size': self._size,
+                    'idle': len(self._idle),
+                    'in_use': self._size - len(self._idle),
+                    'checkouts': self._checkouts,
+                    'waits': self._waits,
+                    'timeouts': self._timeouts,
+                    'wait_times': dict(zip(self.wait_time_buckets + [None],
+                                           self._wait_times))}
+
+
+@contextmanager
+def borrow(conn):
+    """Context manager giving a db.Connection to work with: conn itself,
+    or, if conn is a ConnectionPool, a connection borrowed from it for
+    the duration of the block.
+    """
+    if isinstance(conn, ConnectionPool):
+        with conn.connection() as pooled:
+            yield pooled
+    else:
+        yield conn
 
 
 queries = dict((q._name, q) for q in(
@@ -163,6 +838,21 @@ queries = dict((q._name, q) for q in(
     Query('get_pending_users_unmailed', 'rows',
           """select email, registration_key from pending_users
              where confirmation_sent = 0"""),
+    Query('get_pending_users_unmailed_after', 'rows',
+          """select email, registration_key from pending_users
+             where confirmation_sent = 0 and email > ?
+             order by email limit ?"""),
+    Query('claim_pending_users_unmailed', 'rowcount',
+          """update pending_users set claimed_by = ?, claimed_at = ?
+             where email in (select email from pending_users
+                             where confirmation_sent = 0 and
+                             (claimed_by is null or claimed_at < ?)
+                             limit ?)
+             and (claimed_by is null or claimed_at < ?)""",
+          param_order=[0, 1, 2, 3, 2]),
+    Query('get_pending_users_claimed_by', 'rows',
+          """select email, registration_key from pending_users
+             where claimed_by = ? and confirmation_sent = 0"""),
     Query('set_pending_user_as_mailed', None,
           """update pending_users
              set confirmation_sent = 1 where email = ?"""),
@@ -172,11 +862,25 @@ queries = dict((q._name, q) for q in(
     Query('get_pending_users_registered_before', 'one column',
           """select email from pending_users
              where registration_date < ?"""),
+    Query('get_a_pending_user_registered_before', 'one row',
+          """select email from pending_users
+             where registration_date < ? limit 1"""),
+    Query('delete_pending_users_registered_before', 'rowcount',
+          "delete from pending_users where registration_date < ?"),
+    Query('delete_some_pending_users_registered_before', 'rowcount',
+          """delete from pending_users where email in
+             (select email from pending_users
+              where registration_date < ? limit ?)"""),
     Query('save_user', None,
           "insert into users (email, password) values (?, ?)"),
+    Query('save_user_with_role', None,
+          "insert into users (email, password, role) values (?, ?, ?)"),
     Query('get_user', 'one row',
           """select email, password, failed_login_attempts, suspended_until
              from users where email = ?"""),
+    Query('set_user_password', None,
+          "update users set password = ? where email = ?",
+          param_order=[1, 0]),
     Query('suspend_user', None,
           """update users
              set failed_login_attempts = ?, suspended_until = ?
@@ -195,5 +899,49 @@ queries = dict((q._name, q) for q in(
           "update users set role = ? where email = ?",
           param_order=[1, 0]),
     Query('get_user_role', 'unique',
-          "select role from users where email = ?")
+          "select role from users where email = ?"),
+    Query('get_user_access', 'one row',
+          "select email, role from users where email = ?"),
+    Query('add_user_role', None,
+          "insert into user_roles (email, role) values (?, ?)"),
+    Query('remove_user_role', None,
+          "delete from user_roles where email = ? and role = ?"),
+    Query('get_user_roles', 'one column',
+          "select role from user_roles where email = ?"),
+    Query('get_schema_version', 'unique',
+          "select version from schema_version"),
+    Query('set_schema_version', None,
+          "update schema_version set version = ?"),
+    Query('get_user_role_set', 'rows',
+          """select users.email, users.role, user_roles.role
+             from users left join user_roles
+             on user_roles.email = users.email
+             where users.email = ?""")
 ))
+
+
+def _query_method(name):
+    """Returns a method of db.Connection executing the query called name."""
+    def query_method(self, *params):
+        return self._execute_query(name, *params)
+    query_method.__name__ = name
+    query_method.__doc__ = 'Executes the {0} query.'.format(name)
+    return query_method
+
+for name in queries:
+    setattr(Connection, name, _query_method(name))
+del name
+
+
+# Functions called, with the query parameters, after each execution of the
+# query they are registered for (by add_query_hook)
+query_hooks = {}
+
+def add_query_hook(name, hook):
+    """Registers hook to be called as hook(*params) after the query called
+    name is executed with params, on any db.Connection (after the
+    transaction commits, if it's run within one).
+    """
+    if name not in queries:
+        raise KeyError(name)
+    query_hooks.setdefault(name, []).append(hook)
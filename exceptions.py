@@ -29,9 +29,15 @@ class InvalidRegistrationKeyError(Exception):
 class AuthenticationError(Exception):
     pass
 
+class InvalidTokenError(AuthenticationError):
+    pass
+
 class UnauthorizedAccessError(Exception):
     pass
 
+class HashingQueueFullError(Exception):
+    pass
+
 class Error(builtin_exceptions.StandardError):
     pass
 
@@ -44,6 +50,12 @@ class ProgrammingError(DatabaseError):
 class InternalError(DatabaseError):
     pass
 
+class OperationalError(DatabaseError):
+    pass
+
+class PoolTimeoutError(OperationalError):
+    pass
+
 class UserAlreadyActiveError(DatabaseError):
     pass
 
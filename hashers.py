@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+"""
+Password hashers.
+
+Passwords are stored encoded as "algorithm$cost$salt$hash", salt and hash
+being base64 encoded, so that each of them can be verified with the
+algorithm and cost it was hashed with, even after options.password_hasher
+or the cost options change. Passwords hashed by users.mkhash (before
+there were hashers) don't follow this format, and are verified by the
+users module.
+
+Run as a script to calibrate the cost of each hasher for this host.
+
+
+rbp@isnomore.net
+"""
+
+
+import os
+import sys
+import time
+import hmac
+import base64
+import pickle
+import hashlib
+import threading
+import multiprocessing
+from multiprocessing.pool import MaybeEncodingError
+
+from . config import options
+from . exceptions import HashingQueueFullError
+
+
+class PBKDF2Hasher(object):
+    """PBKDF2-HMAC-SHA256, whose cost is its number of iterations
+    (defaulting to options.pbkdf2_iterations).
+    """
+    algorithm = 'pbkdf2_sha256'
+    salt_len = 16
+    min_cost = 1000
+
+    def __init__(self, cost=None):
+        if cost is None:
+            cost = options.pbkdf2_iterations
+        self.cost = cost
+
+    def params(self):
+        """Parameters (comparable, higher meaning stronger) with which
+        this hasher hashes new passwords.
+        """
+        return self.cost
+
+    def digest(self, password, salt, params):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, params)
+
+    def parse_params(self, params):
+        return int(params)
+
+    def format_params(self, params):
+        return str(params)
+
+    @classmethod
+    def scale_cost(cls, cost, factor):
+        """Returns a cost that would take about factor times as long."""
+        return max(cls.min_cost, int(cost * factor))
+
+    def encode(self, password, salt=None):
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        if salt is None:
+            salt = os.urandom(self.salt_len)
+        params = self.params()
+        digest = self.digest(password, salt, params)
+        return '$'.join([self.algorithm, self.format_params(params),
+                         base64.b64encode(salt), base64.b64encode(digest)])
+
+    def split(self, encoded):
+        """Returns the parameters, salt and digest of an encoded password."""
+        algorithm, params, salt, digest = encoded.split('$')
+        return (self.parse_params(params), base64.b64decode(salt),
+                base64.b64decode(digest))
+
+    def verify(self, password, encoded):
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        params, salt, digest = self.split(encoded)
+        return hmac.compare_digest(self.digest(password, salt, params), digest)
+
+    def needs_rehash(self, encoded):
+        return self.split(encoded)[0] < self.params()
+
+
+class ScryptHasher(PBKDF2Hasher):
+    """scrypt, whose cost is its CPU/memory cost parameter n (a power of
+    two, defaulting to options.scrypt_cost), with block size r and
+    parallelisation p. Only available where hashlib has scrypt.
+    """
+    algorithm = 'scrypt'
+    min_cost = 2 ** 10
+
+    def __init__(self, cost=None, r=8, p=1):
+        if cost is None:
+            cost = options.scrypt_cost
+        self.cost = cost
+        self.r = r
+        self.p = p
+
+    def params(self):
+        return (self.cost, self.r, self.p)
+
+    def digest(self, password, salt, params):
+        n, r, p = params
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * r * (n + p + 2), dklen=32)
+
+    def parse_params(self, params):
+        return tuple(int(param) for param in params.split(':'))
+
+    def format_params(self, params):
+        return ':'.join(str(param) for param in params)
+
+    @classmethod
+    def scale_cost(cls, cost, factor):
+        n = cls.min_cost
+        while n * 2 <= cost * factor:
+            n *= 2
+        return n
+
+
+hashers = {PBKDF2Hasher.algorithm: PBKDF2Hasher}
+if hasattr(hashlib, 'scrypt'):
+    hashers[ScryptHasher.algorithm] = ScryptHasher
+
+
+def identify(encoded):
+    """Returns the hasher for an encoded password, or None for passwords
+    not hashed by a hasher (such as those hashed by users.mkhash).
+    """
+    algorithm = encoded.split('$', 1)[0]
+    if algorithm == encoded or algorithm not in hashers:
+        return None
+    return hashers[algorithm]()
+
+
+def default_hasher():
+    """Returns the hasher set by options.password_hasher."""
+    return hashers[options.password_hasher]()
+
+
+def make_password(password):
+    """Hashes password with the default hasher, returning it encoded."""
+    return default_hasher().encode(password)
+
+
+def verify_password(password, encoded):
+    hasher = identify(encoded)
+    if hasher is None:
+        raise ValueError('Unknown password hash format')
+    return hasher.verify(password, encoded)
+
+
+def needs_rehash(encoded):
+    """Whether an encoded password should be hashed again, because it
+    wasn't hashed by the default hasher, or was hashed with a lower cost.
+    """
+    hasher = identify(encoded)
+    if hasher is None or hasher.algorithm != options.password_hasher:
+        return True
+    return hasher.needs_rehash(encoded)
+
+
+def _call(func, args):
+    """Runs func(*args) on a HashingExecutor's process, returning whether
+    it succeeded, and its result or exception. What it returns can always
+    be sent back, so that the pool always calls the executor back (Python
+    2's pools only do for tasks that succeed).
+    """
+    try:
+        outcome = True, func(*args)
+    except Exception, e:
+        outcome = False, e
+    try:
+        pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        outcome = False, MaybeEncodingError(e, outcome[1])
+    return outcome
+
+
+class HashingResult(object):
+    """The pending result of a function submitted to a HashingExecutor."""
+    def __init__(self, result):
+        self._result = result
+
+    def ready(self):
+        return self._result.ready()
+
+    def get(self, timeout=None):
+        """Waits for the result (at most timeout seconds, if given), and
+        returns it, or raises the function's exception.
+        """
+        if timeout is None:
+            # Waiting with no timeout at all can't be interrupted
+            while not self._result.ready():
+                self._result.wait(1)
+        succeeded, value = self._result.get(timeout)
+        if not succeeded:
+            raise value
+        return value
+
+
+class HashingExecutor(object):
+    """Runs password hashing on a pool of 'processes' processes (defaulting
+    to options.hashing_processes, or one per CPU if that's None), so that
+    it isn't bound to one core by the GIL. Hashers read their cost in the
+    worker processes, which only see options as they were when the
+    executor was created.
+
+    At most max_pending hashes (defaulting to four per process) are queued
+    or running at once. Submitting more waits for one to finish, for at
+    most options.hashing_queue_timeout seconds (None to wait forever),
+    after which HashingQueueFullError is raised.
+    """
+    def __init__(self, processes=None, max_pending=None):
+        if processes is None:
+            processes = options.hashing_processes
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if max_pending is None:
+            max_pending = 4 * processes
+        self.processes = processes
+        self._pool = multiprocessing.Pool(processes)
+        self._max_pending = max_pending
+        self._pending = 0
+        self._lock = threading.Condition()
+
+    def _done(self, outcome):
+        with self._lock:
+            self._pending -= 1
+            self._lock.notify()
+
+    def submit(self, func, *args):
+        """Submits func(*args) (func being a module-level function) to run
+        on the pool, returning a HashingResult.
+        """
+        timeout = options.hashing_queue_timeout
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._pending >= self._max_pending:
+                if deadline is None:
+                    self._lock.wait(1)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise HashingQueueFullError(
+                        'Too many pending hashes ({0})'.format(self._pending))
+                self._lock.wait(remaining)
+            self._pending += 1
+        try:
+            # Arguments that can't be pickled would only fail on the pool's
+            # own thread, which doesn't call back either
+            pickle.dumps((func, args), pickle.HIGHEST_PROTOCOL)
+            result = self._pool.apply_async(_call, (func, args),
+                                            callback=self._done)
+        except:
+            self._done(None)
+            raise
+        return HashingResult(result)
+
+    def make_password(self, password):
+        return self.submit(make_password, password).get()
+
+    def verify_password(self, password, encoded):
+        return self.submit(verify_password, password, encoded).get()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+def calibrate(hasher_class, target=None):
+    """Returns the cost for which hasher_class takes about 'target'
+    seconds (defaulting to options.password_hash_target) to hash a
+    password on this host, along with the time it took.
+    """
+    if target is None:
+        target = options.password_hash_target
+    cost = hasher_class.min_cost
+    while True:
+        hasher = hasher_class(cost)
+        start = time.time()
+        hasher.encode('calibration password')
+        elapsed = time.time() - start
+        if elapsed >= target / 2:
+            break
+        cost = hasher_class.scale_cost(cost, 2)
+    cost = hasher_class.scale_cost(cost, target / elapsed)
+    hasher = hasher_class(cost)
+    start = time.time()
+    hasher.encode('calibration password')
+    return cost, time.time() - start
+
+
+if __name__ == '__main__':
+    target = float(sys.argv[1]) / 1000 if sys.argv[1:] else None
+    for algorithm in sorted(hashers):
+        cost, elapsed = calibrate(hashers[algorithm], target)
+        print "{0}: cost {1} ({2:.0f} ms)".format(algorithm, cost,
+                                                 elapsed * 1000)
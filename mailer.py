@@ -11,24 +11,176 @@ rbp@isnomore.net
 """
 
 
+import os
+import sys
+import time
+import socket
+import string
 import smtplib
+import threading
+from Queue import Queue
+from smtplib import SMTPServerDisconnected
 from email.message import Message
-from . db import Connection
+from . db import Connection, borrow
 from . config import options
 
 
+class MessageTemplate(object):
+    """A registration confirmation message template. The template file is
+    read and parsed once (and read again only if its modification time
+    changes), and the From and Subject headers are rendered once as well,
+    so that only the To header and the registration key vary per message.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._mtime = None
+        self._body = None
+        self._literals = None
+        self._header_values = None
+
+    def refresh(self):
+        """Reads and parses the template file again, if it has changed."""
+        mtime = os.stat(self._path).st_mtime
+        if mtime == self._mtime:
+            return
+        body = open(self._path).read()
+        literals = ['']
+        for literal, field, spec, conversion in \
+                string.Formatter().parse(body):
+            literals[-1] += literal
+            if field is None:
+                continue
+            if field != 'registration_key' or spec or conversion:
+                literals = None
+                break
+            literals.append('')
+        self._body = body
+        self._literals = literals
+        self._mtime = mtime
+
+    def _refresh_headers(self):
+        """Renders the From and Subject headers, if their options have
+        changed since they were last rendered.
+        """
+        values = (options.reg_confirmation_from,
+                  options.reg_confirmation_from_addr,
+                  options.reg_confirmation_subject)
+        if values == self._header_values:
+            return
+        self._from = '{0} <{1}>'.format(*values[:2])
+        self._subject = values[2]
+        rendered = []
+        for name, value in [('From', self._from), ('Subject', self._subject)]:
+            msg = Message()
+            msg[name] = value
+            rendered.append(msg.as_string()[:-1])
+        self._from_line, self._subject_line = rendered
+        self._header_values = values
+
+    def payload(self, key):
+        if self._literals is None:
+            return self._body.format(registration_key=key)
+        return key.join(self._literals)
+
+    def message(self, email, key):
+        """Returns the message for email and key, as a Message object."""
+        self._refresh_headers()
+        msg = Message()
+        msg['From'] = self._from
+        msg['To'] = email
+        msg['Subject'] = self._subject
+        msg.set_payload(self.payload(key))
+        return msg
+
+    def as_string(self, email, key):
+        """Returns the message for email and key, flattened, just as
+        self.message(email, key).as_string() would.
+        """
+        try:
+            # Python 2's sqlite3 returns unicode; non-ASCII addresses are
+            # left to the email module, which encodes them (RFC 2047)
+            email = email.encode('ascii')
+            key = key.encode('ascii')
+        except UnicodeError:
+            return self.message(email, key).as_string()
+        self._refresh_headers()
+        payload = self.payload(key)
+        to_line = 'To: ' + email
+        if (len(to_line) > 76 or email.split() != [email] or
+            payload.startswith('From ') or '\nFrom ' in payload):
+            # Folded headers or mangled payloads: leave it to the email module
+            return self.message(email, key).as_string()
+        return ''.join([self._from_line, to_line, '\n',
+                        self._subject_line, '\n', payload])
+
+
+_templates = {}
+
+def confirmation_template():
+    """Returns the MessageTemplate for options.reg_confirmation_template,
+    loaded only once (unless the template file changes).
+    """
+    path = options.reg_confirmation_template
+    try:
+        template = _templates[path]
+    except KeyError:
+        template = _templates[path] = MessageTemplate(path)
+    template.refresh()
+    return template
+
+
 def create_message(email, key):
-    msg = Message()
-    msg['From'] = '{0} <{1}>'.format(options.reg_confirmation_from,
-                                     options.reg_confirmation_from_addr)
-    msg['To'] = email
-    msg['Subject'] = options.reg_confirmation_subject
-    body = open(options.reg_confirmation_template).read()
-    msg.set_payload(body.format(registration_key=key))
-    return msg
+    return confirmation_template().message(email, key)
+
+
+class SMTPSession(object):
+    """A connection to the SMTP server, reused to send several messages.
+    It's opened when the first message is sent, opened again if the server
+    disconnects, and renewed after max_messages messages (which defaults
+    to options.smtp_messages_per_session; None or 0 for no limit).
+    """
+    def __init__(self, server=None, max_messages=None):
+        if server is None:
+            server = options.smtp_server
+        if max_messages is None:
+            max_messages = options.smtp_messages_per_session
+        self._server = server
+        self._max_messages = max_messages
+        self._smtp = None
+        self._sent = 0
 
+    def _connect(self):
+        self._smtp = smtplib.SMTP(self._server)
+        self._sent = 0
 
-def mail_confirmation(email, msg):
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self._max_messages and self._sent >= self._max_messages:
+            self.quit()
+        if self._smtp is None:
+            self._connect()
+        try:
+            self._smtp.sendmail(from_addr, to_addrs, msg)
+        except SMTPServerDisconnected:
+            self._connect()
+            self._smtp.sendmail(from_addr, to_addrs, msg)
+        self._sent += 1
+
+    def quit(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except SMTPServerDisconnected:
+                pass
+        self._smtp = None
+
+
+def mail_confirmation(email, msg, session=None):
+    """Sends msg to email, through an SMTPSession if one is given, or
+    through a new connection to the SMTP server otherwise.
+    """
+    if session is not None:
+        session.sendmail(options.reg_confirmation_from_addr, email, msg)
+        return
     server = smtplib.SMTP(options.smtp_server)
     server.sendmail(options.reg_confirmation_from_addr,
                     email,
@@ -36,24 +188,152 @@ def mail_confirmation(email, msg):
     server.quit()
 
 
-def send_pending_confirmations():
-    db_conn = Connection(options.db_params, driver=options.db_driver)
-    db_conn.connect()
+def send_pending_confirmations(conn=None):
+    """Mails every unmailed pending user, options.mailer_batch_size at a
+    time, in email order. The users mailed in each batch are marked as
+    such in a transaction of their own, so that a run that dies only
+    leaves the current batch to be mailed again, and the database isn't
+    locked while messages are being sent.
+
+    Returns a dictionary whose 'failed' key points to a list of tuples
+    (email, exception args).
+    """
+    if conn is None:
+        conn = Connection(options.db_params, driver=options.db_driver)
+        conn.connect()
     results = {'failed': []}
-    pending = db_conn.get_pending_users_unmailed()
-    for email, key in pending:
-        msg = create_message(email, key)
-        try:
-            mail_confirmation(email, msg.as_string())
-        except Exception, e:
-            results['failed'].append((email, e.args))
-        else:
-            db_conn.set_pending_user_as_mailed(email)
+    session = SMTPSession()
+    template = confirmation_template()
+    try:
+        with borrow(conn) as db_conn:
+            last_email = ''
+            while True:
+                pending = db_conn.get_pending_users_unmailed_after(
+                    last_email, options.mailer_batch_size)
+                if not pending:
+                    break
+                mailed = []
+                for email, key in pending:
+                    msg = template.as_string(email, key)
+                    try:
+                        mail_confirmation(email, msg, session)
+                    except Exception, e:
+                        results['failed'].append((email, e.args))
+                    else:
+                        mailed.append((email,))
+                if mailed:
+                    with db_conn.transaction():
+                        db_conn.many.set_pending_user_as_mailed(mailed)
+                last_email = pending[-1][0]
+    finally:
+        session.quit()
+    return results
+
+
+def _mailing_thread(tasks, done):
+    """Sends a confirmation message for each (email, registration key,
+    MessageTemplate) taken from the tasks queue, until it gets None,
+    through its own SMTPSession. Puts (email, exception or None) on the
+    done queue.
+    """
+    session = SMTPSession()
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            email, key, template = task
+            try:
+                msg = template.as_string(email, key)
+                mail_confirmation(email, msg, session)
+            except Exception, e:
+                done.put((email, e))
+            else:
+                done.put((email, None))
+    finally:
+        session.quit()
+
+
+def send_claimed_confirmations(conn=None, worker_id=None, threads=None,
+                               batch_size=None):
+    """Worker mode of send_pending_confirmations, so that several mailers
+    can run at the same time. It repeatedly claims a batch of up to
+    batch_size (defaulting to options.mailer_batch_size) unmailed pending
+    users on the database, marking them with a claim unique to this
+    worker, and mails them using 'threads' (defaulting to
+    options.mailer_threads) concurrent threads, until there are no
+    pending users left to claim.
+
+    Users whose message could not be sent remain claimed, and can be
+    claimed again after options.mailer_claim_timeout seconds (as can
+    those claimed by a worker that died before mailing them).
+
+    Returns a dictionary whose 'failed' key points to a list of tuples
+    (email, exception args), as send_pending_confirmations, and whose
+    'sent' key holds the number of messages sent.
+    """
+    if conn is None:
+        conn = Connection(options.db_params, driver=options.db_driver)
+        conn.connect()
+    if worker_id is None:
+        worker_id = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    if threads is None:
+        threads = options.mailer_threads
+    if batch_size is None:
+        batch_size = options.mailer_batch_size
+    results = {'failed': [], 'sent': 0}
+    tasks, done = Queue(), Queue()
+    mailers = [threading.Thread(target=_mailing_thread, args=(tasks, done))
+               for i in xrange(threads)]
+    for thread in mailers:
+        thread.start()
+    try:
+        with borrow(conn) as db_conn:
+            batch = 0
+            while True:
+                batch += 1
+                claim = '{0}:{1}'.format(worker_id, batch)
+                now = int(time.time())
+                with db_conn.transaction():
+                    claimed = db_conn.claim_pending_users_unmailed(
+                        claim, now, now - options.mailer_claim_timeout,
+                        batch_size)
+                if not claimed:
+                    break
+                pending = db_conn.get_pending_users_claimed_by(claim)
+                if not pending:
+                    # Drivers may not know how many rows were claimed
+                    # (rowcount being -1)
+                    break
+                # Loaded (or reloaded) here, rather than by the mailing
+                # threads, so that they never see it being refreshed
+                template = confirmation_template()
+                for email, key in pending:
+                    tasks.put((email, key, template))
+                mailed = []
+                for i in xrange(len(pending)):
+                    email, error = done.get()
+                    if error is None:
+                        mailed.append((email,))
+                    else:
+                        results['failed'].append((email, error.args))
+                if mailed:
+                    with db_conn.transaction():
+                        db_conn.many.set_pending_user_as_mailed(mailed)
+                    results['sent'] += len(mailed)
+    finally:
+        for thread in mailers:
+            tasks.put(None)
+        for thread in mailers:
+            thread.join()
     return results
 
 
 if __name__ == '__main__':
-    results = send_pending_confirmations()
+    if '--worker' in sys.argv[1:]:
+        results = send_claimed_confirmations()
+    else:
+        results = send_pending_confirmations()
     if results:
         print "Sending failed for:"
         print "\n".join(i[0] for i in results["failed"])
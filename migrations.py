@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+This script brings an existing database up to date with schema.sql.
+
+Each schema change is a migration, numbered by the schema version it
+leads to. A database's version is kept in the schema_version table;
+databases created before it existed are at version 1. New databases
+should simply be created from schema.sql, which is always at the latest
+version.
+
+
+rbp@isnomore.net
+"""
+
+
+from . db import Connection, borrow
+from . config import options
+
+
+migrations = []
+
+def migration(version):
+    """Decorator registering a function, called with a db.Connection
+    (within a transaction), as the migration to 'version'.
+    """
+    def register(func):
+        migrations.append((version, func))
+        migrations.sort()
+        return func
+    return register
+
+
+def supports_partial_indexes(conn):
+    """Whether the database behind conn supports "create index ... where"."""
+    name = getattr(conn._driver, '__name__', None)
+    if name in ('sqlite3', 'pysqlite2.dbapi2'):
+        return conn._driver.sqlite_version_info >= (3, 8, 0)
+    return name == 'psycopg2'
+
+
+@migration(2)
+def add_claims_roles_and_indexes(conn):
+    """Claims on pending users (for mailer.py workers), the user_roles
+    table, indexes for the hot lookups on pending_users, and a proper
+    unique index on registration keys.
+    """
+    conn.execute('create table schema_version (version integer not null)')
+    conn.execute('insert into schema_version (version) values (1)')
+    conn.execute('alter table pending_users add column claimed_by text')
+    conn.execute('alter table pending_users add column claimed_at integer')
+    conn.execute("""create table user_roles (
+                        email text not null references users (email),
+                        role text not null,
+                        primary key (email, role))""")
+    conn.execute("""create unique index pending_users_registration_key
+                    on pending_users (registration_key)""")
+    conn.execute("""create index pending_users_registration_date
+                    on pending_users (registration_date)""")
+    if supports_partial_indexes(conn):
+        conn.execute("""create index pending_users_unmailed
+                        on pending_users (email, registration_key)
+                        where confirmation_sent = 0""")
+        conn.execute("""create index pending_users_claimed_by
+                        on pending_users (claimed_by)
+                        where confirmation_sent = 0""")
+    else:
+        conn.execute("""create index pending_users_unmailed
+                        on pending_users (confirmation_sent)""")
+        conn.execute("""create index pending_users_claimed_by
+                        on pending_users (claimed_by)""")
+
+
+def schema_version(conn):
+    """Returns the schema version of the database behind conn."""
+    try:
+        return conn.get_schema_version()
+    except Exception:
+        # No schema_version table yet (the exception type is the driver's)
+        return 1
+
+
+def migrate(conn=None, target=None):
+    """Applies the migrations needed to bring the database up to version
+    'target' (defaulting to the latest), each in its own transaction.
+    Returns the versions migrated to.
+    """
+    if conn is None:
+        conn = Connection(options.db_params, driver=options.db_driver)
+        conn.connect()
+    applied = []
+    with borrow(conn) as conn:
+        version = schema_version(conn)
+        for to_version, func in migrations:
+            if to_version <= version:
+                continue
+            if target is not None and to_version > target:
+                break
+            with conn.transaction():
+                func(conn)
+                conn.set_schema_version(to_version)
+            applied.append(to_version)
+    return applied
+
+
+if __name__ == '__main__':
+    applied = migrate()
+    if applied:
+        print "Migrated to version {0}".format(applied[-1])
+    else:
+        print "Already up to date"
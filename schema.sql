@@ -1,11 +1,22 @@
 CREATE TABLE pending_users (
     email text PRIMARY KEY,
     password text NOT NULL,
-    registration_key text KEY UNIQUE,
+    registration_key text,
     registration_date integer,
-    confirmation_sent integer DEFAULT 0
+    confirmation_sent integer DEFAULT 0,
+    claimed_by text,
+    claimed_at integer
 );
 
+CREATE UNIQUE INDEX pending_users_registration_key
+    ON pending_users (registration_key);
+CREATE INDEX pending_users_registration_date
+    ON pending_users (registration_date);
+CREATE INDEX pending_users_unmailed
+    ON pending_users (email, registration_key) WHERE confirmation_sent = 0;
+CREATE INDEX pending_users_claimed_by
+    ON pending_users (claimed_by) WHERE confirmation_sent = 0;
+
 CREATE TABLE users (
     email text PRIMARY KEY,
     password text NOT NULL,
@@ -13,3 +24,14 @@ CREATE TABLE users (
     suspended_until integer,
     role text
 );
+
+CREATE TABLE user_roles (
+    email text NOT NULL REFERENCES users (email),
+    role text NOT NULL,
+    PRIMARY KEY (email, role)
+);
+
+CREATE TABLE schema_version (
+    version integer NOT NULL
+);
+INSERT INTO schema_version (version) VALUES (2);
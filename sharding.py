@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+"""
+Storage of users sharded across several databases.
+
+A ShardedConnection stands in for a db.Connection, routing each named
+query to one of its shards: by the email it's about (the first parameter
+of most queries), through a consistent hash ring, so that adding a shard
+only moves about 1/N of the users; by registration key, whose last eight
+hex digits are the ring point of the user's email (see
+users.registration_key); or, for the queries run by mailer.py and
+clear_pending_users.py over all pending users, to every shard in turn,
+combining their results.
+
+
+rbp@isnomore.net
+"""
+
+
+import sys
+import bisect
+import threading
+from hashlib import md5
+from itertools import chain
+from contextlib import contextmanager
+
+from . db import (borrow, queries, BatchQueries, StreamingQueries,
+                  _query_method)
+
+
+# Named queries routed by registration key, and run on every shard. All
+# others are routed by the email they're given as their first parameter
+key_queries = set(['get_pending_user_by_key'])
+fan_out_queries = set(['get_pending_users_unmailed',
+                       'get_pending_users_unmailed_after',
+                       'claim_pending_users_unmailed',
+                       'get_pending_users_claimed_by',
+                       'get_pending_users_registered_before',
+                       'get_a_pending_user_registered_before',
+                       'delete_pending_users_registered_before',
+                       'delete_some_pending_users_registered_before',
+                       'get_schema_version', 'set_schema_version'])
+
+# Fan-out queries returning the first rows in order, up to a limit (the
+# parameter at this index): their combined rows are sorted and cut again
+ordered_queries = {'get_pending_users_unmailed_after': 1}
+
+
+def point(value):
+    """The point (a 32-bit integer) of a string on a HashRing."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return int(md5(value).hexdigest()[:8], 16)
+
+
+def key_point(key):
+    """The ring point encoded in a registration key, or None if it
+    doesn't have one.
+    """
+    try:
+        return int(key[-8:], 16) if len(key) > 8 else None
+    except ValueError:
+        return None
+
+
+class HashRing(object):
+    """A consistent hash ring of 'names' (which should stay the same when
+    shards are added), each at 'replicas' points.
+    """
+    def __init__(self, names, replicas=100):
+        ring = sorted((point('{0}#{1}'.format(name, i)), shard)
+                      for shard, name in enumerate(names)
+                      for i in xrange(replicas))
+        self._points = [p for p, shard in ring]
+        self._shards = [shard for p, shard in ring]
+
+    def shard(self, value_point):
+        """Index of the shard (in names) owning value_point."""
+        i = bisect.bisect(self._points, value_point)
+        return self._shards[i % len(self._shards)]
+
+
+def _combine(return_type, results):
+    """Combines the results of a query run on every shard."""
+    if return_type in ('rows', 'one column'):
+        return list(chain.from_iterable(results))
+    if return_type == 'rowcount':
+        # Unknown (-1) on any shard is unknown altogether
+        if any(result < 0 for result in results):
+            return -1
+        return sum(results)
+    if return_type == 'unique':
+        # The schema version: shards are only as up to date as the oldest
+        return min(results)
+    if return_type == 'one row':
+        return next((row for row in results if row is not None), None)
+    return None
+
+
+class ShardedConnection(object):
+    """Routes named queries to shards, given as a list of (name,
+    db.Connection or db.ConnectionPool) tuples. Shard names place shards
+    on the hash ring, so they must stay the same (and in the same order)
+    for as long as the data is on them.
+
+    Queries can be called on it as on a db.Connection, including in batch
+    (many, grouping the rows by shard) and streaming (stream) forms.
+    """
+    def __init__(self, shards, replicas=100):
+        self.names = [name for name, conn in shards]
+        self._shards = [conn for name, conn in shards]
+        self._ring = HashRing(self.names, replicas)
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        if name in queries:
+            def call_query(*args):
+                return self._execute_query(name, *args)
+            return call_query
+        else:
+            raise AttributeError("'{0}' object has no attribute '{1}'".
+                                 format(self.__class__, name))
+
+    def shard(self, email):
+        """Index of the shard storing the user with this email."""
+        return self._ring.shard(point(email))
+
+    @property
+    def many(self):
+        return BatchQueries(self)
+
+    @property
+    def stream(self):
+        return StreamingQueries(self)
+
+    def close(self):
+        for conn in self._shards:
+            conn.close()
+
+    def _levels(self):
+        """This thread's open transactions, outermost first, each mapping
+        the shards used within it to the context managers to exit with it.
+        """
+        try:
+            return self._local.levels
+        except AttributeError:
+            self._local.levels = []
+            self._local.conns = {}
+            return self._local.levels
+
+    @contextmanager
+    def transaction(self):
+        """Context manager running the queries executed within it in a
+        transaction on each shard they go to, begun as the shard is first
+        used. Shards are committed (or rolled back) one after the other,
+        so it's only atomic for queries about a single user.
+        """
+        levels = self._levels()
+        levels.append({})
+        try:
+            yield self
+        except:
+            exc_info = sys.exc_info()
+            self._leave(levels.pop(), exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._leave(levels.pop(), (None, None, None))
+
+    def _leave(self, level, exc_info):
+        """Ends the level's transactions (and, for the outermost level,
+        gives back the connections), all of them even if some fail, raising
+        the first failure.
+        """
+        failure = None
+        for index, managers in level.iteritems():
+            for manager in managers:
+                try:
+                    manager.__exit__(*exc_info)
+                except Exception:
+                    if failure is None:
+                        failure = sys.exc_info()
+        if not self._local.levels:
+            self._local.conns.clear()
+        if failure is not None and exc_info[0] is None:
+            raise failure[0], failure[1], failure[2]
+
+    def _enter(self, index):
+        """Returns this thread's connection to the shard, borrowing it if
+        it isn't in use yet, after beginning a transaction on it for each
+        open level it hasn't been used within.
+        """
+        levels = self._local.levels
+        conn = self._local.conns.get(index)
+        borrowing = None
+        if conn is None:
+            borrowing = borrow(self._shards[index])
+            conn = borrowing.__enter__()
+            self._local.conns[index] = conn
+        for depth, level in enumerate(levels):
+            if index in level:
+                continue
+            transaction = conn.transaction()
+            transaction.__enter__()
+            level[index] = [transaction, borrowing] if depth == 0 \
+                           else [transaction]
+        return conn
+
+    def _connection(self, index):
+        """This thread's connection to the shard, within the innermost
+        open level.
+        """
+        if index in self._local.levels[-1]:
+            return self._local.conns[index]
+        return self._enter(index)
+
+    def _run(self, index, method, *args):
+        """Calls the method of a connection to the shard: the one in
+        this thread's transaction, or one borrowed for the call.
+        """
+        if not self._levels():
+            with borrow(self._shards[index]) as conn:
+                return getattr(conn, method)(*args)
+        return getattr(self._connection(index), method)(*args)
+
+    def _execute_query(self, name, *params):
+        if name in fan_out_queries:
+            result = _combine(queries[name]._return_type,
+                              [self._run(index, '_execute_query', name,
+                                         *params)
+                               for index in xrange(len(self._shards))])
+            if name in ordered_queries:
+                result = sorted(result)[:params[ordered_queries[name]]]
+            return result
+        if name in key_queries:
+            value_point = key_point(params[0])
+            if value_point is not None:
+                index = self._ring.shard(value_point)
+                result = self._run(index, '_execute_query', name, *params)
+                if result is not None:
+                    return result
+            # Keys made before sharding don't say where they are
+            return _combine(queries[name]._return_type,
+                            [self._run(shard, '_execute_query', name, *params)
+                             for shard in xrange(len(self._shards))])
+        return self._run(self.shard(params[0]), '_execute_query', name,
+                         *params)
+
+    def _execute_query_many(self, name, rows):
+        """Runs the batch on each shard, with the rows routed to it."""
+        by_shard = {}
+        for row in rows:
+            row = tuple(row)
+            by_shard.setdefault(self.shard(row[0]), []).append(row)
+        results = [self._run(index, '_execute_query_many', name, shard_rows)
+                   for index, shard_rows in sorted(by_shard.iteritems())]
+        if queries[name]._return_type == 'rowcount':
+            return sum(results)
+        return None
+
+    def _execute_query_stream(self, name, *params):
+        """Generator streaming the results from each shard in turn (or
+        just from the user's, for queries routed by email).
+        """
+        if name in fan_out_queries:
+            shards = xrange(len(self._shards))
+        else:
+            shards = [self.shard(params[0])]
+        for index in shards:
+            if self._levels():
+                conn = self._connection(index)
+                for result in conn._execute_query_stream(name, *params):
+                    yield result
+            else:
+                with borrow(self._shards[index]) as conn:
+                    for result in conn._execute_query_stream(name, *params):
+                        yield result
+
+
+for name in queries:
+    setattr(ShardedConnection, name, _query_method(name))
+del name
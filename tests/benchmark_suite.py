@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+"""
+Reproducible benchmark suite for the hot paths of this package, for
+catching performance regressions.
+
+Run with "python -m auth.tests.benchmark_suite" from the directory
+containing the package. Every case is timed in microseconds per operation
+(lower is better), on sqlite databases in memory and on disk where it
+touches the database. Results are printed, optionally written as JSON
+(--output), and compared with a baseline (benchmark_baseline.json, next
+to this file, or --baseline): the exit status is 1 if any case is slower
+than its baseline by more than the threshold (--threshold, a fraction).
+--save-baseline stores the results as the new baseline. Baselines only
+compare on the host they were made on, and the default threshold is loose
+enough for a noisy one (identical runs on a shared single CPU host differ
+by up to 35%): on a quiet host, pass a tighter one.
+
+Passwords are hashed at the hashers' minimum cost, so that the suite
+measures this package's code rather than the hash (which
+benchmarks.bench_password_hashing measures).
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import itertools
+import tempfile
+import timeit
+
+from .. import db
+from .. import users
+from .. import mailer
+from .. import hashers
+from .. import tokens
+from .. import clear_pending_users
+from .. config import options
+from .. exceptions import AuthenticationError
+from . benchmarks import (sqlite_connection, fill_pending_users, per_call,
+                          local_smtp_server, template_file)
+
+
+baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baseline.json')
+
+storages = ['memory', 'disk']
+
+# Benchmark cases, each a generator function taking a temporary directory
+# and yielding (name, microseconds per operation) tuples
+cases = []
+
+def case(func):
+    cases.append(func)
+    return func
+
+
+def autorange(func, min_time=0.2, repeat=5):
+    """Best of 'repeat' runs of func, in microseconds per call, each run
+    making enough calls to take at least min_time seconds, so that short
+    functions aren't at the mercy of noise on the host. func must be
+    repeatable any number of times.
+    """
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-6)))
+    return min([elapsed] + timeit.repeat(func, number=number,
+                                         repeat=repeat - 1)) / number * 1e6
+
+
+def connection(storage, tmp_dir, users_=1000):
+    """A db.Connection to a new sqlite database (see sqlite_connection),
+    in memory or on disk.
+    """
+    if storage == 'memory':
+        return sqlite_connection(users=users_)
+    path = os.path.join(tmp_dir, 'suite.sqlite')
+    if os.path.exists(path):
+        os.remove(path)
+    return sqlite_connection(path, users=users_)
+
+
+@case
+def password_functions(tmp_dir):
+    encoded = users.hash_password('secret')
+    legacy = users.mkhash('secret')
+    yield 'users.validate_email', autorange(
+        lambda: users.validate_email('user@isnomore.net'))
+    yield 'users.registration_key', autorange(
+        lambda: users.registration_key('user@isnomore.net'))
+    yield 'users.mkhash', autorange(lambda: users.mkhash('secret'))
+    yield 'users.hash_password', autorange(
+        lambda: users.hash_password('secret'))
+    yield 'users.verify_password', autorange(
+        lambda: users.verify_password('secret', encoded))
+    yield 'users.verify_password[legacy]', autorange(
+        lambda: users.verify_password('secret', legacy))
+
+
+@case
+def registration(tmp_dir):
+    for storage in storages:
+        conn = connection(storage, tmp_dir, users_=0)
+        emails = ('new{0}@isnomore.net'.format(i) for i in itertools.count())
+        yield 'users.register_user[{0}]'.format(storage), per_call(
+            lambda: users.register_user(next(emails), 'secret', conn), 200)
+        fill_pending_users(conn, 5000, int(time.time()))
+        keys = ('key{0}'.format(i) for i in itertools.count())
+        yield 'users.activate[{0}]'.format(storage), per_call(
+            lambda: users.activate(next(keys), conn), 1000)
+        conn.close()
+
+
+@case
+def authentication(tmp_dir):
+    for storage in storages:
+        conn = connection(storage, tmp_dir)
+        for email in ('user0@isnomore.net', 'user1@isnomore.net'):
+            conn.set_user_password(email, hashers.make_password('secret'))
+        def failed(email):
+            try:
+                users.authenticate(email, 'wrong', conn)
+            except AuthenticationError:
+                pass
+        yield 'users.authenticate[{0}]'.format(storage), autorange(
+            lambda: users.authenticate('user0@isnomore.net', 'secret', conn))
+        yield 'users.authenticate[{0}, wrong password]'.format(storage), \
+            autorange(lambda: failed('user1@isnomore.net'))
+        yield 'users.authenticate[{0}, unknown user]'.format(storage), \
+            autorange(lambda: failed('nobody@isnomore.net'))
+        conn.close()
+
+
+@case
+def access_control(tmp_dir):
+    @users.access_control('role')
+    def resource():
+        return 42
+    @users.access_control_by_roles(users.any_of('role', 'other role'))
+    def roles_resource():
+        return 42
+    def uncached(func):
+        users._roles.clear()
+        users._role_sets.clear()
+        return func('user0@isnomore.net', conn)
+    for storage in storages:
+        conn = connection(storage, tmp_dir)
+        users._roles.clear()
+        users._role_sets.clear()
+        yield 'users.access_control[{0}]'.format(storage), autorange(
+            lambda: uncached(resource))
+        yield 'users.access_control_by_roles[{0}]'.format(storage), autorange(
+            lambda: uncached(roles_resource))
+        conn.close()
+    conn = connection('memory', tmp_dir)
+    yield 'users.access_control[cached]', autorange(
+        lambda: resource('user0@isnomore.net', conn))
+    yield 'users.access_control_by_roles[cached]', autorange(
+        lambda: roles_resource('user0@isnomore.net', conn))
+    conn.close()
+    yield 'users.role_set', autorange(
+        lambda: users.role_set(['role', 'other role']))
+    saved = options.token_keys
+    options.token_keys = [('current', 'a secret')]
+    try:
+        @users.access_control_by_token('role')
+        def token_resource():
+            return 42
+        token = tokens.issue_token('user0@isnomore.net', 'role')
+        yield 'users.access_control_by_token', autorange(
+            lambda: token_resource(token))
+    finally:
+        options.token_keys = saved
+
+
+@case
+def bulk_import(tmp_dir, rows=2000, runs=3):
+    def run_once(storage):
+        conn = connection(storage, tmp_dir, users_=0)
+        results = users.bulk_import_users(
+            (('import{0}@isnomore.net'.format(i), 'secret', 'role')
+             for i in xrange(rows)), conn, chunk_size=1000, processes=0)
+        assert results['imported'] == rows
+        conn.close()
+        return results['elapsed'] / rows * 1e6
+    for storage in storages:
+        yield 'users.bulk_import_users[{0}]'.format(storage), \
+            min(run_once(storage) for i in xrange(runs))
+
+
+@case
+def query_compilation(tmp_dir):
+    for name, params in [('get_user', ('user@isnomore.net',)),
+                         ('set_user_password', ('user@isnomore.net', 'x'))]:
+        query_obj = db.queries[name]
+        for paramstyle in query_obj.supported_paramstyles:
+            yield 'Query.query[{0}, {1}]'.format(name, paramstyle), autorange(
+                lambda: query_obj.query(*params, paramstyle=paramstyle))
+
+
+@case
+def batch_scripts(tmp_dir, rows=100000, messages=2000, runs=3):
+    expired = int(time.time()) - options.registration_expiration - 60
+    def clear_once(storage):
+        conn = connection(storage, tmp_dir, users_=0)
+        fill_pending_users(conn, rows, expired)
+        results = clear_pending_users.delete_expired_pending_users(
+            conn, pause=0)
+        assert results['deleted'] == rows
+        conn.close()
+        return results['elapsed'] / rows * 1e6
+    for storage in storages:
+        yield 'clear_pending_users[{0}]'.format(storage), \
+            min(clear_once(storage) for i in xrange(runs))
+
+    def mail_once(storage):
+        conn = connection(storage, tmp_dir, users_=0)
+        fill_pending_users(conn, messages, int(time.time()))
+        start = time.time()
+        results = mailer.send_pending_confirmations(conn)
+        elapsed = time.time() - start
+        assert not results['failed']
+        conn.close()
+        return elapsed / messages * 1e6
+    server, thread = local_smtp_server()
+    saved = (options.smtp_server, options.reg_confirmation_template)
+    options.smtp_server = server.address
+    options.reg_confirmation_template = template_file
+    try:
+        for storage in storages:
+            yield 'mailer.send_pending_confirmations[{0}]'.format(storage), \
+                min(mail_once(storage) for i in xrange(runs))
+    finally:
+        options.smtp_server, options.reg_confirmation_template = saved
+        server.close()
+        thread.join()
+
+
+def run(selected=None):
+    """Runs the cases (those whose function names contain any of the
+    'selected' strings, if given), returning their results by name.
+    """
+    saved = (options.pbkdf2_iterations, options.failed_auth_limit,
+             options.hashing_executor)
+    options.pbkdf2_iterations = hashers.PBKDF2Hasher.min_cost
+    options.failed_auth_limit = sys.maxint
+    options.hashing_executor = None
+    tmp_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for func in cases:
+            if selected and not any(s in func.__name__ for s in selected):
+                continue
+            for name, us in func(tmp_dir):
+                results[name] = us
+                print '{0:<50}{1:>12.2f} us'.format(name, us)
+    finally:
+        (options.pbkdf2_iterations, options.failed_auth_limit,
+         options.hashing_executor) = saved
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns (name, baseline, result) for each case slower than its
+    baseline by more than threshold (a fraction of the baseline).
+    """
+    return [(name, baseline[name], results[name])
+            for name in sorted(results)
+            if name in baseline and
+            results[name] > baseline[name] * (1 + threshold)]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Runs the benchmark suite.')
+    parser.add_argument('cases', nargs='*',
+                        help='only run cases whose names contain these')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline', default=baseline_file,
+                        help='compare with the results in this file')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='slowdown (as a fraction) counted as a '
+                             'regression')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the baseline')
+    args = parser.parse_args(args)
+
+    results = run(args.cases)
+    report = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'sqlite': sqlite3.sqlite_version,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    for name, before, after in regressions:
+        print 'REGRESSION {0}: {1:.2f} us -> {2:.2f} us ({3:+.0%})'.format(
+            name, before, after, after / before - 1)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
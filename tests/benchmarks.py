@@ -0,0 +1,771 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmarks for the hot paths of this package.
+
+Run with "python -m auth.tests.benchmarks" from the directory containing
+the package. Timings are reported in microseconds per call.
+"""
+
+
+import os
+import time
+import smtpd
+import shutil
+import string
+import sqlite3
+import asyncore
+import resource
+import tempfile
+import threading
+import multiprocessing
+import timeit
+from email.message import Message
+
+from .. import db
+from .. import users
+from .. import mailer
+from .. import attempts
+from .. import hashers
+from .. import asynchronous
+from .. import tokens
+from .. import sharding
+from .. import clear_pending_users
+from .. config import options
+from .. cache import TTLCache
+from .. exceptions import AuthenticationError, UnauthorizedAccessError
+
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+schema_file = os.path.join(package_dir, 'schema.sql')
+template_file = os.path.join(package_dir, 'reg_confirmation.template')
+
+
+def uncompiled_query(query_obj, params, paramstyle):
+    """Reference implementation of db.Query.query as it was before
+    query compilation, re-splitting the query string on every call (and
+    extended to the format and pyformat paramstyles in the same way).
+    """
+    params = query_obj.reorder_params(params)
+    q_split = query_obj._query.split('?')
+    if paramstyle in ('format', 'pyformat'):
+        q_split = [part.replace('%', '%%') for part in q_split]
+    if paramstyle == 'qmark':
+        return query_obj._query, params
+    elif paramstyle == 'numeric':
+        converted = [(part + ':{0}'.format(i+1)) for i, part in
+                     enumerate(q_split[:-1])] + q_split[-1:]
+        return ''.join(converted), params
+    elif paramstyle == 'named':
+        converted = [part + ':{0}'.format(l) for l, part in
+                     zip(string.ascii_letters, q_split[:-1])] + q_split[-1:]
+        param_dict = dict(zip(string.ascii_letters, params))
+        return ''.join(converted), param_dict
+    elif paramstyle == 'format':
+        return '%s'.join(q_split), params
+    elif paramstyle == 'pyformat':
+        converted = [part + '%({0})s'.format(l) for l, part in
+                     zip(string.ascii_letters, q_split[:-1])] + q_split[-1:]
+        param_dict = dict(zip(string.ascii_letters, params))
+        return ''.join(converted), param_dict
+
+
+def per_call(func, number):
+    """Best of five runs of 'number' calls, in microseconds per call."""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def interleaved(funcs, number, repeat=5):
+    """Like per_call, for several functions at once, alternating between
+    them so that they are equally affected by noise on the host.
+    """
+    best = [None] * len(funcs)
+    for r in xrange(repeat):
+        for i, func in enumerate(funcs):
+            t = timeit.timeit(func, number=number) / number * 1e6
+            best[i] = t if best[i] is None else min(best[i], t)
+    return best
+
+
+def bench_query_compilation(number=20000):
+    """Per-call overhead of formatting a query, before and after
+    compilation, for every query in db.queries and every paramstyle.
+    'after' is what db.Connection does: look up the compiled query and
+    bind the parameters.
+    """
+    print '{0:<38}{1:<10}{2:>10}{3:>10}'.format('query', 'paramstyle',
+                                                'before', 'after')
+    for name in sorted(db.queries):
+        query_obj = db.queries[name]
+        params = tuple(range(query_obj._query.count('?')))
+        for paramstyle in db.Query.supported_paramstyles:
+            def compiled():
+                query, binder = query_obj.compile(paramstyle)
+                return query, binder(params)
+            before = per_call(
+                lambda: uncompiled_query(query_obj, params, paramstyle),
+                number)
+            after = per_call(compiled, number)
+            print '{0:<38}{1:<10}{2:>10.2f}{3:>10.2f}'.format(
+                name, paramstyle, before, after)
+
+
+def sqlite_connection(path=':memory:', users=1000, **kwargs):
+    """A db.Connection to a new sqlite3 database with 'users' active users,
+    named user0@isnomore.net, user1@isnomore.net etc.
+    """
+    conn = db.Connection(path, driver=sqlite3, **kwargs)
+    conn.connect()
+    conn._cursor.executescript(open(schema_file).read())
+    conn._cursor.executemany(
+        'insert into users (email, password, role) values (?, ?, ?)',
+        (('user{0}@isnomore.net'.format(i), 'password', 'role')
+         for i in xrange(users)))
+    conn._conn.commit()
+    return conn
+
+
+def bench_query_dispatch(number=100000):
+    """Calls per second of conn.get_user on an in-memory sqlite database:
+    through the generated method, through __getattr__ (as every query
+    used to be), and executing the query directly on the cursor.
+    """
+    conn = sqlite_connection(users=1000)
+    email = 'user500@isnomore.net'
+    q = db.queries['get_user']._query
+    cursor = conn._cursor
+    funcs = [('generated method', lambda: conn.get_user(email)),
+             ('__getattr__', lambda: db.Connection.__getattr__(
+                 conn, 'get_user')(email)),
+             ('cursor', lambda: cursor.execute(q, (email,)).fetchall())]
+    print 'get_user dispatch ({0} calls):'.format(number)
+    names, funcs = zip(*funcs)
+    for name, us in zip(names, interleaved(funcs, number)):
+        print '{0:<24}{1:>12.0f} calls/s'.format(name, 1e6 / us)
+    conn.close()
+
+
+def bench_query_stats(number=50000):
+    """Cost of measuring queries: microseconds per conn.get_user on an
+    in-memory sqlite database, unmeasured, with a slow query threshold,
+    and with query stats.
+    """
+    email = 'user500@isnomore.net'
+    conns = [('unmeasured', sqlite_connection(users=1000)),
+             ('slow_query_time', sqlite_connection(users=1000,
+                                                   slow_query_time=1)),
+             ('query_stats', sqlite_connection(users=1000,
+                                               query_stats=True))]
+    print 'query stats overhead ({0} calls):'.format(number)
+    names, conns = zip(*conns)
+    times = interleaved([lambda conn=conn: conn.get_user(email)
+                         for conn in conns], number)
+    for name, us in zip(names, times):
+        print '{0:<24}{1:>10.2f} us{2:>+10.2f} us'.format(name, us,
+                                                         us - times[0])
+    for conn in conns:
+        conn.close()
+
+
+def bench_statement_cache(number=5000):
+    """Latency of the read queries (get_user and get_user_role amongst
+    them) with a small sqlite3 statement cache, which this mix of queries
+    thrashes so that statements are prepared again on every call, with
+    sqlite3's default cache, and with db.Connection's statement cache.
+    """
+    print '{0:<30}{1:>12}{2:>10}{3:>10}'.format('', 'thrashed', 'default',
+                                                'cached')
+    thrashed = sqlite_connection(cached_statements=5)
+    default = sqlite_connection()
+    cached = sqlite_connection(statement_cache_size=20)
+
+    def mix(conn):
+        email = 'user42@isnomore.net'
+        def run():
+            conn.get_user(email)
+            conn.get_user_role(email)
+            conn.get_pending_user(email)
+            conn.get_pending_user_by_key('key')
+            conn.get_pending_users_unmailed()
+            conn.get_pending_users_registered_before(0)
+        return run
+    timings = interleaved([mix(conn) for conn in
+                           [thrashed, default, cached]], number)
+    print '{0:<30}{1:>12.2f}{2:>10.2f}{3:>10.2f}'.format(
+        'six read queries', *timings)
+
+
+def fill_pending_users(conn, rows, registration_date):
+    """Inserts 'rows' pending users, registered at registration_date."""
+    conn._cursor.executemany(
+        """insert into pending_users
+           (email, password, registration_key, registration_date)
+           values (?, 'password', ?, ?)""",
+        (('pending{0}@isnomore.net'.format(i), 'key{0}'.format(i),
+          registration_date) for i in xrange(rows)))
+    conn._conn.commit()
+
+
+def bench_expiry(rows=1000000, sample=2000, chunk_size=10000):
+    """Deletion of 'rows' expired pending users from an on-disk sqlite
+    database: one row at a time (committing each, as clear_pending_users
+    used to, measured on 'sample' rows), in chunks, and all at once.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    expired = int(time.time()) - options.registration_expiration - 60
+    try:
+        conn = sqlite_connection(os.path.join(tmp_dir, 'bench.sqlite'),
+                                 users=0)
+        fill_pending_users(conn, sample, expired)
+        start = time.time()
+        for email in conn.get_pending_users_registered_before(expired + 1):
+            conn.delete_pending_user(email)
+        per_row = sample / (time.time() - start)
+
+        rates = []
+        for size in [chunk_size, None]:
+            fill_pending_users(conn, rows, expired)
+            results = clear_pending_users.delete_expired_pending_users(
+                conn, chunk_size=size, pause=0)
+            assert results['deleted'] == rows
+            rates.append(rows / results['elapsed'])
+    finally:
+        shutil.rmtree(tmp_dir)
+    print 'expired pending users deleted per second ({0} rows):'.format(rows)
+    print '{0:<20}{1:>12.0f}'.format('one at a time', per_row)
+    print '{0:<20}{1:>12.0f}'.format('chunks of {0}'.format(chunk_size),
+                                     rates[0])
+    print '{0:<20}{1:>12.0f}'.format('all at once', rates[1])
+
+
+def uncached_message(email, key):
+    """Reference implementation of mailer.create_message(email, key)
+    .as_string() as it was before message templates, reading the template
+    file and rendering every header for every message.
+    """
+    msg = Message()
+    msg['From'] = '{0} <{1}>'.format(options.reg_confirmation_from,
+                                     options.reg_confirmation_from_addr)
+    msg['To'] = email
+    msg['Subject'] = options.reg_confirmation_subject
+    body = open(template_file).read()
+    msg.set_payload(body.format(registration_key=key))
+    return msg.as_string()
+
+
+def bench_message_rendering(keys=100000):
+    """Confirmation messages rendered per second, for 'keys' different
+    registration keys, before and after message templates.
+    """
+    saved = options.reg_confirmation_template
+    options.reg_confirmation_template = template_file
+    try:
+        template = mailer.confirmation_template()
+        pending = [('user{0}@isnomore.net'.format(i), 'key{0}'.format(i))
+                   for i in xrange(keys)]
+        rates = []
+        for render in [uncached_message, template.as_string]:
+            start = time.time()
+            for email, key in pending:
+                render(email, key)
+            rates.append(keys / (time.time() - start))
+    finally:
+        options.reg_confirmation_template = saved
+    print 'confirmation messages rendered per second ({0} keys):'.format(keys)
+    print '{0:<20}{1:>12.0f}'.format('uncached', rates[0])
+    print '{0:<20}{1:>12.0f}'.format('template', rates[1])
+
+
+class SinkSMTPServer(smtpd.SMTPServer):
+    """Local SMTP server which counts and discards all messages."""
+    received = 0
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+
+
+def local_smtp_server():
+    """Starts a SinkSMTPServer on a free local port, on its own thread.
+    Returns the server, whose address is server.address, and the thread,
+    which finishes once the server and its connections are closed.
+    """
+    server = SinkSMTPServer(('127.0.0.1', 0), None)
+    server.address = '{0}:{1}'.format(*server.socket.getsockname())
+    thread = threading.Thread(target=asyncore.loop,
+                              kwargs={'timeout': 0.05, 'use_poll': True})
+    thread.daemon = True
+    thread.start()
+    return server, thread
+
+
+def bench_mailer(users=10000, sample=1000):
+    """Confirmation messages sent per second to a local SMTP server, by
+    send_pending_confirmations with 'users' pending users, opening a new
+    connection for each message (as mailer used to, measured on 'sample'
+    messages), and through SMTP sessions of several sizes.
+    """
+    server, thread = local_smtp_server()
+    saved = (options.smtp_server, options.smtp_messages_per_session,
+             options.reg_confirmation_template)
+    options.smtp_server = server.address
+    options.reg_confirmation_template = template_file
+    print 'confirmation messages sent per second ({0} users):'.format(users)
+    try:
+        msg = mailer.create_message('user@isnomore.net', 'key').as_string()
+        start = time.time()
+        for i in xrange(sample):
+            mailer.mail_confirmation('user@isnomore.net', msg)
+        print '{0:<30}{1:>10.0f}'.format('connection per message',
+                                         sample / (time.time() - start))
+
+        for per_session in [10, 100, None]:
+            options.smtp_messages_per_session = per_session
+            conn = sqlite_connection(users=0)
+            fill_pending_users(conn, users, int(time.time()))
+            start = time.time()
+            results = mailer.send_pending_confirmations(conn)
+            elapsed = time.time() - start
+            assert not results['failed']
+            print '{0:<30}{1:>10.0f}'.format(
+                'session of {0} messages'.format(per_session or 'all'),
+                users / elapsed)
+    finally:
+        (options.smtp_server, options.smtp_messages_per_session,
+         options.reg_confirmation_template) = saved
+        server.close()
+        thread.join()
+
+
+def bench_failed_logins(logins=100000, users_=1000):
+    """Database writes and latency of 'logins' failed authentications,
+    spread over users_ users of an on-disk sqlite database, with failed
+    attempts counted on the database and on each attempt tracker.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    saved = options.attempt_tracker
+    trackers = [('database', lambda: None),
+                ('memory', attempts.MemoryAttemptTracker),
+                ('file', lambda: attempts.FileAttemptTracker(
+                    os.path.join(tmp_dir, 'attempts')))]
+    print 'failed logins ({0} logins, {1} users):'.format(logins, users_)
+    print '{0:<12}{1:>12}{2:>14}'.format('tracker', 'db writes', 'us/login')
+    try:
+        for name, tracker in trackers:
+            path = os.path.join(tmp_dir, '{0}.sqlite'.format(name))
+            conn = sqlite_connection(path, users=users_)
+            options.attempt_tracker = tracker()
+            emails = ['user{0}@isnomore.net'.format(i)
+                      for i in xrange(users_)]
+            writes = conn._conn.total_changes
+            start = time.time()
+            for i in xrange(logins):
+                try:
+                    users.authenticate(emails[i % users_], 'wrong', conn)
+                except AuthenticationError:
+                    pass
+            elapsed = time.time() - start
+            writes = conn._conn.total_changes - writes
+            conn.close()
+            print '{0:<12}{1:>12}{2:>14.1f}'.format(name, writes,
+                                                    elapsed / logins * 1e6)
+    finally:
+        options.attempt_tracker = saved
+        shutil.rmtree(tmp_dir)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(len(sorted_values) * p / 100.0))]
+
+
+def bench_login_timing(samples=300, iterations=10000):
+    """Latency of failed authentications of an existing user (wrong
+    password) and of unknown users, interleaved, on an in-memory sqlite
+    database with PBKDF2 at 'iterations' iterations. Asserts that the
+    distributions overlap: each median is within the other's 10th to 90th
+    percentiles.
+    """
+    saved = (options.pbkdf2_iterations, options.failed_auth_limit)
+    options.pbkdf2_iterations = iterations
+    options.failed_auth_limit = samples + 1
+    print 'failed login latency ({0} samples, {1} PBKDF2 iterations):'.format(
+        samples, iterations)
+    print '{0:<14}{1:>10}{2:>10}{3:>10}'.format('user', 'p10 ms', 'p50 ms',
+                                                 'p90 ms')
+    try:
+        conn = sqlite_connection(users=0)
+        conn.save_user('user@isnomore.net', hashers.make_password('secret'))
+        emails = {'existing': lambda i: 'user@isnomore.net',
+                  'unknown': lambda i: 'nobody{0}@isnomore.net'.format(i)}
+        times = dict((name, []) for name in emails)
+        for i in xrange(samples):
+            for name in sorted(emails):
+                email = emails[name](i)
+                start = time.time()
+                try:
+                    users.authenticate(email, 'wrong', conn)
+                except AuthenticationError:
+                    pass
+                times[name].append(time.time() - start)
+        ranges = {}
+        for name in sorted(times):
+            values = sorted(times[name])
+            ranges[name] = [percentile(values, p) for p in (10, 50, 90)]
+            print '{0:<14}{1:>10.2f}{2:>10.2f}{3:>10.2f}'.format(
+                name, *[value * 1000 for value in ranges[name]])
+        existing, unknown = ranges['existing'], ranges['unknown']
+        assert unknown[0] <= existing[1] <= unknown[2], ranges
+        assert existing[0] <= unknown[1] <= existing[2], ranges
+        conn.close()
+    finally:
+        options.pbkdf2_iterations, options.failed_auth_limit = saved
+
+
+def two_query_access_control(role):
+    """Reference implementation of users.access_control as it was before
+    the role cache, querying for the user and then for their role.
+    """
+    def decorate(func):
+        def auth_wrapper(email, conn, *args, **kwargs):
+            if conn.get_user(email) is None:
+                raise UnauthorizedAccessError()
+            if conn.get_user_role(email) != role:
+                raise UnauthorizedAccessError()
+            return func(*args, **kwargs)
+        return auth_wrapper
+    return decorate
+
+
+def bench_access_control(number=20000, users_=1000):
+    """Decorated calls per second, for users_ users with the required role,
+    querying twice per call (as access_control used to), once per call
+    (with the role cache disabled), and with the role cache.
+    """
+    conn = sqlite_connection(users=users_)
+    emails = ['user{0}@isnomore.net'.format(i) for i in xrange(users_)]
+    def resource():
+        return True
+    def calls(decorated):
+        def run():
+            for email in emails:
+                decorated(email, conn)
+        return run
+    saved = users._roles
+    try:
+        two_queries = calls(two_query_access_control('role')(resource))
+        decorated = calls(users.access_control('role')(resource))
+        def one_query():
+            users._roles = TTLCache(ttl=0)
+            decorated()
+        def cached():
+            users._roles = saved
+            decorated()
+        timings = interleaved([two_queries, one_query, cached],
+                              max(1, number // users_))
+    finally:
+        users._roles = saved
+    print 'decorated calls per second ({0} users):'.format(users_)
+    for name, t in zip(['two queries', 'one query', 'cached'], timings):
+        print '{0:<20}{1:>12.0f}'.format(name, users_ / t * 1e6)
+
+
+def bench_tokens(number=20000, users_=1000):
+    """Token verifications per second (tokens.verify_token), and decorated
+    calls per second for users_ users with the required role: by session
+    token, and by email, through the role cache and with a query per call.
+    """
+    saved = (options.token_keys, users._roles)
+    options.token_keys = [('current', 'a secret'), ('previous', 'another')]
+    conn = sqlite_connection(users=users_)
+    emails = ['user{0}@isnomore.net'.format(i) for i in xrange(users_)]
+    user_tokens = [tokens.issue_token(email, 'role') for email in emails]
+    def resource():
+        return True
+    def calls(decorated, credentials, conn=None):
+        def run():
+            for credential in credentials:
+                if conn is None:
+                    decorated(credential)
+                else:
+                    decorated(credential, conn)
+        return run
+    try:
+        by_email = calls(users.access_control('role')(resource), emails,
+                         conn)
+        def one_query():
+            users._roles = TTLCache(ttl=0)
+            by_email()
+        def cached():
+            users._roles = saved[1]
+            by_email()
+        timings = interleaved(
+            [calls(tokens.verify_token, user_tokens),
+             calls(users.access_control_by_token('role')(resource),
+                   user_tokens),
+             cached, one_query], max(1, number // users_))
+    finally:
+        options.token_keys, users._roles = saved
+        conn.close()
+    print 'token verifications and decorated calls per second ' \
+          '({0} users):'.format(users_)
+    for name, t in zip(['verify_token', 'by token', 'by email, cached',
+                        'by email, one query'], timings):
+        print '{0:<24}{1:>12.0f}'.format(name, users_ / t * 1e6)
+
+
+def bench_bulk_import(users_=1000000, sample=2000):
+    """Users imported per second into an on-disk sqlite database: one at a
+    time with register_user and activate (measured on 'sample' users), and
+    users_ users with bulk_import_users, without and with a process pool.
+    Passwords are hashed at the lowest cost, since at full cost hashing
+    would dwarf everything else.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    saved = options.pbkdf2_iterations
+    options.pbkdf2_iterations = hashers.PBKDF2Hasher.min_cost
+    print 'users imported per second:'
+    try:
+        conn = sqlite_connection(os.path.join(tmp_dir, 'single.sqlite'),
+                                 users=0)
+        start = time.time()
+        for i in xrange(sample):
+            email = 'user{0}@isnomore.net'.format(i)
+            users.activate(users.register_user(email, 'secret', conn), conn)
+        print '{0:<30}{1:>10.0f}'.format(
+            'register and activate', sample / (time.time() - start))
+        conn.close()
+
+        for processes in [0, None]:
+            path = os.path.join(tmp_dir, 'bulk{0}.sqlite'.format(processes))
+            conn = sqlite_connection(path, users=0)
+            results = users.bulk_import_users(
+                (('user{0}@isnomore.net'.format(i), 'secret', 'role')
+                 for i in xrange(users_)), conn, processes=processes)
+            assert results['imported'] == users_
+            conn.close()
+            print '{0:<30}{1:>10.0f}'.format(
+                'bulk, {0} processes'.format(
+                    processes if processes is not None else 'all'),
+                users_ / results['elapsed'])
+    finally:
+        options.pbkdf2_iterations = saved
+        shutil.rmtree(tmp_dir)
+
+
+def peak_memory():
+    """Peak resident memory of this process so far, in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bench_streaming(rows=5000000):
+    """Peak memory growth while going through 'rows' unmailed pending users
+    of an on-disk sqlite database, streamed and fetched all at once. The
+    streamed query runs first, since the peak can only grow.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        conn = sqlite_connection(os.path.join(tmp_dir, 'bench.sqlite'),
+                                 users=0)
+        fill_pending_users(conn, rows, int(time.time()))
+        print 'peak memory growth over {0} pending users (MB):'.format(rows)
+        for name, query in [
+                ('streamed', conn.stream.get_pending_users_unmailed),
+                ('fetchall', conn.get_pending_users_unmailed)]:
+            before = peak_memory()
+            start = time.time()
+            count = 0
+            for email, key in query():
+                count += 1
+            elapsed = time.time() - start
+            assert count == rows
+            print '{0:<12}{1:>10.1f}{2:>10.1f}s'.format(
+                name, peak_memory() - before, elapsed)
+        conn.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_password_hashing(seconds=2):
+    """Successful logins per second on one core (authenticate on an
+    in-memory sqlite database, for 'seconds' seconds each), with passwords
+    hashed by mkhash (as before hashers), and by each hasher at its
+    current cost.
+    """
+    conn = sqlite_connection(users=0)
+    saved = options.rehash_passwords
+    options.rehash_passwords = False
+    passwords = [('mkhash', users.mkhash('secret'))]
+    for algorithm in sorted(hashers.hashers):
+        passwords.append((algorithm,
+                          hashers.hashers[algorithm]().encode('secret')))
+    print 'logins per second per core:'
+    try:
+        for name, password in passwords:
+            email = '{0}@isnomore.net'.format(name)
+            conn.save_user(email, password)
+            logins = 0
+            start = time.time()
+            while time.time() - start < seconds:
+                users.authenticate(email, 'secret', conn)
+                logins += 1
+            print '{0:<16}{1:>14}{2:>12.1f}'.format(
+                name, password.split('$')[1] if '$' in password else '',
+                logins / (time.time() - start))
+    finally:
+        options.rehash_passwords = saved
+
+
+def bench_hashing_executor(seconds=3, iterations=10000, max_processes=None):
+    """Successful logins per second, by 8 threads sharing a pool of
+    connections to an on-disk sqlite database, with PBKDF2 at 'iterations'
+    iterations: hashing on the calling threads, and on a HashingExecutor
+    of 1 to max_processes (defaulting to the number of CPUs) processes.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    saved = (options.pbkdf2_iterations, options.hashing_executor)
+    options.pbkdf2_iterations = iterations
+    if max_processes is None:
+        max_processes = multiprocessing.cpu_count()
+    print 'logins per second ({0} PBKDF2 iterations, {1} CPUs):'.format(
+        iterations, multiprocessing.cpu_count())
+    try:
+        path = os.path.join(tmp_dir, 'bench.sqlite')
+        sqlite_connection(path, users=0).close()
+        pool = db.ConnectionPool(path, driver=sqlite3, max_size=8,
+                                 check_same_thread=False)
+        with pool.connection() as conn:
+            conn.save_user('user@isnomore.net',
+                           hashers.make_password('secret'))
+        for processes in [None] + range(1, max_processes + 1):
+            executor = None
+            if processes is not None:
+                executor = hashers.HashingExecutor(processes)
+            options.hashing_executor = executor
+            logins = [0]
+            deadline = time.time() + seconds
+            def login():
+                while time.time() < deadline:
+                    users.authenticate('user@isnomore.net', 'secret', pool)
+                    logins[0] += 1
+            threads = [threading.Thread(target=login) for i in xrange(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if executor is not None:
+                executor.close()
+            print '{0:<24}{1:>10.1f}'.format(
+                'calling threads' if processes is None else
+                '{0} processes'.format(processes), logins[0] / seconds)
+        pool.close()
+    finally:
+        options.pbkdf2_iterations, options.hashing_executor = saved
+        shutil.rmtree(tmp_dir)
+
+
+def bench_async_logins(logins=2000, iterations=1000, workers=8):
+    """'logins' concurrent successful logins against an on-disk sqlite
+    database, with PBKDF2 at 'iterations' iterations: each on a thread of
+    its own, and all submitted at once to an AsyncConnection with
+    'workers' threads. Reports the total time, and the peak memory of the
+    process (so the AsyncConnection runs first).
+    """
+    tmp_dir = tempfile.mkdtemp()
+    saved = options.pbkdf2_iterations
+    options.pbkdf2_iterations = iterations
+    print '{0} concurrent logins ({1} PBKDF2 iterations):'.format(
+        logins, iterations)
+    try:
+        path = os.path.join(tmp_dir, 'bench.sqlite')
+        sqlite_connection(path, users=0).close()
+        pool = db.ConnectionPool(path, driver=sqlite3, max_size=workers,
+                                 check_same_thread=False)
+        with pool.connection() as conn:
+            conn.save_user('user@isnomore.net',
+                           hashers.make_password('secret'))
+
+        aconn = asynchronous.AsyncConnection(pool, workers)
+        start = time.time()
+        futures = [asynchronous.authenticate('user@isnomore.net', 'secret',
+                                             aconn) for i in xrange(logins)]
+        for future in futures:
+            future.result()
+        print '{0:<24}{1:>10.3f} s {2:>8.1f} MB'.format(
+            '{0} workers'.format(workers), time.time() - start, peak_memory())
+        aconn.close()
+
+        def login():
+            users.authenticate('user@isnomore.net', 'secret', pool)
+        start = time.time()
+        threads = [threading.Thread(target=login) for i in xrange(logins)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print '{0:<24}{1:>10.3f} s {2:>8.1f} MB'.format(
+            'thread per login', time.time() - start, peak_memory())
+        pool.close()
+    finally:
+        options.pbkdf2_iterations = saved
+        shutil.rmtree(tmp_dir)
+
+
+def bench_sharding(seconds=3, threads=8, shard_counts=(1, 2, 4)):
+    """Users saved and read back per second by 'threads' threads, through
+    a ShardedConnection over 1 or more on-disk sqlite databases, each
+    behind a pool of connections.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    print 'users saved and read per second ({0} threads):'.format(threads)
+    try:
+        for shards in shard_counts:
+            pools = []
+            for i in xrange(shards):
+                path = os.path.join(tmp_dir, '{0}-{1}.sqlite'.format(shards, i))
+                sqlite_connection(path, users=0).close()
+                pools.append(('shard{0}'.format(i), db.ConnectionPool(
+                    path, driver=sqlite3, max_size=threads, timeout=30,
+                    check_same_thread=False)))
+            conn = sharding.ShardedConnection(pools)
+            done = [0] * threads
+            deadline = time.time() + seconds
+            def work(thread):
+                i = 0
+                while time.time() < deadline:
+                    email = 'user{0}-{1}@isnomore.net'.format(thread, i)
+                    conn.save_user(email, 'password')
+                    assert conn.get_user(email)
+                    i += 1
+                done[thread] = i
+            workers = [threading.Thread(target=work, args=(i,))
+                       for i in xrange(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            conn.close()
+            print '{0:<12}{1:>12.0f}'.format(
+                '{0} shard{1}'.format(shards, 's' if shards > 1 else ''),
+                sum(done) / float(seconds))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    bench_query_compilation()
+    bench_query_dispatch()
+    bench_query_stats()
+    bench_statement_cache()
+    bench_expiry()
+    bench_message_rendering()
+    bench_mailer()
+    bench_failed_logins()
+    bench_login_timing()
+    bench_access_control()
+    bench_tokens()
+    bench_bulk_import()
+    bench_streaming()
+    bench_password_hashing()
+    bench_hashing_executor()
+    bench_async_logins()
+    bench_sharding()
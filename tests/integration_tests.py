@@ -33,6 +33,13 @@ Now, let's register a user:
 
 >>> from .. import users
 >>> from .. import db
+>>> from .. import hashers
+>>> from .. config import options
+
+Passwords are hashed at a deliberately high cost, which would make these
+tests take minutes, so we'll use the lowest one:
+
+>>> options.pbkdf2_iterations = hashers.PBKDF2Hasher.min_cost
 >>> conn = db.Connection(tmp_db, driver=sqlite3)
 >>> conn.connect()
 >>> before_reg = int(time.time())
@@ -47,7 +54,9 @@ Now, let's register a user:
 rbp@isnomore.net
 >>> password != 'foobar'
 True
->>> password == users.mkhash('foobar', users.Hash(password).salt)
+>>> password.startswith('pbkdf2_sha256$')
+True
+>>> users.verify_password('foobar', password)
 True
 >>> len(key) > 0
 True
@@ -191,6 +200,17 @@ True
 True
 
 
+The template file is only read (and its headers rendered) once, by
+mailer.confirmation_template, which also renders messages directly
+into the form in which they're sent:
+
+>>> mailer.confirmation_template() is mailer.confirmation_template()
+True
+>>> mailer.confirmation_template().as_string(
+...     'someone@isnomore.net', 'a_registration_key') == msg.as_string()
+True
+
+
 Once the message is built, mailer sends it:
 
 >>> mocker = Mocker()
@@ -210,20 +230,42 @@ Once the message is built, mailer sends it:
 >>> mailer.smtplib = l
 
 
+When sending several messages, mailer keeps the connection to the SMTP
+server open, using an SMTPSession:
+
+>>> mocker = Mocker()
+>>> mock_smtplib = mocker.mock()
+>>> mock_smtp = mocker.mock()
+>>> _ = expect(mock_smtplib.SMTP(options.smtp_server)).result(mock_smtp)
+>>> _ = expect(mock_smtp.sendmail(options.reg_confirmation_from_addr,
+...                               ANY, msg.as_string())).count(2)
+>>> mock_smtp.quit() #doctest: +ELLIPSIS
+<mocker.Mock ...>
+>>> mailer.smtplib = mock_smtplib
+>>> with mocker:
+...     session = mailer.SMTPSession()
+...     mailer.mail_confirmation('someone@isnomore.net', msg.as_string(),
+...                              session)
+...     mailer.mail_confirmation('someone_else@isnomore.net',
+...                              msg.as_string(), session)
+...     session.quit()
+>>> mailer.smtplib = l
+
+
 Now, putting it all together:
 
 >>> mocker = Mocker()
->>> mock_create_msg = mocker.replace(mailer.create_message)
 >>> mock_confirmation = mocker.mock()
 >>> mock_options = mocker.replace(options)
 >>> to_mail = conn.get_pending_users_unmailed()
 >>> user1, user2 = to_mail
+>>> template = mailer.confirmation_template()
 >>>
->>> _ = expect(mock_create_msg(user1[0], user1[1])).passthrough()
->>> _ = expect(mock_create_msg(user2[0], user2[1])).passthrough()
->>> mock_confirmation(user1[0], ANY) #doctest: +ELLIPSIS
+>>> mock_confirmation(user1[0], template.as_string(*user1),
+...                   ANY) #doctest: +ELLIPSIS
 <mocker.Mock ...>
->>> mock_confirmation(user2[0], ANY) #doctest: +ELLIPSIS
+>>> mock_confirmation(user2[0], template.as_string(*user2),
+...                   ANY) #doctest: +ELLIPSIS
 <mocker.Mock ...>
 >>> _ = expect(mock_options.db_driver).result(sqlite3)
 >>> _ = expect(mock_options.db_params).result(tmp_db)
@@ -248,9 +290,10 @@ has having been sent the confirmation email:
 >>> mocker = Mocker()
 >>> mock_confirmation = mocker.replace(mailer.mail_confirmation)
 >>> mock_options = mocker.replace(options)
->>> _ = expect(mock_confirmation(ARGS)).throw(smtplib.SMTPSenderRefused(0, '', 
-...                                           'user_with_error@isnomore.net'))
->>> mock_confirmation(ARGS) #doctest: +ELLIPSIS
+>>> _ = expect(mock_confirmation('user_with_error@isnomore.net', ANY, ANY)
+...           ).throw(smtplib.SMTPSenderRefused(0, '',
+...                                             'user_with_error@isnomore.net'))
+>>> mock_confirmation('user_ok@isnomore.net', ANY, ANY) #doctest: +ELLIPSIS
 <mocker.Mock ...>
 >>> _ = expect(mock_options.db_driver).result(sqlite3)
 >>> _ = expect(mock_options.db_params).result(tmp_db)
@@ -294,7 +337,7 @@ the same password, and removed from the pending_users table:
 >>> email, passwd = r[0]
 >>> email
 u'user_ok@isnomore.net'
->>> passwd == users.mkhash('foobar', passwd[:users.Hash._salt_len])
+>>> users.verify_password('foobar', passwd)
 True
 >>> sqlite_cursor.execute('''select email from pending_users 
 ...                       where email = 'user_ok@isnomore.net' ''').fetchall()
@@ -318,7 +361,7 @@ to exemplify deleting users.
 >>> mocker = Mocker()
 >>> mock_time = mocker.replace("time.time")
 >>> future_time = now + options.registration_expiration + 3600
->>> _ = expect(mock_time()).result(future_time)
+>>> _ = expect(mock_time()).result(future_time).count(1, None)
 >>> old = conn.get_pending_users_registered_before(future_time)
 >>> set(old) == set([u'another@isnomore.net', u'someone@isnomore.net',
 ...             u'someone_else@isnomore.net', u'user_with_error@isnomore.net'])
@@ -328,6 +371,8 @@ True
 ...     results = clear_pending_users.delete_expired_pending_users(conn)
 >>> results['failed']
 []
+>>> results['deleted']
+4
 >>> conn.get_pending_users_registered_before(future_time)
 []
 
@@ -427,6 +472,31 @@ True
 >>> mocker.verify()
 
 
+Passwords hashed before there were hashers (by users.mkhash) are still
+verified, and hashed again with the current hasher once the user
+authenticates. The same goes for passwords hashed at a lower cost than
+the current one:
+
+>>> old_hash = users.mkhash('old secret')
+>>> conn.save_user('old_timer@isnomore.net', old_hash)
+>>> users.authenticate('old_timer@isnomore.net', 'old secret', conn)
+True
+>>> new_hash = conn.get_user('old_timer@isnomore.net')[1]
+>>> new_hash.startswith('pbkdf2_sha256$')
+True
+>>> options.pbkdf2_iterations *= 2
+>>> users.authenticate('old_timer@isnomore.net', 'old secret', conn)
+True
+>>> newer_hash = conn.get_user('old_timer@isnomore.net')[1]
+>>> newer_hash != new_hash
+True
+>>> users.authenticate('old_timer@isnomore.net', 'old secret', conn)
+True
+>>> conn.get_user('old_timer@isnomore.net')[1] == newer_hash
+True
+>>> options.pbkdf2_iterations = hashers.PBKDF2Hasher.min_cost
+
+
 A valid authentication attempt (while the user is not suspended)
 clears out previous failed ones:
 
@@ -501,6 +571,39 @@ UnauthorizedAccessError: User does not have the role required by this resource
 'Always look on the bright side of life'
 
 
+Users can also have any number of other roles, and resources can
+require any or all of a set of roles (or of nested role expressions),
+with the @access_control_by_roles decorator:
+
+>>> conn.add_user_role('brian@isnomore.net', 'prophet')
+>>> conn.add_user_role('brian@isnomore.net', 'gourd holder')
+>>> sorted(conn.get_user_roles('brian@isnomore.net'))
+[u'gourd holder', u'prophet']
+
+>>> @users.access_control_by_roles(users.all_of('prophet', 'messiah'))
+... def lead(people):
+...     return True
+
+>>> lead('brian@isnomore.net', conn, 'the crowd')
+Traceback (most recent call last):
+  ...
+UnauthorizedAccessError: User does not have the role required by this resource
+
+>>> @users.access_control_by_roles(users.any_of(
+...     'messiah', users.all_of('naughty boy', 'prophet')))
+... def preach(people):
+...     return 'Blessed are the {0}'.format(people)
+
+>>> preach('brian@isnomore.net', conn, 'cheesemakers')
+'Blessed are the cheesemakers'
+
+>>> conn.remove_user_role('brian@isnomore.net', 'prophet')
+>>> preach('brian@isnomore.net', conn, 'cheesemakers')
+Traceback (most recent call last):
+  ...
+UnauthorizedAccessError: User does not have the role required by this resource
+
+
 
 Cleaning up:
 
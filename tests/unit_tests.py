@@ -1,20 +1,62 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import hmac
+import json
+import base64
+import hashlib
+import logging
+import time
+import shutil
+import smtplib
+import sqlite3
+import tempfile
+import threading
 import unittest
 import exceptions
+from multiprocessing.pool import MaybeEncodingError
 import mocker
 from mocker import expect
 
 from .. import users
 from .. import db
+from .. import clear_pending_users
+from .. import mailer
+from .. import attempts
+from .. import migrations
+from .. import hashers
+from .. import asynchronous
+from .. import tokens
+from .. import sharding
+from .. cache import TTLCache
+from .. config import options
 from .. users import (register_user, activate, authenticate, access_control,
                       registration_key, mkhash, Hash)
 from .. exceptions import (InvalidEmailError, InvalidPasswordError,
                            ProgrammingError, DatabaseError, InternalError,
                            InvalidRegistrationKeyError, AuthenticationError,
                            UnauthorizedAccessError, UnsupportedParamStyle,
-                           Error)
+                           PoolTimeoutError, HashingQueueFullError,
+                           InvalidTokenError, Error)
+
+
+def setUpModule():
+    # Hashing passwords at full cost would make the tests take minutes
+    options.pbkdf2_iterations = hashers.PBKDF2Hasher.min_cost
+
+
+class NoTransaction(object):
+    """Stands in for db.Connection.transaction() on mock connections."""
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        return False
+
+
+schema_file = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'schema.sql')
 
 
 class TestUserRegistration(mocker.MockerTestCase):
@@ -236,6 +278,649 @@ class TestDBConnection(mocker.MockerTestCase):
         conn.execute('something')
         
 
+class TestStatementCache(unittest.TestCase):
+    def connect(self, **kwargs):
+        conn = db.Connection(':memory:', driver=sqlite3, **kwargs)
+        conn.connect()
+        conn._cursor.executescript(open(schema_file).read())
+        return conn
+
+    def test_statement_cache_is_off_by_default(self):
+        conn = self.connect()
+        conn.get_user('someone@isnomore.net')
+        assert not conn._statements
+        assert 'cached_statements' not in conn._conn_kwargs
+
+    def test_statement_cache_size_is_passed_on_to_sqlite(self):
+        conn = db.Connection(':memory:', driver=sqlite3,
+                             statement_cache_size=10)
+        assert conn._conn_kwargs['cached_statements'] == 10
+        conn = db.Connection(':memory:', driver=sqlite3,
+                             statement_cache_size=10, cached_statements=50)
+        assert conn._conn_kwargs['cached_statements'] == 50
+
+    def test_each_query_keeps_its_own_cursor(self):
+        conn = self.connect(statement_cache_size=5)
+        conn.save_user('someone@isnomore.net', 'password')
+        assert conn.get_user('someone@isnomore.net')[0] == \
+            'someone@isnomore.net'
+        cursor = conn._statements['get_user']
+        assert cursor is not conn._cursor
+        conn.get_user_role('someone@isnomore.net')
+        conn.get_user('someone@isnomore.net')
+        assert conn._statements['get_user'] is cursor
+
+    def test_least_recently_used_cursors_are_evicted(self):
+        conn = self.connect(statement_cache_size=2)
+        conn.get_user('someone@isnomore.net')
+        conn.get_user_role('someone@isnomore.net')
+        conn.get_user('someone@isnomore.net')
+        conn.get_pending_user('someone@isnomore.net')
+        assert sorted(conn._statements) == ['get_pending_user', 'get_user']
+        conn.close()
+        assert not conn._statements
+
+
+class CountingConnection(sqlite3.Connection):
+    """sqlite3 connection counting its commits (and so, its fsyncs)."""
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.commits = 0
+
+    def commit(self):
+        self.commits += 1
+        return sqlite3.Connection.commit(self)
+
+
+class FakeDriver(object):
+    """DB-API driver whose connections, like psycopg2's, have an
+    isolation_level, and whose cursors record what they execute.
+    """
+    class connection(object):
+        isolation_level = 'read committed'
+        def __init__(self, *args, **kwargs):
+            self.executed = []
+        def cursor(self):
+            return FakeDriver.cursor(self.executed)
+        def commit(self): pass
+        def rollback(self): pass
+
+    class cursor(object):
+        def __init__(self, executed):
+            self.executed = executed
+        def execute(self, query, params=()):
+            self.executed.append(query)
+
+    @classmethod
+    def connect(cls, *args, **kwargs):
+        return cls.connection()
+
+
+class TestTransactions(unittest.TestCase):
+    def setUp(self):
+        self.conn = db.Connection(':memory:', driver=sqlite3,
+                                  factory=CountingConnection)
+        self.conn.connect()
+        self.conn._cursor.executescript(open(schema_file).read())
+        self.conn._conn.commits = 0
+
+    def emails(self):
+        return [r[0] for r in self.conn.execute(
+                'select email from users order by email').fetchall()]
+
+    def test_queries_outside_transactions_commit_immediately(self):
+        self.conn.save_user('a@isnomore.net', 'password')
+        self.conn.save_user('b@isnomore.net', 'password')
+        assert self.conn._conn.commits == 2
+
+    def test_transaction_commits_once_on_exit(self):
+        with self.conn.transaction():
+            self.conn.save_user('a@isnomore.net', 'password')
+            self.conn.save_user('b@isnomore.net', 'password')
+            assert self.conn._conn.commits == 0
+        assert self.conn._conn.commits == 1
+        assert self.emails() == ['a@isnomore.net', 'b@isnomore.net']
+
+    def test_transaction_rolls_back_on_exception(self):
+        try:
+            with self.conn.transaction():
+                self.conn.save_user('a@isnomore.net', 'password')
+                self.conn.save_user('a@isnomore.net', 'password')
+        except sqlite3.IntegrityError:
+            pass
+        else:
+            self.fail()
+        assert self.conn._conn.commits == 0
+        assert self.emails() == []
+
+    def test_nested_transactions_roll_back_to_savepoints(self):
+        with self.conn.transaction():
+            self.conn.save_user('a@isnomore.net', 'password')
+            try:
+                with self.conn.transaction():
+                    self.conn.save_user('b@isnomore.net', 'password')
+                    raise ValueError()
+            except ValueError:
+                pass
+            with self.conn.transaction():
+                self.conn.save_user('c@isnomore.net', 'password')
+        assert self.conn._conn.commits == 1
+        assert self.emails() == ['a@isnomore.net', 'c@isnomore.net']
+        assert self.conn._conn.isolation_level == ''
+
+    def test_registration_commits_once(self):
+        self.conn.save_pending_user('user@isnomore.net', 'password', 'key', 0)
+        self.conn._conn.commits = 0
+        users.register_user('user@isnomore.net', 'password', self.conn)
+        assert self.conn._conn.commits == 1
+
+    def test_activation_is_atomic(self):
+        key = users.register_user('user@isnomore.net', 'password', self.conn)
+        self.conn.execute("""create trigger keep_pending
+                             before delete on pending_users
+                             begin select raise(abort, 'kept'); end""")
+        self.assertRaises(sqlite3.IntegrityError, users.activate,
+                          key, self.conn)
+        assert self.emails() == []
+        assert self.conn.get_pending_user_by_key(key)
+
+    def test_transactions_begin_in_autocommit_mode(self):
+        conn = db.Connection(':memory:', driver=sqlite3, isolation_level=None)
+        conn.connect()
+        conn._cursor.executescript(open(schema_file).read())
+        try:
+            with conn.transaction():
+                conn.save_user('a@isnomore.net', 'password')
+                raise ValueError()
+        except ValueError:
+            pass
+        assert conn.get_user('a@isnomore.net') is None
+        assert conn._conn.isolation_level is None
+
+    def test_only_sqlite_transactions_begin_explicitly(self):
+        conn = db.Connection(':memory:', driver=FakeDriver)
+        conn.connect()
+        with conn.transaction():
+            pass
+        assert conn._conn.isolation_level == 'read committed'
+        assert conn._cursor.executed == []
+
+
+class TestExpiredPendingUsers(unittest.TestCase):
+    def setUp(self):
+        self.conn = db.Connection(':memory:', driver=sqlite3)
+        self.conn.connect()
+        self.conn._cursor.executescript(open(schema_file).read())
+        old = int(time.time()) - options.registration_expiration - 60
+        with self.conn.transaction():
+            for i in range(10):
+                self.conn.save_pending_user('old{0}@isnomore.net'.format(i),
+                                            'password', 'old{0}'.format(i),
+                                            old)
+            for i in range(5):
+                self.conn.save_pending_user('new{0}@isnomore.net'.format(i),
+                                            'password', 'new{0}'.format(i),
+                                            int(time.time()))
+
+    def remaining(self):
+        return self.conn.execute(
+            'select count(*) from pending_users').fetchall()[0][0]
+
+    def test_expired_users_are_deleted_at_once(self):
+        results = clear_pending_users.delete_expired_pending_users(self.conn)
+        assert results['deleted'] == 10
+        assert results['failed'] == []
+        assert results['elapsed'] >= 0
+        assert self.remaining() == 5
+
+    def test_expired_users_are_deleted_in_chunks(self):
+        sleeps = []
+        sleep = time.sleep
+        time.sleep = sleeps.append
+        try:
+            results = clear_pending_users.delete_expired_pending_users(
+                self.conn, chunk_size=3, pause=0.5)
+        finally:
+            time.sleep = sleep
+        assert results['deleted'] == 10
+        assert results['failed'] == []
+        assert sleeps == [0.5] * 3
+        assert self.remaining() == 5
+
+    def test_unknown_counts_are_not_added_up(self):
+        delete = self.conn.delete_some_pending_users_registered_before
+        def delete_without_rowcount(*params):
+            delete(*params)
+            return -1
+        self.conn.delete_some_pending_users_registered_before = \
+            delete_without_rowcount
+        results = clear_pending_users.delete_expired_pending_users(
+            self.conn, chunk_size=3, pause=0)
+        assert results['deleted'] == 0
+        assert results['failed'] == []
+        assert self.remaining() == 5
+
+    def test_failed_chunk_stops_deletion(self):
+        self.conn.execute("""create trigger keep_pending
+                             before delete on pending_users
+                             when old.email = 'old5@isnomore.net'
+                             begin select raise(abort, 'kept'); end""")
+        results = clear_pending_users.delete_expired_pending_users(
+            self.conn, chunk_size=4, pause=0)
+        assert results['deleted'] == 4
+        assert results['failed'] == [(1, ('kept',))]
+        assert self.remaining() == 11
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, 'pool.sqlite')
+        sqlite_conn = sqlite3.connect(self.db_file)
+        sqlite_conn.executescript(open(schema_file).read())
+        sqlite_conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def pool(self, **kwargs):
+        return db.ConnectionPool(self.db_file, driver=sqlite3,
+                                 check_same_thread=False, **kwargs)
+
+    def test_pool_opens_min_size_connections(self):
+        pool = self.pool(min_size=2)
+        stats = pool.stats()
+        assert stats['size'] == 2
+        assert stats['idle'] == 2
+        assert stats['checkouts'] == 0
+
+    def test_pool_reuses_checked_in_connections(self):
+        pool = self.pool(min_size=1, max_size=1)
+        conn = pool.checkout()
+        assert isinstance(conn, db.Connection)
+        pool.checkin(conn)
+        with pool.connection() as conn2:
+            assert conn2 is conn
+            assert pool.stats()['in_use'] == 1
+        assert pool.stats()['in_use'] == 0
+        assert pool.stats()['checkouts'] == 2
+
+    def test_pool_raises_after_wait_timeout(self):
+        pool = self.pool(min_size=0, max_size=1, wait_timeout=0.01)
+        conn = pool.checkout()
+        self.assertRaises(PoolTimeoutError, pool.checkout)
+        stats = pool.stats()
+        assert stats['waits'] == 1
+        assert stats['timeouts'] == 1
+        pool.checkin(conn)
+        pool.checkin(pool.checkout())
+
+    def test_overflow_connections_are_closed_on_checkin(self):
+        pool = self.pool(min_size=0, max_size=1, max_overflow=1,
+                         wait_timeout=0)
+        conn1 = pool.checkout()
+        conn2 = pool.checkout()
+        self.assertRaises(PoolTimeoutError, pool.checkout)
+        assert pool.stats()['size'] == 2
+        pool.checkin(conn2)
+        assert pool.stats()['size'] == 1
+        assert conn2._conn is None
+        pool.checkin(conn1)
+        assert pool.stats()['idle'] == 1
+
+    def test_idle_connections_above_min_size_expire(self):
+        pool = self.pool(min_size=1, max_size=3, idle_timeout=0.01)
+        conns = [pool.checkout() for i in range(3)]
+        for conn in conns:
+            pool.checkin(conn)
+        assert pool.stats()['size'] == 3
+        time.sleep(0.02)
+        with pool.connection():
+            assert pool.stats()['size'] == 1
+
+    def test_pre_ping_replaces_dead_connections(self):
+        pool = self.pool(min_size=1, max_size=1, pre_ping=True)
+        conn = pool.checkout()
+        conn._conn.close()
+        pool.checkin(conn)
+        with pool.connection() as new_conn:
+            assert new_conn is not conn
+            assert new_conn.ping()
+        assert pool.stats()['size'] == 1
+
+    def test_borrow_checks_out_from_pools_only(self):
+        pool = self.pool(min_size=1, max_size=1)
+        with db.borrow(pool) as conn:
+            assert isinstance(conn, db.Connection)
+            assert pool.stats()['in_use'] == 1
+        assert pool.stats()['in_use'] == 0
+        conn = db.Connection()
+        with db.borrow(conn) as borrowed:
+            assert borrowed is conn
+
+    def test_pool_under_concurrent_load(self):
+        pool = self.pool(min_size=2, max_size=4, max_overflow=2)
+        threads, per_thread = 16, 50
+        errors = []
+        in_use = []
+
+        key = users.register_user('user@isnomore.net', 'secret', pool)
+        users.activate(key, pool)
+
+        def worker():
+            try:
+                for i in xrange(per_thread):
+                    with pool.connection() as conn:
+                        in_use.append(pool.stats()['in_use'])
+                        assert conn.get_user('user@isnomore.net')
+                    users.authenticate('user@isnomore.net', 'secret', pool)
+            except Exception, e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=worker) for i in xrange(threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        assert errors == [], errors
+        stats = pool.stats()
+        assert stats['checkouts'] == 2 + 2 * threads * per_thread
+        assert max(in_use) <= 6
+        assert stats['size'] <= 4
+        assert stats['in_use'] == 0
+        assert sum(stats['wait_times'].values()) == stats['waits']
+
+
+class TestSMTPSession(mocker.MockerTestCase):
+    def setUp(self):
+        self.mock_smtplib = self.mocker.replace('smtplib')
+        self.mock_smtp = self.mocker.mock()
+
+    def test_session_connects_once_for_several_messages(self):
+        expect(self.mock_smtplib.SMTP('server')).result(self.mock_smtp)
+        expect(self.mock_smtp.sendmail('from', mocker.ANY, 'msg')).count(3)
+        self.mock_smtp.quit()
+        self.mocker.replay()
+
+        session = mailer.SMTPSession('server', max_messages=None)
+        for email in ['a@isnomore.net', 'b@isnomore.net', 'c@isnomore.net']:
+            session.sendmail('from', email, 'msg')
+        session.quit()
+        session.quit()
+
+    def test_session_reconnects_after_max_messages(self):
+        expect(self.mock_smtplib.SMTP('server')).result(
+            self.mock_smtp).count(2)
+        expect(self.mock_smtp.sendmail('from', mocker.ANY, 'msg')).count(3)
+        expect(self.mock_smtp.quit()).count(2)
+        self.mocker.replay()
+
+        session = mailer.SMTPSession('server', max_messages=2)
+        for email in ['a@isnomore.net', 'b@isnomore.net', 'c@isnomore.net']:
+            session.sendmail('from', email, 'msg')
+        session.quit()
+
+    def test_session_reconnects_when_server_disconnects(self):
+        expect(self.mock_smtplib.SMTP('server')).result(
+            self.mock_smtp).count(2)
+        self.mock_smtp.sendmail('from', 'a@isnomore.net', 'msg')
+        self.mocker.throw(mailer.SMTPServerDisconnected)
+        self.mock_smtp.sendmail('from', 'a@isnomore.net', 'msg')
+        self.mock_smtp.quit()
+        self.mocker.replay()
+
+        session = mailer.SMTPSession('server', max_messages=None)
+        session.sendmail('from', 'a@isnomore.net', 'msg')
+        session.quit()
+
+
+class TestMessageTemplate(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'template')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, body, mtime):
+        f = open(self.path, 'w')
+        f.write(body)
+        f.close()
+        os.utime(self.path, (mtime, mtime))
+
+    def assert_renders_as_email_module(self, template, email, key):
+        msg = template.message(email, key)
+        assert template.as_string(email, key) == msg.as_string()
+        return msg
+
+    def test_template_renders_key_in_payload(self):
+        body = 'Hi {{there}}!\nClick on /{registration_key}\n'
+        self.write(body, 1000)
+        template = mailer.MessageTemplate(self.path)
+        template.refresh()
+        msg = self.assert_renders_as_email_module(template,
+                                                  'user@isnomore.net', 'k3y')
+        assert msg.get_payload() == body.format(registration_key='k3y')
+        assert msg['to'] == 'user@isnomore.net'
+        assert msg['subject'] == options.reg_confirmation_subject
+
+    def test_template_with_format_specs_is_formatted(self):
+        body = '{registration_key:>6}\n{registration_key!r}'
+        self.write(body, 1000)
+        template = mailer.MessageTemplate(self.path)
+        template.refresh()
+        msg = self.assert_renders_as_email_module(template,
+                                                  'user@isnomore.net', 'k3y')
+        assert msg.get_payload() == body.format(registration_key='k3y')
+
+    def test_unusual_messages_are_rendered_as_email_module(self):
+        self.write('From {registration_key}\nFrom here on\n', 1000)
+        template = mailer.MessageTemplate(self.path)
+        template.refresh()
+        self.assert_renders_as_email_module(template, 'user@isnomore.net',
+                                            'k3y')
+        self.assert_renders_as_email_module(template,
+                                            'user' * 30 + '@isnomore.net',
+                                            'k3y')
+
+    def test_unicode_and_spaced_addresses_are_rendered_as_email_module(self):
+        self.write('Click on /{registration_key}\n', 1000)
+        template = mailer.MessageTemplate(self.path)
+        template.refresh()
+        for email in [u'user@isnomore.net', u'\xe9@isnomore.net',
+                      ' user@isnomore.net', 'user@isnomore.net ']:
+            self.assert_renders_as_email_module(template, email, u'k3y')
+            assert type(template.as_string(email, u'k3y')) is str
+
+    def test_template_is_only_read_again_if_modified(self):
+        self.write('first {registration_key}', 1000)
+        template = mailer.MessageTemplate(self.path)
+        template.refresh()
+        self.write('second {registration_key}', 1000)
+        template.refresh()
+        assert template.payload('key') == 'first key'
+        self.write('second {registration_key}', 2000)
+        template.refresh()
+        assert template.payload('key') == 'second key'
+
+    def test_headers_are_rendered_again_if_options_change(self):
+        self.write('{registration_key}', 1000)
+        template = mailer.MessageTemplate(self.path)
+        template.refresh()
+        subject = options.reg_confirmation_subject
+        try:
+            options.reg_confirmation_subject = 'Another subject'
+            msg = self.assert_renders_as_email_module(
+                template, 'user@isnomore.net', 'k3y')
+            assert msg['subject'] == 'Another subject'
+        finally:
+            options.reg_confirmation_subject = subject
+        msg = self.assert_renders_as_email_module(
+            template, 'user@isnomore.net', 'k3y')
+        assert msg['subject'] == subject
+
+    def test_confirmation_template_is_cached(self):
+        self.write('{registration_key}', 1000)
+        path = options.reg_confirmation_template
+        options.reg_confirmation_template = self.path
+        try:
+            template = mailer.confirmation_template()
+            assert mailer.confirmation_template() is template
+        finally:
+            options.reg_confirmation_template = path
+            mailer._templates.pop(self.path)
+
+
+class StubSMTPLib(object):
+    """Stands in for the smtplib module, as a local SMTP server recording
+    every message delivered. Delivery to the addresses in 'refused' fails,
+    and after 'crash_after' messages, KeyboardInterrupt is raised (as if
+    the mailer had been killed).
+    """
+    def __init__(self, refused=(), crash_after=None):
+        self.delivered = []
+        self.refused = refused
+        self.crash_after = crash_after
+        self.lock = threading.Lock()
+
+    def SMTP(self, server):
+        return StubSMTPConnection(self)
+
+
+class StubSMTPConnection(object):
+    def __init__(self, smtplib):
+        self.smtplib = smtplib
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        time.sleep(0.001)
+        if to_addrs in self.smtplib.refused:
+            raise smtplib.SMTPRecipientsRefused({to_addrs: 'refused'})
+        with self.smtplib.lock:
+            if len(self.smtplib.delivered) == self.smtplib.crash_after:
+                raise KeyboardInterrupt
+            self.smtplib.delivered.append(to_addrs)
+
+    def quit(self):
+        pass
+
+
+class TestMailerWorkers(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, 'mailer.sqlite')
+        self.emails = ['user{0}@isnomore.net'.format(i) for i in range(200)]
+        sqlite_conn = sqlite3.connect(self.db_file)
+        sqlite_conn.executescript(open(schema_file).read())
+        sqlite_conn.executemany(
+            """insert into pending_users
+               (email, password, registration_key, registration_date)
+               values (?, 'password', ?, 0)""",
+            [(email, 'key ' + email) for email in self.emails])
+        sqlite_conn.commit()
+        sqlite_conn.close()
+        self.template = options.reg_confirmation_template
+        options.reg_confirmation_template = os.path.join(
+            os.path.dirname(schema_file), 'reg_confirmation.template')
+        self.smtplib = mailer.smtplib
+
+    def tearDown(self):
+        mailer.smtplib = self.smtplib
+        options.reg_confirmation_template = self.template
+        shutil.rmtree(self.tmp_dir)
+
+    def connect(self):
+        conn = db.Connection(self.db_file, driver=sqlite3)
+        conn.connect()
+        return conn
+
+    def test_concurrent_workers_mail_each_user_exactly_once(self):
+        mailer.smtplib = stub = StubSMTPLib()
+        results = []
+        def worker(worker_id):
+            results.append(mailer.send_claimed_confirmations(
+                self.connect(), worker_id, threads=3, batch_size=7))
+        workers = [threading.Thread(target=worker,
+                                    args=('worker{0}'.format(i),))
+                   for i in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        assert sorted(stub.delivered) == sorted(self.emails)
+        assert sum(r['sent'] for r in results) == len(self.emails)
+        assert [r['failed'] for r in results] == [[]] * 4
+        assert self.connect().get_pending_users_unmailed() == []
+
+    def test_mailed_batches_are_marked_even_if_the_run_dies(self):
+        batch_size = options.mailer_batch_size
+        options.mailer_batch_size = 50
+        self.addCleanup(setattr, options, 'mailer_batch_size', batch_size)
+        conn = self.connect()
+        mailer.smtplib = stub = StubSMTPLib(crash_after=120)
+        self.assertRaises(KeyboardInterrupt,
+                          mailer.send_pending_confirmations, conn)
+        assert len(stub.delivered) == 120
+        unmailed = [email for email, key in conn.get_pending_users_unmailed()]
+        assert sorted(unmailed) == sorted(self.emails)[100:]
+
+        mailer.smtplib = stub = StubSMTPLib()
+        assert mailer.send_pending_confirmations(conn) == {'failed': []}
+        assert sorted(stub.delivered) == sorted(unmailed)
+        assert conn.get_pending_users_unmailed() == []
+
+    def test_failed_users_stay_claimed_until_claim_times_out(self):
+        mailer.smtplib = stub = StubSMTPLib(refused=['user42@isnomore.net'])
+        conn = self.connect()
+        results = mailer.send_claimed_confirmations(conn, 'worker',
+                                                    threads=2, batch_size=50)
+        assert results['sent'] == len(self.emails) - 1
+        assert results['failed'] == [('user42@isnomore.net',
+                                      ({'user42@isnomore.net': 'refused'},))]
+
+        results = mailer.send_claimed_confirmations(conn, 'worker',
+                                                    threads=2, batch_size=50)
+        assert results == {'failed': [], 'sent': 0}
+        assert conn.get_pending_users_unmailed() == [
+            ('user42@isnomore.net', 'key user42@isnomore.net')]
+
+        conn.execute('update pending_users set claimed_at = 0')
+        mailer.smtplib = stub = StubSMTPLib()
+        results = mailer.send_claimed_confirmations(conn, 'worker',
+                                                    threads=2, batch_size=50)
+        assert results == {'failed': [], 'sent': 1}
+        assert stub.delivered == ['user42@isnomore.net']
+
+    def test_template_is_fetched_once_per_batch(self):
+        mailer.smtplib = StubSMTPLib()
+        fetched = []
+        confirmation_template = mailer.confirmation_template
+        def counting_template():
+            fetched.append(None)
+            return confirmation_template()
+        mailer.confirmation_template = counting_template
+        self.addCleanup(setattr, mailer, 'confirmation_template',
+                        confirmation_template)
+        results = mailer.send_claimed_confirmations(self.connect(), 'worker',
+                                                    threads=3, batch_size=50)
+        assert results['sent'] == len(self.emails)
+        assert len(fetched) == len(self.emails) // 50
+
+    def test_workers_stop_when_drivers_dont_count_claimed_rows(self):
+        mailer.smtplib = stub = StubSMTPLib()
+        conn = self.connect()
+        claim = conn.claim_pending_users_unmailed
+        def claim_without_rowcount(*params):
+            claim(*params)
+            return -1
+        conn.claim_pending_users_unmailed = claim_without_rowcount
+        results = mailer.send_claimed_confirmations(conn, 'worker',
+                                                    threads=2, batch_size=50)
+        assert results['sent'] == len(self.emails)
+        assert sorted(stub.delivered) == sorted(self.emails)
+
+
 class TestDBQuery(unittest.TestCase):
     def test_db_query_is_equal_to_string_of_its_name(self):
         q = db.Query('some name', None, None)
@@ -265,18 +950,45 @@ class TestDBQueries(mocker.MockerTestCase):
                                                         paramstyle='numeric')
         query_named = db.queries['set_user_role'].query('user', 'role',
                                                         paramstyle='named')
+        query_format = db.queries['set_user_role'].query('user', 'role',
+                                                        paramstyle='format')
+        query_pyformat = db.queries['set_user_role'].query(
+            'user', 'role', paramstyle='pyformat')
 
         assert query_qmark[0] == "update users set role = ? where email = ?"
         assert query_numeric[0] == "update users set role = :1 where email = :2"
         assert query_named[0] == "update users set role = :a where email = :b"
+        assert query_format[0] == "update users set role = %s where email = %s"
+        assert query_pyformat[0] == ("update users set role = %(a)s "
+                                     "where email = %(b)s")
 
         assert query_qmark[1] == ('role', 'user')
         assert query_numeric[1] == ('role', 'user')
         assert query_named[1] == {'a': 'role', 'b': 'user'}
+        assert query_format[1] == ('role', 'user')
+        assert query_pyformat[1] == {'a': 'role', 'b': 'user'}
+
+    def test_format_paramstyles_escape_literal_percent_signs(self):
+        q = db.Query('some name', None,
+                     "select email from users where email like '%@' || ?")
+        assert q.query('x', paramstyle='format')[0] == (
+            "select email from users where email like '%%@' || %s")
+        assert q.query('x', paramstyle='pyformat')[0] == (
+            "select email from users where email like '%%@' || %(a)s")
+        assert q.query('x', paramstyle='qmark')[0] == q._query
+
+    def test_db_queries_are_compiled_once_per_paramstyle(self):
+        q = db.Query('some name', None, "select ? from t where a = ?",
+                     param_order=[1, 0])
+        compiled = q.compile('named')
+        assert q.compile('named') is compiled
+        assert q.compile('numeric') is not compiled
+        assert q.query(1, 2, paramstyle='named')[1] == {'a': 2, 'b': 1}
+        assert q.query(1, 2, paramstyle='numeric')[1] == (2, 1)
 
     def test_db_queries_on_unsupported_paramstyle_raises(self):
         mock_driver = self.mocker.mock()
-        expect(mock_driver.paramstyle).result('pyformat').count(1, None)
+        expect(mock_driver.paramstyle).result('unknown').count(1, None)
         self.mocker.replay()
 
         conn = db.Connection(driver=mock_driver)
@@ -301,9 +1013,26 @@ class TestDBQueries(mocker.MockerTestCase):
         db.queries['get_meaning_of_life'] = db.Query('get_meaning_of_life',
                                                      'unique',
                                                      'select * from answer')
+        self.addCleanup(db.queries.pop, 'get_meaning_of_life')
         a = conn.get_meaning_of_life()
         assert a == 42
-        db.queries.pop('get_meaning_of_life')
+
+    def test_module_queries_are_connection_methods(self):
+        assert all(name in vars(db.Connection) for name in db.queries)
+        conn = db.Connection(':memory:', driver=sqlite3)
+        conn.connect()
+        conn._cursor.executescript(open(schema_file).read())
+        conn.save_user('someone@isnomore.net', 'password')
+        assert conn.get_user('someone@isnomore.net') == (
+            'someone@isnomore.net', 'password', 0, None)
+        assert conn.get_user('nobody@isnomore.net') is None
+
+    def test_unsupported_return_type_raises(self):
+        db.queries['get_weird'] = db.Query('get_weird', 'weird', 'select 1')
+        self.addCleanup(db.queries.pop, 'get_weird')
+        conn = db.Connection(':memory:', driver=sqlite3)
+        conn.connect()
+        self.assertRaises(db.UnsupportedQueryReturnType, conn.get_weird)
 
 
 class TestUserActivation(mocker.MockerTestCase):
@@ -313,6 +1042,7 @@ class TestUserActivation(mocker.MockerTestCase):
 
     def test_activate_with_non_existent_key_raises(self):
         mock_conn = self.mocker.mock()
+        expect(mock_conn.transaction()).result(NoTransaction())
         expect(mock_conn.get_pending_user_by_key(mocker.ANY)).result([])
         self.mocker.replay()
 
@@ -321,6 +1051,7 @@ class TestUserActivation(mocker.MockerTestCase):
 
     def test_activate_inserts_into_table_users_removes_from_pending(self):
         mock_conn = self.mocker.mock()
+        expect(mock_conn.transaction()).result(NoTransaction())
         mock_conn.get_pending_user_by_key('some key')
         self.mocker.result((u'user@isnomore.net', 'hashed password'))
         mock_conn.save_user(u'user@isnomore.net', 'hashed password')
@@ -331,6 +1062,9 @@ class TestUserActivation(mocker.MockerTestCase):
 
 
 class TestUserAuthentication(mocker.MockerTestCase):
+    def setUp(self):
+        users._suspensions.clear()
+
     def test_authenticate_non_existent_email_raises(self):
         mock_conn = self.mocker.mock()
         expect(mock_conn.get_user('someone@isnomore.net')).result(None)
@@ -339,8 +1073,22 @@ class TestUserAuthentication(mocker.MockerTestCase):
         self.assertRaises(AuthenticationError, authenticate,
                           'someone@isnomore.net', 'password', mock_conn)
 
+    def test_authenticate_non_existent_email_verifies_dummy_password(self):
+        mock_conn = self.mocker.mock()
+        expect(mock_conn.get_user('someone@isnomore.net')).result(None)
+        mock_verify = self.mocker.replace(users.verify_password)
+        expect(mock_verify('password', mocker.ANY)).passthrough()
+        self.mocker.replay()
+
+        self.assertRaises(AuthenticationError, authenticate,
+                          'someone@isnomore.net', 'password', mock_conn)
+        hasher = hashers.default_hasher()
+        dummy = users._dummy_passwords[(hasher.algorithm, hasher.params())]
+        assert not hasher.needs_rehash(dummy)
+
     def test_authenticate_wrong_password_raises(self):
         mock_conn = self.mocker.mock()
+        expect(mock_conn.transaction()).result(NoTransaction())
         mock_conn.get_user('someone@isnomore.net')
         hashed = users.mkhash('correct password')
         self.mocker.result(['someone@isnomore.net', hashed,
@@ -353,6 +1101,7 @@ class TestUserAuthentication(mocker.MockerTestCase):
 
     def test_authenticate_wrong_email_raises(self):
         mock_conn = self.mocker.mock()
+        expect(mock_conn.transaction()).result(NoTransaction())
         mock_conn.get_user('someone@isnomore.net')
         hashed_password = users.mkhash('a password')
         self.mocker.result(['someone_else@isnomore.net', hashed_password,
@@ -366,19 +1115,243 @@ class TestUserAuthentication(mocker.MockerTestCase):
     def test_authenticate_password_with_salted_hash(self):
         hashed = users.mkhash('password')
         mock_conn = self.mocker.mock()
+        expect(mock_conn.transaction()).result(NoTransaction())
         mock_mkhash = self.mocker.replace(users.mkhash)
         mock_conn.get_user('someone@isnomore.net')
         self.mocker.result(['someone@isnomore.net', hashed, 0, None])
         expect(mock_mkhash('password', salt=hashed.salt)).passthrough()
+        mock_conn.set_user_password('someone@isnomore.net', mocker.ANY)
         self.mocker.replay()
 
         assert authenticate('someone@isnomore.net', 'password', mock_conn)
 
+    def test_authenticate_hashes_outside_transactions(self):
+        conn = db.Connection(':memory:', driver=sqlite3)
+        conn.connect()
+        conn._cursor.executescript(open(schema_file).read())
+        cheap = hashers.PBKDF2Hasher(options.pbkdf2_iterations - 1)
+        conn.save_user('someone@isnomore.net', cheap.encode('password'))
+        depths = []
+        def verify(password, db_password):
+            depths.append(conn._transaction_depth)
+            return hashers.verify_password(password, db_password)
+        def rehash(password):
+            depths.append(conn._transaction_depth)
+            return hashers.make_password(password)
+        mock_verify = self.mocker.replace(users.verify_password)
+        expect(mock_verify('password', mocker.ANY)).call(verify)
+        mock_rehash = self.mocker.replace(users.hash_password)
+        expect(mock_rehash('password')).call(rehash)
+        self.mocker.replay()
+
+        assert authenticate('someone@isnomore.net', 'password', conn)
+        assert depths == [0, 0]
+        assert not hashers.needs_rehash(
+            conn.get_user('someone@isnomore.net')[1])
+
+    def test_authenticate_with_tracker_only_writes_suspension(self):
+        options.attempt_tracker = attempts.MemoryAttemptTracker()
+        self.addCleanup(setattr, options, 'attempt_tracker', None)
+        hashed = users.mkhash('correct password')
+        mock_conn = self.mocker.mock()
+        expect(mock_conn.transaction()).result(NoTransaction())
+        expect(mock_conn.get_user('someone@isnomore.net')).result(
+            ['someone@isnomore.net', hashed, 0, None]).count(
+            options.failed_auth_limit)
+        mock_conn.suspend_user('someone@isnomore.net',
+                               options.failed_auth_limit, mocker.ANY)
+        self.mocker.replay()
+
+        for i in xrange(options.failed_auth_limit):
+            self.assertRaises(AuthenticationError, authenticate,
+                              'someone@isnomore.net', 'wrong', mock_conn)
+        assert options.attempt_tracker.get('someone@isnomore.net') == 0
+
+    def test_authenticate_with_tracker_opens_no_transaction_for_failures(self):
+        options.attempt_tracker = attempts.MemoryAttemptTracker()
+        self.addCleanup(setattr, options, 'attempt_tracker', None)
+        hashed = users.mkhash('correct password')
+        mock_conn = self.mocker.mock()
+        expect(mock_conn.get_user('someone@isnomore.net')).result(
+            ['someone@isnomore.net', hashed, 0, None])
+        self.mocker.replay()
+
+        self.assertRaises(AuthenticationError, authenticate,
+                          'someone@isnomore.net', 'wrong', mock_conn)
+        assert options.attempt_tracker.get('someone@isnomore.net') == 1
+
+    def test_authenticate_with_tracker_resets_count(self):
+        options.attempt_tracker = attempts.MemoryAttemptTracker()
+        self.addCleanup(setattr, options, 'attempt_tracker', None)
+        options.attempt_tracker.increment('someone@isnomore.net')
+        hashed = users.mkhash('password')
+        mock_conn = self.mocker.mock()
+        expect(mock_conn.transaction()).result(NoTransaction())
+        expect(mock_conn.get_user('someone@isnomore.net')).result(
+            ['someone@isnomore.net', hashed, 0, None])
+        mock_conn.set_user_password('someone@isnomore.net', mocker.ANY)
+        self.mocker.replay()
+
+        assert authenticate('someone@isnomore.net', 'password', mock_conn)
+        assert options.attempt_tracker.get('someone@isnomore.net') == 0
+
+    def test_suspended_user_is_rejected_without_database(self):
+        hashed = users.mkhash('password')
+        now = time.time()
+        mock_conn = self.mocker.mock()
+        expect(mock_conn.transaction()).result(NoTransaction())
+        expect(mock_conn.get_user('someone@isnomore.net')).result(
+            ['someone@isnomore.net', hashed, 3, now + 60])
+        mock_conn.set_failed_login_attempts('someone@isnomore.net', 4)
+        self.mocker.replay()
+
+        for i in xrange(3):
+            self.assertRaises(AuthenticationError, authenticate,
+                              'someone@isnomore.net', 'password', mock_conn)
+
+    def test_suspended_user_rejection_verifies_dummy_password(self):
+        users._suspensions.set('someone@isnomore.net', time.time() + 60)
+        mock_conn = self.mocker.mock()
+        mock_verify = self.mocker.replace(users.verify_password)
+        expect(mock_verify('password', mocker.ANY)).passthrough()
+        self.mocker.replay()
+
+        self.assertRaises(AuthenticationError, authenticate,
+                          'someone@isnomore.net', 'password', mock_conn)
+
+    def test_lifting_a_suspension_forgets_it(self):
+        conn = db.Connection(':memory:', driver=sqlite3)
+        conn.connect()
+        conn._cursor.executescript(open(schema_file).read())
+        conn.save_user('someone@isnomore.net',
+                       hashers.make_password('password'))
+        conn.suspend_user('someone@isnomore.net', 3, time.time() + 60)
+        self.assertRaises(AuthenticationError, authenticate,
+                          'someone@isnomore.net', 'password', conn)
+        assert users._suspensions.get('someone@isnomore.net') is not None
+        conn.lift_user_suspension('someone@isnomore.net')
+        assert authenticate('someone@isnomore.net', 'password', conn)
+
+    def test_suspension_is_remembered_when_suspending(self):
+        hashed = users.mkhash('password')
+        mock_conn = self.mocker.mock()
+        expect(mock_conn.transaction()).result(NoTransaction())
+        expect(mock_conn.get_user('someone@isnomore.net')).result(
+            ['someone@isnomore.net', hashed, options.failed_auth_limit - 1,
+             None])
+        mock_conn.suspend_user('someone@isnomore.net',
+                               options.failed_auth_limit, mocker.ANY)
+        self.mocker.replay()
+
+        self.assertRaises(AuthenticationError, authenticate,
+                          'someone@isnomore.net', 'wrong', mock_conn)
+        self.assertRaises(AuthenticationError, authenticate,
+                          'someone@isnomore.net', 'password', mock_conn)
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_entries_expire(self):
+        cache = TTLCache(ttl=10)
+        cache.set('a', 1, now=100)
+        cache.set('b', 2, expires=105, now=100)
+        assert cache.get('a', now=109) == 1
+        assert cache.get('b', now=105) is None
+        assert cache.get('a', 'gone', now=110) == 'gone'
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = TTLCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert len(cache) == 2
+        assert cache.get('b') is None
+        assert (cache.get('a'), cache.get('c')) == (1, 3)
+
+    def test_increment_restarts_after_expiry(self):
+        cache = TTLCache(ttl=10)
+        assert cache.increment('a', now=100) == 1
+        assert cache.increment('a', now=105) == 2
+        assert cache.increment('a', now=114) == 3
+        assert cache.increment('a', now=124) == 1
+
+
+class FakeRedis(object):
+    """The few redis.StrictRedis methods used by RedisAttemptTracker."""
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+    def incr(self, key):
+        self.data[key] = self.data.get(key, 0) + 1
+        return self.data[key]
+    def expire(self, key, ttl):
+        self.ttls[key] = ttl
+    def get(self, key):
+        return self.data.get(key)
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class TestAttemptTrackers(unittest.TestCase):
+    def check_tracker(self, tracker):
+        assert tracker.get('a@isnomore.net', now=100) == 0
+        assert tracker.increment('a@isnomore.net', now=100) == 1
+        assert tracker.increment('a@isnomore.net', now=101) == 2
+        assert tracker.get('a@isnomore.net', now=102) == 2
+        assert tracker.get('b@isnomore.net', now=102) == 0
+        tracker.reset('a@isnomore.net')
+        tracker.reset('b@isnomore.net')
+        assert tracker.get('a@isnomore.net', now=103) == 0
+
+    def test_memory_tracker(self):
+        tracker = attempts.MemoryAttemptTracker(ttl=60)
+        self.check_tracker(tracker)
+        tracker.increment('a@isnomore.net', now=100)
+        assert tracker.get('a@isnomore.net', now=160) == 0
+
+    def test_file_tracker_is_shared(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'attempts')
+        self.check_tracker(attempts.FileAttemptTracker(path, ttl=60))
+        attempts.FileAttemptTracker(path, ttl=60).increment('a@isnomore.net',
+                                                            now=100)
+        other = attempts.FileAttemptTracker(path, ttl=60)
+        assert other.get('a@isnomore.net', now=159) == 1
+        assert other.get('a@isnomore.net', now=160) == 0
+
+    def test_file_tracker_purges_expired_counts(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'attempts')
+        tracker = attempts.FileAttemptTracker(path, ttl=60, purge_interval=10)
+        tracker.increment('a@isnomore.net', now=100)
+        tracker.increment('b@isnomore.net', now=105)
+        tracker.increment('b@isnomore.net', now=170)
+        rows = tracker._conn().execute(
+            'select email, count from attempt_counts').fetchall()
+        assert rows == [(u'b@isnomore.net', 1)]
+
+    def test_incomplete_trackers_cannot_be_created(self):
+        class NoReset(attempts.AttemptTracker):
+            def get(self, email, now=None): return 0
+            def increment(self, email, now=None): return 1
+        self.assertRaises(TypeError, NoReset)
+
+    def test_redis_tracker(self):
+        client = FakeRedis()
+        self.check_tracker(attempts.RedisAttemptTracker(client, ttl=60))
+        attempts.RedisAttemptTracker(client, ttl=60).increment('c@isnomore.net')
+        assert client.ttls['auth:failed:c@isnomore.net'] == 60
+
 
 class TestAccessControl(mocker.MockerTestCase):
+    def setUp(self):
+        users._roles.clear()
+
     def test_access_control_with_invalid_email_fails(self):
         mock_conn = self.mocker.mock()
-        expect(mock_conn.get_user('someone@isnomore.net')).result(None)
+        expect(mock_conn.get_user_access('someone@isnomore.net')).result(None)
         self.mocker.replay()
 
         @access_control('a role')
@@ -389,10 +1362,8 @@ class TestAccessControl(mocker.MockerTestCase):
 
     def test_access_control_for_valid_user_with_wrong_role_fails(self):
         mock_conn = self.mocker.mock()
-        mock_conn.get_user('someone@isnomore.net')
-        self.mocker.result(['someone@isnomore.net', 'password', 0, None])
-        mock_conn.get_user_role('someone@isnomore.net')
-        self.mocker.result('some role')
+        mock_conn.get_user_access('someone@isnomore.net')
+        self.mocker.result(['someone@isnomore.net', 'some role'])
         self.mocker.replay()
 
         @access_control('another role')
@@ -403,10 +1374,8 @@ class TestAccessControl(mocker.MockerTestCase):
         
     def test_access_control_valid_credentials_and_role_return_function(self):
         mock_conn = self.mocker.mock()
-        mock_conn.get_user('someone@isnomore.net')
-        self.mocker.result(['someone@isnomore.net', 'password', 0, None])
-        mock_conn.get_user_role('someone@isnomore.net')
-        self.mocker.result('a role')
+        mock_conn.get_user_access('someone@isnomore.net')
+        self.mocker.result(['someone@isnomore.net', 'a role'])
         self.mocker.replay()
 
         @access_control('a role')
@@ -416,12 +1385,8 @@ class TestAccessControl(mocker.MockerTestCase):
 
     def test_access_control_passes_on_function_arguments(self):
         mock_conn = self.mocker.mock()
-        mock_conn.get_user('someone@isnomore.net')
-        self.mocker.result(['someone@isnomore.net', 'password', 0, None])
-        self.mocker.count(3)
-        mock_conn.get_user_role('someone@isnomore.net')
-        self.mocker.result('a role')
-        self.mocker.count(3)
+        mock_conn.get_user_access('someone@isnomore.net')
+        self.mocker.result(['someone@isnomore.net', 'a role'])
         self.mocker.replay()
 
         @access_control('a role')
@@ -439,3 +1404,832 @@ class TestAccessControl(mocker.MockerTestCase):
             return a + b + c + d
 
         assert baz('someone@isnomore.net', mock_conn, 5, 7, d=20) == 42
+
+    def test_roles_are_cached_until_set_user_role(self):
+        conn = db.Connection(':memory:', driver=sqlite3)
+        conn.connect()
+        conn._cursor.executescript(open(schema_file).read())
+        conn.save_user('someone@isnomore.net', 'password')
+        conn.set_user_role('someone@isnomore.net', 'a role')
+
+        @access_control('a role')
+        def foo(): return 42
+
+        assert foo('someone@isnomore.net', conn) == 42
+        conn._cursor.execute("update users set role = 'another role'")
+        assert foo('someone@isnomore.net', conn) == 42
+        conn.set_user_role('someone@isnomore.net', 'another role')
+        self.assertRaises(UnauthorizedAccessError,
+                          foo, 'someone@isnomore.net', conn)
+
+
+class TestTokens(unittest.TestCase):
+    def setUp(self):
+        saved = options.token_keys
+        options.token_keys = [('k2', 'new secret'), ('k1', 'old secret')]
+        self.addCleanup(setattr, options, 'token_keys', saved)
+
+    def test_tokens_carry_email_role_and_issue_time(self):
+        token = tokens.issue_token('someone@isnomore.net', 'a role', 1000)
+        assert token.startswith('k2.')
+        assert tokens.verify_token(token, 1001) == (
+            'someone@isnomore.net', 'a role', 1000)
+
+    def test_tampered_tokens_are_rejected(self):
+        token = tokens.issue_token('someone@isnomore.net', 'a role', 1000)
+        key_id, payload, signature = token.split('.')
+        forged = base64.urlsafe_b64encode(
+            json.dumps(['someone@isnomore.net', 'admin', 1000]))
+        for bad in ['.'.join([key_id, forged, signature]),
+                    '.'.join(['k3', payload, signature]),
+                    '.'.join([key_id, payload, signature[::-1]]),
+                    token[:-1], 'garbage', u'\xe9.a.b']:
+            self.assertRaises(InvalidTokenError, tokens.verify_token, bad,
+                              1001)
+
+    def test_signatures_are_hmac_sha256(self):
+        for secret in ['a secret', 'x' * 64, 'y' * 100]:
+            for signed in ['', 'k1.payload']:
+                assert tokens._sign(secret, signed) == \
+                    base64.urlsafe_b64encode(
+                        hmac.new(secret, signed, hashlib.sha256).digest())
+
+    def test_tokens_expire(self):
+        token = tokens.issue_token('someone@isnomore.net', 'a role', 1000)
+        self.assertRaises(InvalidTokenError, tokens.verify_token, token,
+                          1000 + options.token_ttl)
+
+    def test_keys_can_be_rotated(self):
+        options.token_keys = [('k1', 'old secret')]
+        old = tokens.issue_token('someone@isnomore.net', 'a role', 1000)
+        options.token_keys = [('k2', 'new secret'), ('k1', 'old secret')]
+        assert tokens.verify_token(old, 1001)[0] == 'someone@isnomore.net'
+        new = tokens.issue_token('someone@isnomore.net', 'a role', 1000)
+        assert new.startswith('k2.')
+        options.token_keys = [('k2', 'new secret')]
+        self.assertRaises(InvalidTokenError, tokens.verify_token, old, 1001)
+        options.token_keys = []
+        self.assertRaises(ValueError, tokens.issue_token,
+                          'someone@isnomore.net', 'a role')
+
+    def test_authenticate_issues_tokens_for_access_control(self):
+        users._suspensions.clear()
+        conn = db.Connection(':memory:', driver=sqlite3)
+        conn.connect()
+        conn._cursor.executescript(open(schema_file).read())
+        conn.save_user('someone@isnomore.net',
+                       hashers.make_password('password'))
+        conn.set_user_role('someone@isnomore.net', 'a role')
+        token = authenticate('someone@isnomore.net', 'password', conn,
+                             issue_token=True)
+
+        @users.access_control_by_token('a role')
+        def foo(a, b=1): return a + b
+
+        @users.access_control_by_token('another role')
+        def bar(): return 42
+
+        conn.close()
+        assert foo(token, 40, b=2) == 42
+        self.assertRaises(UnauthorizedAccessError, bar, token)
+        self.assertRaises(InvalidTokenError, foo, token + 'x', 1)
+
+
+class TestRoleExpressions(unittest.TestCase):
+    def setUp(self):
+        users._role_sets.clear()
+        self.conn = db.Connection(':memory:', driver=sqlite3)
+        self.conn.connect()
+        self.conn._cursor.executescript(open(schema_file).read())
+        self.conn.save_user('someone@isnomore.net', 'password')
+        self.conn.add_user_role('someone@isnomore.net', 'editor')
+        self.conn.add_user_role('someone@isnomore.net', 'reviewer')
+
+    def allowed(self, expression, email='someone@isnomore.net'):
+        @users.access_control_by_roles(expression)
+        def foo(): return 42
+        try:
+            return foo(email, self.conn) == 42
+        except UnauthorizedAccessError:
+            return False
+
+    def test_role_sets(self):
+        assert users.role_set([]) == 0
+        assert users.role_set(['editor', None, 'editor']) == \
+            users.role_bit('editor')
+        assert users.role_bit('editor') != users.role_bit('reviewer')
+
+    def test_any_of(self):
+        assert self.allowed('editor')
+        assert self.allowed(users.any_of('admin', 'reviewer'))
+        assert not self.allowed(users.any_of('admin', 'owner'))
+
+    def test_all_of(self):
+        assert self.allowed(users.all_of('editor', 'reviewer'))
+        assert not self.allowed(users.all_of('editor', 'admin'))
+
+    def test_nested_expressions(self):
+        assert self.allowed(users.any_of(
+            'admin', users.all_of('editor', 'reviewer')))
+        assert not self.allowed(users.all_of(
+            'editor', users.any_of('admin', 'owner')))
+
+    def test_single_role_column_counts(self):
+        self.conn.set_user_role('someone@isnomore.net', 'admin')
+        assert self.allowed(users.all_of('admin', 'editor'))
+
+    def test_unknown_user_is_denied(self):
+        assert not self.allowed(users.any_of(), 'nobody@isnomore.net')
+        assert not self.allowed('editor', 'nobody@isnomore.net')
+
+    def test_role_changes_invalidate_cache(self):
+        assert not self.allowed('admin')
+        self.conn.add_user_role('someone@isnomore.net', 'admin')
+        assert self.allowed('admin')
+        self.conn.remove_user_role('someone@isnomore.net', 'admin')
+        assert not self.allowed('admin')
+
+
+class TestBulkImport(unittest.TestCase):
+    def setUp(self):
+        self.conn = db.Connection(':memory:', driver=sqlite3,
+                                  factory=CountingConnection)
+        self.conn.connect()
+        self.conn._cursor.executescript(open(schema_file).read())
+        self.conn._conn.commits = 0
+
+    def rows(self):
+        return self.conn._cursor.execute(
+            'select email, password, role from users order by email'
+        ).fetchall()
+
+    def test_users_are_imported_in_chunks(self):
+        users_ = (('user{0}@isnomore.net'.format(i), 'secret', 'role')
+                  for i in xrange(25))
+        results = users.bulk_import_users(users_, self.conn, chunk_size=10,
+                                          processes=0)
+        assert results['imported'] == 25
+        assert results['failed'] == []
+        assert self.conn._conn.commits == 3
+        rows = self.rows()
+        assert len(rows) == 25
+        email, password, role = rows[0]
+        assert role == 'role'
+        assert users.verify_password('secret', password)
+
+    def test_hashed_passwords_are_stored_as_they_are(self):
+        hashed = mkhash('secret')
+        users.bulk_import_users([('a@isnomore.net', hashed, None)],
+                                self.conn, processes=0)
+        assert self.rows() == [('a@isnomore.net', hashed, None)]
+
+    def test_failed_rows_are_reported(self):
+        self.conn.save_user('taken@isnomore.net', 'password')
+        users_ = [('a@isnomore.net', 'secret', None),
+                  ('not an email', 'secret', None),
+                  ('b@isnomore.net', '', None),
+                  ('taken@isnomore.net', 'secret', None),
+                  ('c@isnomore.net', 'secret', None)]
+        results = users.bulk_import_users(users_, self.conn, chunk_size=2,
+                                          processes=0)
+        assert results['imported'] == 2
+        assert [f[:2] for f in results['failed']] == [
+            (1, 'not an email'), (2, 'b@isnomore.net'),
+            (3, 'taken@isnomore.net')]
+        assert [r[0] for r in self.rows()] == [
+            'a@isnomore.net', 'c@isnomore.net', 'taken@isnomore.net']
+
+    def test_malformed_rows_are_reported(self):
+        users_ = [('a@isnomore.net', 'secret', None),
+                  ('b@isnomore.net', 'secret'),
+                  ('c@isnomore.net', 'secret', None)]
+        results = users.bulk_import_users(users_, self.conn, chunk_size=2,
+                                          processes=0)
+        assert results['imported'] == 2
+        assert [f[:2] for f in results['failed']] == [(1, None)]
+        assert [r[0] for r in self.rows()] == [
+            'a@isnomore.net', 'c@isnomore.net']
+
+    def test_users_are_hashed_by_process_pool(self):
+        users_ = [('user{0}@isnomore.net'.format(i), 'secret', None)
+                  for i in xrange(50)]
+        results = users.bulk_import_users(users_, self.conn, chunk_size=5,
+                                          processes=2)
+        assert results['imported'] == 50
+        assert all(users.verify_password('secret', password)
+                   for e, password, r in self.rows())
+
+
+class TestQueryStats(unittest.TestCase):
+    def connection(self, **kwargs):
+        conn = db.Connection(':memory:', driver=sqlite3, **kwargs)
+        conn.connect()
+        conn._cursor.executescript(open(schema_file).read())
+        return conn
+
+    def test_queries_are_not_measured_by_default(self):
+        conn = self.connection()
+        conn.save_user('someone@isnomore.net', 'password')
+        assert conn.stats() == {}
+        assert '_execute_query' not in vars(conn)
+
+    def test_queries_are_counted(self):
+        conn = self.connection(query_stats=True)
+        conn.save_user('someone@isnomore.net', 'password')
+        conn.get_user('someone@isnomore.net')
+        conn.get_user('nobody@isnomore.net')
+        self.assertRaises(sqlite3.IntegrityError, conn.save_user,
+                          'someone@isnomore.net', 'password')
+        conn.many.save_user([('a@isnomore.net', 'password'),
+                             ('b@isnomore.net', 'password')])
+        conn.many.lift_user_suspension([('a@isnomore.net',),
+                                        ('b@isnomore.net',)])
+        stats = conn.stats()
+        assert stats['get_user']['calls'] == 2
+        assert stats['get_user']['rows'] == 1
+        assert stats['get_user']['errors'] == 0
+        assert stats['save_user']['calls'] == 3
+        assert stats['save_user']['errors'] == 1
+        assert stats['lift_user_suspension']['calls'] == 1
+        assert sum(stats['get_user']['latencies'].values()) == 2
+        assert stats['get_user']['p50'] is not None
+
+    def test_percentiles_are_bucket_bounds(self):
+        stats = db.QueryStats()
+        for i in xrange(98):
+            stats.record('q', 0.00005)
+        stats.record('q', 0.03)
+        stats.record('q', 60)
+        snapshot = stats.snapshot()['q']
+        assert snapshot['p50'] == stats.latency_buckets[0]
+        assert snapshot['p95'] == stats.latency_buckets[0]
+        assert snapshot['p99'] == stats.latency_buckets[9]
+        assert snapshot['max_time'] == 60
+        assert snapshot['latencies'][None] == 1
+
+    def test_stats_can_be_shared(self):
+        stats = db.QueryStats()
+        for conn in (self.connection(query_stats=stats),
+                     self.connection(query_stats=stats)):
+            conn.get_user('someone@isnomore.net')
+        assert stats.snapshot()['get_user']['calls'] == 2
+        stats.clear()
+        assert stats.snapshot() == {}
+
+    def test_slow_queries_are_logged_redacted(self):
+        logged = []
+        conn = self.connection(slow_query_time=0,
+                               slow_query_sink=lambda *args:
+                                   logged.append(args))
+        conn.save_user('someone@isnomore.net', 'password')
+        conn.many.save_user([('a@isnomore.net', 'password')])
+        assert [(name, params) for name, elapsed, params in logged] == [
+            ('save_user', ('<str>', '<str>')), ('save_user', ('<1 rows>',))]
+        assert conn.stats() == {}
+
+
+class NamedSqlite(object):
+    """sqlite3, claiming the named paramstyle (which it also supports)."""
+    paramstyle = 'named'
+    connect = staticmethod(sqlite3.connect)
+
+
+class TestBatchQueries(unittest.TestCase):
+    def connection(self, driver=sqlite3):
+        conn = db.Connection(':memory:', driver=driver)
+        conn.connect()
+        conn._cursor.executescript(open(schema_file).read())
+        conn.many.save_user([('user{0}@isnomore.net'.format(i), 'password')
+                             for i in xrange(5)])
+        return conn
+
+    def test_params_are_reordered_for_each_row(self):
+        for driver in [sqlite3, NamedSqlite]:
+            conn = self.connection(driver)
+            conn.many.set_failed_login_attempts(
+                [('user1@isnomore.net', 1), ('user3@isnomore.net', 3)])
+            assert conn._cursor.execute(
+                'select email, failed_login_attempts from users '
+                'where failed_login_attempts > 0 order by email'
+            ).fetchall() == [('user1@isnomore.net', 1),
+                             ('user3@isnomore.net', 3)]
+
+    def test_rowcount_queries_return_affected_rows(self):
+        conn = self.connection()
+        assert conn.many.delete_pending_users_registered_before([]) == 0
+        conn._cursor.execute(
+            "insert into pending_users (email, password, registration_date)"
+            " values ('a@isnomore.net', 'password', 10)")
+        assert conn.many.delete_pending_users_registered_before(
+            [(20,), (30,)]) == 1
+
+    def test_hooks_are_called_for_each_row(self):
+        conn = self.connection()
+        called = []
+        db.add_query_hook('save_user', lambda *params: called.append(params))
+        self.addCleanup(db.query_hooks['save_user'].pop)
+        conn.many.save_user([('a@isnomore.net', 'x'), ('b@isnomore.net', 'y')])
+        assert called == [('a@isnomore.net', 'x'), ('b@isnomore.net', 'y')]
+
+    def test_hooks_wait_for_the_transaction_to_commit(self):
+        conn = self.connection()
+        called = []
+        db.add_query_hook('save_user', lambda *params: called.append(params))
+        self.addCleanup(db.query_hooks['save_user'].pop)
+        with conn.transaction():
+            conn.save_user('a@isnomore.net', 'x')
+            try:
+                with conn.transaction():
+                    conn.many.save_user([('b@isnomore.net', 'y')])
+                    raise ValueError
+            except ValueError:
+                pass
+            assert called == []
+        assert called == [('a@isnomore.net', 'x')]
+        try:
+            with conn.transaction():
+                conn.save_user('c@isnomore.net', 'z')
+                raise ValueError
+        except ValueError:
+            pass
+        assert called == [('a@isnomore.net', 'x')]
+
+    def test_row_returning_queries_are_not_supported(self):
+        conn = self.connection()
+        self.assertRaises(db.UnsupportedQueryReturnType,
+                          conn.many.get_user, [('user1@isnomore.net',)])
+        self.assertRaises(AttributeError, getattr, conn.many, 'nonexistent')
+
+
+class TestStreamingQueries(unittest.TestCase):
+    def setUp(self):
+        self.conn = db.Connection(':memory:', driver=sqlite3,
+                                  stream_arraysize=2)
+        self.conn.connect()
+        self.conn._cursor.executescript(open(schema_file).read())
+        self.conn.many.save_pending_user(
+            [('user{0}@isnomore.net'.format(i), 'password',
+              'key{0}'.format(i), i) for i in xrange(5)])
+
+    def test_rows_are_streamed(self):
+        rows = self.conn.stream.get_pending_users_unmailed()
+        assert not isinstance(rows, list)
+        assert sorted(rows) == sorted(
+            self.conn.get_pending_users_unmailed())
+
+    def test_one_column_queries_stream_values(self):
+        emails = self.conn.stream.get_pending_users_registered_before(3)
+        assert sorted(emails) == ['user0@isnomore.net', 'user1@isnomore.net',
+                                  'user2@isnomore.net']
+
+    def test_other_queries_can_run_while_streaming_in_transaction(self):
+        with self.conn.transaction():
+            seen = []
+            for email, key in self.conn.stream.get_pending_users_unmailed():
+                seen.append(email)
+                self.conn.set_pending_user_as_mailed(email)
+        assert len(seen) == 5
+        assert self.conn.get_pending_users_unmailed() == []
+
+    def test_only_row_returning_queries_can_be_streamed(self):
+        rows = self.conn.stream.get_user('user1@isnomore.net')
+        self.assertRaises(db.UnsupportedQueryReturnType, list, rows)
+        self.assertRaises(AttributeError, getattr, self.conn.stream, 'nope')
+
+
+# schema.sql as it was before migrations (schema version 1), verbatim
+schema_v1 = """
+CREATE TABLE pending_users (
+    email text PRIMARY KEY,
+    password text NOT NULL,
+    registration_key text KEY UNIQUE,
+    registration_date integer,
+    confirmation_sent integer DEFAULT 0
+);
+
+CREATE TABLE users (
+    email text PRIMARY KEY,
+    password text NOT NULL,
+    failed_login_attempts integer DEFAULT 0,
+    suspended_until integer,
+    role text
+);
+"""
+
+
+class TestMigrations(unittest.TestCase):
+    def connection(self, schema):
+        conn = db.Connection(':memory:', driver=sqlite3)
+        conn.connect()
+        conn._cursor.executescript(schema)
+        return conn
+
+    def indexes(self, conn):
+        return sorted(conn._cursor.execute(
+            """select name, tbl_name from sqlite_master where type = 'index'
+               and name not like 'sqlite_autoindex%'""").fetchall())
+
+    def test_schema_file_is_at_latest_version(self):
+        conn = self.connection(open(schema_file).read())
+        assert migrations.schema_version(conn) == migrations.migrations[-1][0]
+        assert migrations.migrate(conn) == []
+
+    def tables(self, conn):
+        # Columns as (name, type, not null, default, primary key), with
+        # only the type's first word ("text KEY" is still text)
+        names = [name for name, in conn._cursor.execute(
+            "select name from sqlite_master where type = 'table'")]
+        return dict((name, [(column[1], column[2].split()[0].lower())
+                            + column[3:]
+                            for column in conn._cursor.execute(
+                                'pragma table_info({0})'.format(name))])
+                    for name in names)
+
+    def test_migrating_version_1_matches_schema_file(self):
+        conn = self.connection(schema_v1)
+        assert migrations.schema_version(conn) == 1
+        assert migrations.migrate(conn) == [2]
+        assert migrations.schema_version(conn) == 2
+        assert migrations.migrate(conn) == []
+        latest = self.connection(open(schema_file).read())
+        assert self.tables(conn) == self.tables(latest)
+        assert self.indexes(conn) == self.indexes(latest)
+
+    def test_migrated_version_1_runs_all_queries(self):
+        conn = self.connection(schema_v1)
+        conn.save_pending_user('user@isnomore.net', 'password', 'key', 1)
+        migrations.migrate(conn)
+        assert conn.claim_pending_users_unmailed('worker', 2, 1, 10) == 1
+        assert conn.get_pending_users_claimed_by('worker') == \
+            [('user@isnomore.net', 'key')]
+        conn.save_user('user@isnomore.net', 'password')
+        conn.add_user_role('user@isnomore.net', 'role')
+        assert conn.get_user_roles('user@isnomore.net') == ['role']
+
+    def test_failed_migration_is_rolled_back(self):
+        conn = self.connection(schema_v1)
+        @migrations.migration(3)
+        def fail(conn):
+            conn.execute('create index nonsense on nothing (nothing)')
+        self.addCleanup(migrations.migrations.remove, (3, fail))
+        self.assertRaises(sqlite3.OperationalError, migrations.migrate, conn)
+        assert migrations.schema_version(conn) == 2
+        assert migrations.migrate(conn, target=2) == []
+
+
+class TestQueryPlans(unittest.TestCase):
+    def test_queries_use_indexes_on_sqlite(self):
+        conn = sqlite3.connect(':memory:')
+        conn.executescript(open(schema_file).read())
+        for name, query_obj in db.queries.items():
+            query, binder = query_obj.compile('qmark')
+            if (query.lstrip().startswith('insert') or
+                'schema_version' in query):
+                continue
+            params = binder(tuple(range(query.count('?'))))
+            for row in conn.execute('explain query plan ' + query, params):
+                detail = row[-1]
+                if detail.startswith(('SCAN', 'SEARCH')):
+                    assert 'USING' in detail, (name, detail)
+
+
+class TestHashers(unittest.TestCase):
+    def setUp(self):
+        self.hasher = hashers.PBKDF2Hasher(2000)
+
+    def test_encoded_passwords_carry_algorithm_cost_and_salt(self):
+        encoded = self.hasher.encode('secret')
+        algorithm, cost, salt, digest = encoded.split('$')
+        assert (algorithm, cost) == ('pbkdf2_sha256', '2000')
+        assert len(self.hasher.split(encoded)[1]) == 16
+        assert encoded != self.hasher.encode('secret')
+
+    def test_passwords_are_verified_with_their_own_cost(self):
+        encoded = self.hasher.encode(u'sécret')
+        assert hashers.PBKDF2Hasher(5000).verify(u'sécret', encoded)
+        assert hashers.verify_password(u'sécret', encoded)
+        assert not hashers.verify_password('secret', encoded)
+
+    def test_identify(self):
+        assert hashers.identify(mkhash('secret')) is None
+        assert hashers.identify('unknown$1$c2FsdA==$aGFzaA==') is None
+        assert isinstance(hashers.identify(self.hasher.encode('secret')),
+                          hashers.PBKDF2Hasher)
+
+    def test_legacy_and_cheaper_hashes_need_rehash(self):
+        assert hashers.needs_rehash(mkhash('secret'))
+        cheap = hashers.PBKDF2Hasher(options.pbkdf2_iterations - 1)
+        assert hashers.needs_rehash(cheap.encode('secret'))
+        assert not hashers.needs_rehash(hashers.make_password('secret'))
+
+    def test_users_verify_legacy_and_encoded_passwords(self):
+        assert users.verify_password('secret', mkhash('secret'))
+        assert not users.verify_password('wrong', mkhash('secret'))
+        assert users.verify_password('secret',
+                                     hashers.make_password('secret'))
+
+    def test_calibration_scales_cost_to_target(self):
+        cost, elapsed = hashers.calibrate(hashers.PBKDF2Hasher, 0.01)
+        assert cost >= hashers.PBKDF2Hasher.min_cost
+        assert elapsed < 0.1
+
+
+class TestHashingExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = hashers.HashingExecutor(processes=2, max_pending=2)
+        self.addCleanup(self.executor.close)
+
+    def test_hashes_are_made_and_verified_on_the_pool(self):
+        encoded = self.executor.make_password('secret')
+        assert hashers.verify_password('secret', encoded)
+        assert self.executor.verify_password('secret', encoded)
+        assert not self.executor.verify_password('wrong', encoded)
+
+    def test_exceptions_are_raised_by_results(self):
+        result = self.executor.submit(hashers.verify_password, 'a', 'b')
+        self.assertRaises(ValueError, result.get)
+        # The failed hash no longer counts as pending
+        assert self.executor.submit(hashers.make_password, 'a').get()
+
+    def test_unpicklable_tasks_no_longer_count_as_pending(self):
+        saved = options.hashing_queue_timeout
+        options.hashing_queue_timeout = 1
+        self.addCleanup(setattr, options, 'hashing_queue_timeout', saved)
+        for i in xrange(3):
+            # Locks can't be pickled, as arguments or as results
+            self.assertRaises(Exception, self.executor.submit,
+                              len, threading.Lock())
+            result = self.executor.submit(threading.Lock)
+            self.assertRaises(MaybeEncodingError, result.get, 5)
+        assert self.executor.submit(hashers.make_password, 'a').get(5)
+
+    def test_submitting_too_many_hashes_times_out(self):
+        saved = options.hashing_queue_timeout
+        options.hashing_queue_timeout = 0.05
+        self.addCleanup(setattr, options, 'hashing_queue_timeout', saved)
+        results = [self.executor.submit(time.sleep, 0.5) for i in xrange(2)]
+        self.assertRaises(HashingQueueFullError, self.executor.submit,
+                          time.sleep, 0)
+        for result in results:
+            result.get()
+        self.executor.submit(time.sleep, 0).get()
+
+    def test_users_hash_on_the_executor(self):
+        options.hashing_executor = self.executor
+        self.addCleanup(setattr, options, 'hashing_executor', None)
+        conn = db.Connection(':memory:', driver=sqlite3)
+        conn.connect()
+        conn._cursor.executescript(open(schema_file).read())
+        activate(register_user('a@isnomore.net', 'secret', conn), conn)
+        assert authenticate('a@isnomore.net', 'secret', conn)
+        results = users.bulk_import_users(
+            [('user{0}@isnomore.net'.format(i), 'secret', None)
+             for i in xrange(10)], conn, chunk_size=3)
+        assert results['imported'] == 10
+        assert authenticate('user9@isnomore.net', 'secret', conn)
+
+
+class TestFuture(unittest.TestCase):
+    def test_result_and_callbacks(self):
+        future = asynchronous.Future()
+        seen = []
+        future.add_done_callback(lambda f: seen.append(f.result()))
+        assert not future.done()
+        future.set_result(42)
+        assert future.done()
+        assert future.result() == 42
+        assert future.exception() is None
+        future.add_done_callback(lambda f: seen.append(f.result() + 1))
+        assert seen == [42, 43]
+
+    def test_exceptions_are_raised_by_result(self):
+        future = asynchronous.Future()
+        try:
+            raise AuthenticationError('nope')
+        except AuthenticationError:
+            future.set_exception(sys.exc_info())
+        assert isinstance(future.exception(), AuthenticationError)
+        self.assertRaises(AuthenticationError, future.result)
+
+    def test_waiting_times_out(self):
+        future = asynchronous.Future()
+        self.assertRaises(RuntimeError, future.result, 0.01)
+
+    def test_failing_callbacks_are_logged(self):
+        future = asynchronous.Future()
+        seen = []
+        def fail(f):
+            raise ValueError('callback failed')
+        future.add_done_callback(fail)
+        future.add_done_callback(lambda f: seen.append(f.result()))
+        logger = logging.getLogger(asynchronous.__name__)
+        logger.disabled = True
+        self.addCleanup(setattr, logger, 'disabled', False)
+        future.set_result(42)
+        future.add_done_callback(fail)
+        assert seen == [42]
+
+
+class TestAsyncConnection(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        db_file = os.path.join(self.tmp_dir, 'async.sqlite')
+        sqlite_conn = sqlite3.connect(db_file)
+        sqlite_conn.executescript(open(schema_file).read())
+        sqlite_conn.close()
+        self.pool = db.ConnectionPool(db_file, driver=sqlite3, max_size=4,
+                                      check_same_thread=False)
+        self.aconn = asynchronous.AsyncConnection(self.pool, workers=4)
+        self.addCleanup(self.pool.close)
+        self.addCleanup(self.aconn.close)
+        users._roles.clear()
+        users._suspensions.clear()
+
+    def test_failing_callbacks_dont_kill_workers(self):
+        logger = logging.getLogger(asynchronous.__name__)
+        logger.disabled = True
+        self.addCleanup(setattr, logger, 'disabled', False)
+        def fail(future):
+            raise ValueError('callback failed')
+        release = threading.Event()
+        futures = [self.aconn.submit(lambda conn: release.wait(5))
+                   for i in range(4)]
+        for future in futures:
+            future.add_done_callback(fail)
+        release.set()
+        assert [future.result(5) for future in futures] == [True] * 4
+        assert self.aconn.submit(lambda conn: 42).result(5) == 42
+
+    def test_queries_return_futures(self):
+        self.aconn.save_user('a@isnomore.net', 'password').result()
+        assert self.aconn.get_user('a@isnomore.net').result() == \
+            ('a@isnomore.net', 'password', 0, None)
+        self.assertRaises(AttributeError, getattr, self.aconn, 'no_query')
+
+    def test_register_activate_and_authenticate(self):
+        key = asynchronous.register_user('a@isnomore.net', 'secret',
+                                         self.aconn).result()
+        asynchronous.activate(key, self.aconn).result()
+        logins = [asynchronous.authenticate('a@isnomore.net', 'secret',
+                                            self.aconn) for i in xrange(20)]
+        assert all(login.result() for login in logins)
+        failed = asynchronous.authenticate('a@isnomore.net', 'wrong',
+                                           self.aconn)
+        self.assertRaises(AuthenticationError, failed.result)
+        # The workers took turns with the pool's connections
+        assert self.pool.stats()['size'] <= 4
+
+    def test_access_control(self):
+        with self.pool.connection() as conn:
+            conn.save_user('a@isnomore.net', 'password')
+            conn.set_user_role('a@isnomore.net', 'a role')
+
+        @asynchronous.access_control('a role')
+        def foo(a, b=1): return a + b
+
+        @asynchronous.access_control_by_roles(users.any_of('other role'))
+        def bar(): return 42
+
+        assert foo('a@isnomore.net', self.aconn, 41).result() == 42
+        assert foo('a@isnomore.net', self.aconn, 1, b=2).result() == 3
+        self.assertRaises(UnauthorizedAccessError,
+                          bar('a@isnomore.net', self.aconn).result)
+        self.assertRaises(UnauthorizedAccessError,
+                          foo('b@isnomore.net', self.aconn, 1).result)
+
+
+class TestShardedConnection(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        shards = []
+        for name in ('a', 'b', 'c'):
+            conn = db.Connection(os.path.join(self.tmp_dir, name + '.sqlite'),
+                                 driver=sqlite3)
+            conn.connect()
+            conn._cursor.executescript(open(schema_file).read())
+            shards.append((name, conn))
+        self.shards = [shard for name, shard in shards]
+        self.conn = sharding.ShardedConnection(shards)
+        self.addCleanup(self.conn.close)
+        self.emails = ['user{0}@isnomore.net'.format(i) for i in xrange(60)]
+        users._suspensions.clear()
+        users._roles.clear()
+
+    def emails_on(self, index):
+        return sorted(self.shards[index]._cursor.execute(
+            'select email from users').fetchall())
+
+    def test_ring_moves_few_users_when_adding_shards(self):
+        emails = ['user{0}@isnomore.net'.format(i) for i in xrange(3000)]
+        before = sharding.HashRing(['a', 'b', 'c'])
+        after = sharding.HashRing(['a', 'b', 'c', 'd'])
+        moved = [email for email in emails
+                 if before.shard(sharding.point(email)) !=
+                 after.shard(sharding.point(email))]
+        assert 0.15 < len(moved) / 3000.0 < 0.35
+        assert all(after.shard(sharding.point(email)) == 3
+                   for email in moved)
+
+    def test_users_are_stored_on_their_shard(self):
+        for email in self.emails:
+            self.conn.save_user(email, 'password')
+        for index in xrange(3):
+            on_shard = self.emails_on(index)
+            assert 5 < len(on_shard) < 40
+            assert all(self.conn.shard(email) == index
+                       for (email,) in on_shard)
+        assert self.conn.get_user(self.emails[0])[0] == self.emails[0]
+        assert self.conn.get_user('nobody@isnomore.net') is None
+
+    def test_users_functions_work_across_shards(self):
+        for email in self.emails[:10]:
+            key = register_user(email, 'secret', self.conn)
+            assert sharding.key_point(key) == sharding.point(email)
+            activate(key, self.conn)
+            assert authenticate(email, 'secret', self.conn)
+            self.conn.set_user_role(email, 'a role')
+
+        @access_control('a role')
+        def foo(): return 42
+
+        assert all(foo(email, self.conn) == 42 for email in self.emails[:10])
+        self.assertRaises(InvalidRegistrationKeyError, activate,
+                          '0' * 64, self.conn)
+
+    def test_keys_without_ring_points_are_found(self):
+        email = self.emails[0]
+        self.conn.save_pending_user(email, 'password', 'an old key', 0)
+        assert self.conn.get_pending_user_by_key('an old key')[0] == email
+        assert self.conn.get_pending_user_by_key('no such key') is None
+
+    def test_batch_scripts_fan_out(self):
+        rows = [(email, 'password', 'key ' + email, 0)
+                for email in self.emails]
+        self.conn.many.save_pending_user(rows)
+        unmailed = self.conn.get_pending_users_unmailed()
+        assert sorted(email for email, key in unmailed) == sorted(self.emails)
+
+        stub = StubSMTPLib()
+        saved = mailer.smtplib, options.reg_confirmation_template
+        mailer.smtplib = stub
+        options.reg_confirmation_template = os.path.join(
+            os.path.dirname(schema_file), 'reg_confirmation.template')
+        saved_batch_size = options.mailer_batch_size
+        options.mailer_batch_size = 7
+        try:
+            results = mailer.send_pending_confirmations(self.conn)
+        finally:
+            mailer.smtplib, options.reg_confirmation_template = saved
+            options.mailer_batch_size = saved_batch_size
+        assert results['failed'] == []
+        assert sorted(stub.delivered) == sorted(self.emails)
+        assert self.conn.get_pending_users_unmailed() == []
+
+        results = clear_pending_users.delete_expired_pending_users(
+            self.conn, chunk_size=7, pause=0)
+        assert results['deleted'] == len(self.emails)
+        assert self.conn.get_pending_users_registered_before(1) == []
+
+    def test_transactions_are_per_shard(self):
+        first = self.emails[0]
+        second = next(email for email in self.emails
+                      if self.conn.shard(email) != self.conn.shard(first))
+        try:
+            with self.conn.transaction():
+                self.conn.save_user(first, 'password')
+                with self.conn.transaction():
+                    self.conn.save_user(second, 'password')
+                raise ValueError()
+        except ValueError:
+            pass
+        assert self.conn.get_user(first) is None
+        assert self.conn.get_user(second) is None
+        with self.conn.transaction():
+            self.conn.save_user(first, 'password')
+            try:
+                with self.conn.transaction():
+                    self.conn.save_user(second, 'password')
+                    raise ValueError()
+            except ValueError:
+                pass
+        assert self.conn.get_user(first) is not None
+        assert self.conn.get_user(second) is None
+
+    def test_inner_transactions_roll_back_shards_used_before(self):
+        first = self.emails[0]
+        second = next(email for email in self.emails
+                      if self.conn.shard(email) == self.conn.shard(first)
+                      and email != first)
+        with self.conn.transaction():
+            with self.conn.transaction():
+                self.conn.save_user(first, 'password')
+            try:
+                with self.conn.transaction():
+                    self.conn.save_user(second, 'password')
+                    raise ValueError()
+            except ValueError:
+                pass
+        assert self.conn.get_user(first) is not None
+        assert self.conn.get_user(second) is None
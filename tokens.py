@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+Stateless session tokens.
+
+A token carries a user's email, role and the time it was issued, signed
+(HMAC-SHA256) with one of options.token_keys, so that it can be checked
+without going to the database. Tokens look like
+
+    <key id>.<base64 payload>.<base64 signature>
+
+the key id telling which key signed them. New tokens are signed with the
+first key in options.token_keys, and tokens signed by any of them are
+accepted, so keys can be rotated by adding a new one at the front, and
+dropping the old one once its tokens have expired (options.token_ttl
+seconds after they were issued).
+
+
+rbp@isnomore.net
+"""
+
+
+import hmac
+import json
+import time
+import base64
+from hashlib import sha256
+
+from . config import options
+from . exceptions import InvalidTokenError
+
+
+def _keys():
+    """Returns the key id and secret signing new tokens, and the secrets
+    of all accepted keys by id.
+    """
+    keys = options.token_keys
+    if not keys:
+        raise ValueError('No token keys configured')
+    return keys[0], dict(keys)
+
+
+# HMAC-SHA256 objects by secret, with the key already set up, so that
+# signing only has to copy one (Python 2's hmac module sets up the key all
+# over again for every hmac.new)
+_hmacs = {}
+
+def _sign(secret, signed):
+    try:
+        mac = _hmacs[secret]
+    except KeyError:
+        mac = _hmacs[secret] = hmac.new(str(secret), digestmod=sha256)
+    mac = mac.copy()
+    mac.update(signed)
+    return base64.urlsafe_b64encode(mac.digest())
+
+
+def issue_token(email, role, now=None):
+    """Returns a token for the user with this email and role, issued now
+    (defaulting to the current time).
+    """
+    if now is None:
+        now = time.time()
+    (key_id, secret), accepted = _keys()
+    payload = base64.urlsafe_b64encode(json.dumps([email, role, int(now)]))
+    signed = '{0}.{1}'.format(key_id, payload)
+    return '{0}.{1}'.format(signed, _sign(secret, signed))
+
+
+def verify_token(token, now=None):
+    """Returns the (email, role, issue time) of a token, raising
+    InvalidTokenError if it wasn't signed by an accepted key, or has
+    expired.
+    """
+    if now is None:
+        now = time.time()
+    current, accepted = _keys()
+    try:
+        signed, signature = str(token).rsplit('.', 1)
+        key_id, payload = signed.split('.', 1)
+        secret = accepted[key_id]
+    except (ValueError, KeyError, UnicodeError):
+        raise InvalidTokenError('Malformed token, or unknown key')
+    if not hmac.compare_digest(_sign(secret, signed), signature):
+        raise InvalidTokenError('Invalid token signature')
+    email, role, issued = json.loads(base64.urlsafe_b64decode(payload))
+    if now - issued >= options.token_ttl:
+        raise InvalidTokenError('Expired token')
+    return email, role, issued
@@ -14,9 +14,20 @@ import time
 import re
 import random
 import string
+import itertools
+import hmac
+import threading
+import multiprocessing
+from collections import deque
 from hashlib import sha256
 
 from . config import options
+from . db import borrow, add_query_hook
+from . cache import TTLCache
+from . import hashers
+from . import tokens
+from . sharding import point
+from . hashers import identify, make_password, needs_rehash
 from . exceptions import (InvalidEmailError, InvalidPasswordError,
                           InvalidRegistrationKeyError, ProgrammingError,
                           UserAlreadyActiveError, AuthenticationError,
@@ -33,8 +44,12 @@ def validate_email(email):
     
 
 def registration_key(username):
-    """Generates a pseudo-random registration key."""
-    return sha256(username + str(random.random())[2:]).hexdigest()
+    """Generates a pseudo-random registration key. Its last eight hex
+    digits are the point of username on a sharding.HashRing, so that a
+    ShardedConnection knows where to look for it.
+    """
+    return sha256(username + str(random.random())[2:]).hexdigest()[:56] + \
+        '{0:08x}'.format(point(username))
 
 
 def mkhash(passwd, salt=None):
@@ -50,6 +65,45 @@ def mkhash(passwd, salt=None):
     return h
 
 
+def verify_password(password, db_password):
+    """Whether password matches db_password, as stored on the database:
+    either encoded by a hasher, or a Hash made by mkhash.
+    """
+    if identify(db_password) is None:
+        db_hashed = Hash(db_password)
+        return hmac.compare_digest(mkhash(password, salt=db_hashed.salt),
+                                   db_hashed)
+    if options.hashing_executor is not None:
+        return options.hashing_executor.verify_password(password, db_password)
+    return hashers.verify_password(password, db_password)
+
+
+# Encoded passwords, by hasher and parameters, against which the passwords
+# of unknown users are verified
+_dummy_passwords = {}
+
+def _dummy_password():
+    """Returns a password encoded by the default hasher, at its current
+    cost, so that verifying it takes as long as verifying any user's.
+    """
+    hasher = hashers.default_hasher()
+    key = (hasher.algorithm, hasher.params())
+    try:
+        return _dummy_passwords[key]
+    except KeyError:
+        encoded = _dummy_passwords[key] = hasher.encode('dummy password')
+        return encoded
+
+
+def hash_password(password):
+    """Hashes password with the default hasher, on
+    options.hashing_executor if it's set.
+    """
+    if options.hashing_executor is not None:
+        return options.hashing_executor.make_password(password)
+    return make_password(password)
+
+
 def register_user(email=None, password=None, conn=None):
     if email is None:
         raise InvalidEmailError()
@@ -59,65 +113,371 @@ def register_user(email=None, password=None, conn=None):
     if conn is None:
         raise ProgrammingError()
     
-    passwd_hash = mkhash(password)
+    passwd_hash = hash_password(password)
     key = registration_key(email)
     now = int(time.time())
 
-    old_registration = conn.get_pending_user(email)
-    if old_registration is not None:
-        old_date = old_registration[3]
-        if now - old_date >= options.registration_expiration:
-            conn.delete_pending_user(email)
-    already_active = conn.get_user(email)
-    if already_active:
-        raise UserAlreadyActiveError("user '{0}' already exists".format(email))
-    conn.save_pending_user(email, passwd_hash, key, now)
+    with borrow(conn) as conn, conn.transaction():
+        old_registration = conn.get_pending_user(email)
+        if old_registration is not None:
+            old_date = old_registration[3]
+            if now - old_date >= options.registration_expiration:
+                conn.delete_pending_user(email)
+        already_active = conn.get_user(email)
+        if already_active:
+            raise UserAlreadyActiveError(
+                "user '{0}' already exists".format(email))
+        conn.save_pending_user(email, passwd_hash, key, now)
     return key
 
 
+def _prepare_users(offset, rows):
+    """Validates and hashes a chunk of (email, password, role) rows, the
+    first of which is number 'offset' of the import. Passwords which are
+    Hash instances are taken to be hashed already. Returns the (row
+    number, row) of the rows to insert, and the (row number, email,
+    exception args) of invalid ones.
+    """
+    valid, failed = [], []
+    for i, row in enumerate(rows, offset):
+        email = None
+        try:
+            email, password, role = row
+            validate_email(email)
+            if not password:
+                raise InvalidPasswordError()
+            if not isinstance(password, Hash):
+                password = make_password(password)
+        except Exception, e:
+            failed.append((i, email, e.args))
+        else:
+            valid.append((i, (email, str(password), role)))
+    return valid, failed
+
+
+def _insert_users(conn, valid, results):
+    """Inserts a chunk of prepared (row number, row) tuples in one
+    transaction or, if that fails, one at a time, recording those which
+    fail.
+    """
+    try:
+        with conn.transaction():
+            conn.many.save_user_with_role([row for i, row in valid])
+        results['imported'] += len(valid)
+        return
+    except Exception:
+        pass
+    with conn.transaction():
+        for i, row in valid:
+            try:
+                with conn.transaction():
+                    conn.save_user_with_role(*row)
+            except Exception, e:
+                results['failed'].append((i, row[0], e.args))
+            else:
+                results['imported'] += 1
+
+
+def _insert_prepared(conn, prepared, results):
+    if not isinstance(prepared, tuple):
+        prepared = prepared.get()
+    valid, failed = prepared
+    results['failed'].extend(failed)
+    if valid:
+        _insert_users(conn, valid, results)
+
+
+def bulk_import_users(users, conn, chunk_size=None, processes=None):
+    """Imports active users from an iterable of (email, password, role)
+    tuples, where password can be a Hash (of an already hashed password,
+    encoded by a hasher or made by mkhash) to be stored as is.
+
+    Users are read chunk_size at a time (defaulting to
+    options.import_chunk_size), validated and hashed by a pool of
+    'processes' processes (defaulting to options.import_processes; None
+    for one per CPU, 0 or 1 for none), or by options.hashing_executor if
+    it's set and processes isn't given, and each chunk is inserted in a
+    single transaction. If that fails, the chunk's users are inserted one
+    at a time, so that only the offending ones are left out.
+
+    Returns a dictionary with the number of users 'imported', the time
+    'elapsed' (in seconds), and the users that 'failed' (to validate, or
+    to be inserted), as a list of (row number, email, exception args)
+    tuples, rows being numbered from 0 (and email being None for rows that
+    aren't (email, password, role) tuples).
+    """
+    if chunk_size is None:
+        chunk_size = options.import_chunk_size
+    executor = None
+    if processes is None:
+        executor = options.hashing_executor
+        processes = options.import_processes
+    results = {'imported': 0, 'failed': []}
+    start = time.time()
+    users = iter(users)
+    chunks = iter(lambda: list(itertools.islice(users, chunk_size)), [])
+    pool = None
+    if executor is not None:
+        processes = executor.processes
+        submit = executor.submit
+    else:
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            submit = lambda func, *args: pool.apply_async(func, args)
+        else:
+            processes = 0
+    try:
+        with borrow(conn) as conn:
+            prepared = deque()
+            offset = 0
+            for chunk in chunks:
+                if not processes:
+                    prepared.append(_prepare_users(offset, chunk))
+                else:
+                    # At most two chunks per process are in flight, so
+                    # that users are streamed rather than all read at once
+                    prepared.append(submit(_prepare_users, offset, chunk))
+                offset += len(chunk)
+                while prepared and len(prepared) > 2 * processes:
+                    _insert_prepared(conn, prepared.popleft(), results)
+            while prepared:
+                _insert_prepared(conn, prepared.popleft(), results)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    results['elapsed'] = time.time() - start
+    return results
+
+
 def activate(key, conn):
-    user = conn.get_pending_user_by_key(key)
-    if not user:
-        raise InvalidRegistrationKeyError()
-    email, password = user
-    conn.save_user(email, password)
-    conn.delete_pending_user(email)
-
-
-def authenticate(email, password, conn):
-    db_credentials = conn.get_user(email)
-    if db_credentials is not None:
-        db_email, db_password, failed_attempts, suspended_until = db_credentials
-        db_hashed = Hash(db_password)
-        hashed = mkhash(password, salt=db_hashed.salt)
-        now = time.time()
-        if suspended_until is not None and now > suspended_until:
+    with borrow(conn) as conn, conn.transaction():
+        user = conn.get_pending_user_by_key(key)
+        if not user:
+            raise InvalidRegistrationKeyError()
+        email, password = user
+        conn.save_user(email, password)
+        conn.delete_pending_user(email)
+
+
+# Suspended users, mapped to the end of their suspension, so that they
+# can be rejected without going to the database
+_suspensions = TTLCache(max_size=options.suspension_cache_size)
+
+def _forget_suspension(email):
+    _suspensions.pop(email)
+
+add_query_hook('lift_user_suspension', _forget_suspension)
+
+
+def authenticate(email, password, conn, issue_token=False):
+    """Returns True if email and password are valid (raising
+    AuthenticationError otherwise), or, if issue_token is set, a session
+    token for the user (see the tokens module).
+    """
+    tracker = options.attempt_tracker
+    now = time.time()
+    if _suspensions.get(email, now=now) is not None:
+        # Hashing anyway, so that this doesn't tell the account exists
+        verify_password(password, _dummy_password())
+        raise AuthenticationError("invalid authentication credentials")
+    # Passwords are verified (and rehashed) with no connection borrowed nor
+    # transaction open, so that hashing doesn't hold database locks or
+    # pooled connections; only the writes that follow are in a transaction
+    with borrow(conn) as borrowed:
+        db_credentials = borrowed.get_user(email)
+    if db_credentials is None:
+        # So that unknown users take as long as wrong passwords
+        verify_password(password, _dummy_password())
+        raise AuthenticationError("invalid authentication credentials")
+    db_email, db_password, failed_attempts, suspended_until = db_credentials
+    valid_password = verify_password(password, db_password)
+    lift_suspension = suspended_until is not None and now > suspended_until
+    authenticated = (email == db_email and valid_password and
+                     (suspended_until is None or lift_suspension))
+    new_password = None
+    if (authenticated and options.rehash_passwords and
+        needs_rehash(db_password)):
+        new_password = hash_password(password)
+    if (authenticated and not lift_suspension and failed_attempts == 0 and
+        new_password is None and not issue_token):
+        # Nothing to write
+        if tracker is not None:
+            tracker.reset(email)
+        return True
+    if (not authenticated and tracker is not None and
+        suspended_until is None):
+        # Only the suspension itself is written to the database
+        failed_attempts = tracker.increment(email, now)
+        if failed_attempts < options.failed_auth_limit:
+            raise AuthenticationError("invalid authentication credentials")
+    with borrow(conn) as conn, conn.transaction():
+        if lift_suspension:
             conn.lift_user_suspension(email)
             suspended_until = None
             failed_attempts = 0
-        if (email == db_email and hashed == db_hashed and
-            suspended_until is None):
+        elif suspended_until is not None:
+            _suspensions.set(email, suspended_until,
+                             expires=suspended_until, now=now)
+        if authenticated:
             if failed_attempts > 0:
                 conn.lift_user_suspension(email)
+            if new_password is not None:
+                conn.set_user_password(email, new_password)
+            if tracker is not None:
+                tracker.reset(email)
+            if issue_token:
+                role = conn.get_user_access(email)[1]
+                return tokens.issue_token(email, role, now)
             return True
-        failed_attempts += 1
-        if failed_attempts == options.failed_auth_limit:
-            conn.suspend_user(email, failed_attempts,
-                              now + options.login_suspended_period)
+        if tracker is not None:
+            if lift_suspension:
+                failed_attempts = tracker.increment(email, now)
+            if (suspended_until is None and
+                failed_attempts >= options.failed_auth_limit):
+                _suspend(conn, email, failed_attempts, now)
+                tracker.reset(email)
         else:
-            conn.set_failed_login_attempts(email, failed_attempts)
+            failed_attempts += 1
+            if failed_attempts == options.failed_auth_limit:
+                _suspend(conn, email, failed_attempts, now)
+            else:
+                conn.set_failed_login_attempts(email, failed_attempts)
     raise AuthenticationError("invalid authentication credentials")
 
 
+def _suspend(conn, email, failed_attempts, now):
+    """Suspends the user for options.login_suspended_period seconds."""
+    suspended_until = now + options.login_suspended_period
+    conn.suspend_user(email, failed_attempts, suspended_until)
+    _suspensions.set(email, suspended_until, expires=suspended_until, now=now)
+
+
+# Roles of users seen by access_control, and role bitsets of users seen by
+# access_control_by_roles. Entries are forgotten when a user's roles are
+# changed, and expire anyway after options.role_cache_ttl seconds (for
+# changes made by other processes)
+_roles = TTLCache(options.role_cache_ttl, options.role_cache_size)
+_role_sets = TTLCache(options.role_cache_ttl, options.role_cache_size)
+_unknown_role = object()
+
+def _forget_role(email, role):
+    _roles.pop(email)
+    _role_sets.pop(email)
+
+add_query_hook('set_user_role', _forget_role)
+add_query_hook('add_user_role', _forget_role)
+add_query_hook('remove_user_role', _forget_role)
+
+
+# Bit of each role, in role bitsets, assigned as roles are first seen
+_role_bits = {}
+_role_bits_lock = threading.Lock()
+
+def role_bit(role):
+    try:
+        return _role_bits[role]
+    except KeyError:
+        with _role_bits_lock:
+            return _role_bits.setdefault(role, 1 << len(_role_bits))
+
+
+def role_set(roles):
+    """Returns the bitset of roles."""
+    bits = 0
+    for role in roles:
+        if role is not None:
+            bits |= role_bit(role)
+    return bits
+
+
+class RoleExpression(object):
+    """A requirement on a user's roles, which can be any_of or all_of some
+    roles (each of them a role name, or another RoleExpression). Calling it
+    with a user's role bitset tells whether they meet it.
+    """
+    def __init__(self, roles, require_all):
+        self._mask = role_set(r for r in roles
+                              if not isinstance(r, RoleExpression))
+        self._nested = [r for r in roles if isinstance(r, RoleExpression)]
+        self._require_all = require_all
+
+    def __call__(self, bits):
+        if self._require_all:
+            return (bits & self._mask == self._mask and
+                    all(e(bits) for e in self._nested))
+        return bool(bits & self._mask) or any(e(bits) for e in self._nested)
+
+
+def any_of(*roles):
+    return RoleExpression(roles, require_all=False)
+
+def all_of(*roles):
+    return RoleExpression(roles, require_all=True)
+
+
 def access_control(role):
     """Decorator to grant or deny access to functions, given a role"""
     def decorate(func):
         def auth_wrapper(email, conn, *args, **kwargs):
-            user_data = conn.get_user(email)
-            if user_data is None:
+            user_role = _roles.get(email, _unknown_role)
+            if user_role is _unknown_role:
+                with borrow(conn) as conn:
+                    user_access = conn.get_user_access(email)
+                if user_access is None:
+                    raise UnauthorizedAccessError("User does not have the "
+                                                  "role required by this "
+                                                  "resource")
+                user_role = user_access[1]
+                _roles.set(email, user_role)
+            if user_role != role:
+                raise UnauthorizedAccessError(
+                        "User does not have the role required by this resource")
+            return func(*args, **kwargs)
+        return auth_wrapper
+    return decorate
+
+
+def access_control_by_roles(expression):
+    """Decorator to grant or deny access to functions, given a role
+    expression (see any_of and all_of) or a single role. Users can have any
+    number of roles (see db.Connection.add_user_role), besides the one set
+    with db.Connection.set_user_role.
+    """
+    if not isinstance(expression, RoleExpression):
+        expression = any_of(expression)
+    def decorate(func):
+        def auth_wrapper(email, conn, *args, **kwargs):
+            bits = _role_sets.get(email)
+            if bits is None:
+                with borrow(conn) as conn:
+                    rows = conn.get_user_role_set(email)
+                if not rows:
+                    raise UnauthorizedAccessError("User does not have the "
+                                                  "role required by this "
+                                                  "resource")
+                bits = role_set([rows[0][1]] + [row[2] for row in rows])
+                _role_sets.set(email, bits)
+            if not expression(bits):
                 raise UnauthorizedAccessError(
-                    "User does not have the role required by this resource")
-            user_role = conn.get_user_role(email)
+                        "User does not have the role required by this resource")
+            return func(*args, **kwargs)
+        return auth_wrapper
+    return decorate
+
+
+def access_control_by_token(role):
+    """Decorator to grant or deny access to functions, given a role, to
+    users identified by a session token (see authenticate), without going
+    to the database. Decorated functions are called with the token as
+    their first argument, followed by their own arguments. Invalid or
+    expired tokens raise InvalidTokenError.
+    """
+    def decorate(func):
+        def auth_wrapper(token, *args, **kwargs):
+            email, user_role, issued = tokens.verify_token(token)
             if user_role != role:
                 raise UnauthorizedAccessError(
                         "User does not have the role required by this resource")